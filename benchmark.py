@@ -0,0 +1,397 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+from nuscenes.eval.common.config import config_factory
+from nuscenes.eval.detection.data_classes import DetectionMetricDataList, DetectionMetrics
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.GenericDetectionEval import GenericDetectionEval
+from classes.PartialDetectionStats import PartialDetectionStats
+from classes.StageProfiler import StageProfiler
+from classes.StreamingDetectionEval import StreamingDetectionEval
+from functions.filter_eval_boxes import filter_columnar_boxes, filter_eval_boxes, load_classes_filter
+from functions.load_gts import load_gts_columnar
+from functions.load_predictions import load_prediction_columnar
+from functions.render import render_output_dir
+from functions.save_boxes import save_boxes_json
+from functions.slice_boxes import load_slices, slice_masks
+from functions.synthetic_boxes import generate_synthetic_gts, generate_synthetic_predictions
+
+
+def run_script(args: list) -> dict:
+    """
+    Runs a Python script of the repository in a new process and measures it.
+    :param args: Script path and its arguments.
+    :return: Dict with the wall time (s) and the peak RSS (MB) of the process.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + args, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    exit_code = os.waitstatus_to_exitcode(status)
+    assert exit_code == 0, f'Error: {" ".join(args)} failed with exit code {exit_code}!'
+    # ru_maxrss is given in KB on Linux.
+    return {'wall_time': time.perf_counter() - start, 'peak_rss_mb': rusage.ru_maxrss / 1024}
+
+
+def measure_startup(work_dir: str, runs: int, seed: int = 0) -> dict:
+    """
+    Measures the startup time of `eval.py`: the wall time of evaluating a single sample (with the GTs cache already
+    created, without plots), which is almost all spent starting Python and importing modules.
+    :param work_dir: Folder where the synthetic JSONs and the results of the evaluations are saved.
+    :param runs: Number of measured evaluations.
+    :param seed: Seed of the synthetic boxes.
+    :return: Dict with the minimum and median wall times (s) of the evaluations and the minimum wall time of starting
+        Python alone.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    gts_path = os.path.join(work_dir, 'gts.json')
+    preds_path = os.path.join(work_dir, 'preds.json')
+    gt_boxes = generate_synthetic_gts(1, 20, seed=seed)
+    save_boxes_json(gt_boxes, gts_path)
+    save_boxes_json(generate_synthetic_predictions(gt_boxes, seed=seed), preds_path,
+                    meta={'use_camera': False, 'use_lidar': True, 'use_radar': False, 'use_map': False,
+                          'use_external': False})
+
+    eval_args = ['eval.py', gts_path, preds_path, '--verbose', '0', '--render_curves', '0', '--server', '0',
+                 '--output_dir', os.path.join(work_dir, 'eval')]
+    run_script(eval_args)  # Creates the GTs cache.
+    wall_times = sorted(run_script(eval_args)['wall_time'] for _ in range(runs))
+    python_time = min(run_script(['-c', 'pass'])['wall_time'] for _ in range(runs))
+    return {'min_wall_time': wall_times[0], 'median_wall_time': wall_times[len(wall_times) // 2],
+            'python_wall_time': python_time}
+
+
+def check_nuscenes_package_exports() -> bool:
+    """
+    Checks, in a new process, that every name defined by the `__init__` of the `nuscenes` package can still be imported
+    after the scripts skip it (see `skip_nuscenes_package_init`).
+    :return: Whether every name was imported.
+    """
+    code = ('from functions.lazy_imports import nuscenes_package_exports, skip_nuscenes_package_init\n'
+            'skip_nuscenes_package_init()\n'
+            'for name in nuscenes_package_exports():\n'
+            '    exec(f"from nuscenes import {name}")\n')
+    return subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL).returncode == 0
+
+
+def evaluation_results(nusc_eval: GenericDetectionEval) -> str:
+    """
+    Runs an evaluation and returns its results in a comparable form.
+    :param nusc_eval: The evaluation.
+    :return: JSON with the metrics (without the evaluation time) and the metric data.
+    """
+    return comparable_results(*nusc_eval.evaluate())
+
+
+def comparable_results(metrics: DetectionMetrics, metric_data_list: DetectionMetricDataList) -> str:
+    """
+    Converts the results of an evaluation to a comparable form.
+    :param metrics: The high-level metrics of the evaluation.
+    :param metric_data_list: The metric data of the evaluation.
+    :return: JSON with the metrics (without the evaluation time) and the metric data.
+    """
+    metrics_summary = metrics.serialize()
+    metrics_summary.pop('eval_time')
+    # NaN is not equal to itself, so the JSONs are compared instead of the dicts.
+    return json.dumps([metrics_summary, metric_data_list.serialize()], sort_keys=True)
+
+
+def check_correctness(gts_path: str, preds_path: str, filter_path: str, slices_path: str, work_dir: str,
+                      workers: int, num_shards: int = 3) -> dict:
+    """
+    Compares the metrics of the optimized evaluation paths to the devkit implementation of the evaluation.
+    :param gts_path: Path of the GTs JSON file.
+    :param preds_path: Path of the predictions JSON file.
+    :param filter_path: Path of a JSON filter file, used in the filtered checks.
+    :param slices_path: Path of a JSON slices file. Its first ego distance slice and its first attributes slice are
+        checked.
+    :param work_dir: Folder where the outputs of the evaluations are saved.
+    :param workers: Number of processes of the parallel checks.
+    :param num_shards: Number of hash shards of the distributed check.
+    :return: Dict mapping each check to whether its metrics are identical to the devkit ones.
+    """
+    def evaluation(name: str, **kwargs) -> GenericDetectionEval:
+        return GenericDetectionEval(config_factory('detection_cvpr_2019'), preds_path, gts_path,
+                                    output_dir=os.path.join(work_dir, name), verbose=False, gts_cache=False, **kwargs)
+
+    with open(preds_path, 'r') as f:
+        results = json.load(f)['results']
+
+    checks = {}
+    for filter_name, filter_kwargs in (('', {}), ('filtered_', {'filter_path': filter_path})):
+        reference = evaluation_results(evaluation(f'{filter_name}devkit', devkit_eval=True, **filter_kwargs))
+        checks[f'{filter_name}columnar'] = \
+            evaluation_results(evaluation(f'{filter_name}columnar', **filter_kwargs)) == reference
+        checks[f'{filter_name}columnar_workers'] = \
+            evaluation_results(evaluation(f'{filter_name}columnar', workers=max(workers, 2), **filter_kwargs)) == reference
+
+        # The second incremental evaluation reuses the matches of every sample.
+        shutil.rmtree(os.path.join(work_dir, f'{filter_name}incremental'), ignore_errors=True)
+        evaluation_results(evaluation(f'{filter_name}incremental', incremental=True, **filter_kwargs))
+        checks[f'{filter_name}incremental'] = \
+            evaluation_results(evaluation(f'{filter_name}incremental', incremental=True, **filter_kwargs)) == reference
+
+        # Hash shards evaluated separately and merged, as in a distributed evaluation.
+        shards = [PartialDetectionStats.evaluate_shard(config_factory('detection_cvpr_2019'), preds_path, gts_path,
+                                                       shard_index=i, num_shards=num_shards, verbose=False,
+                                                       gts_cache=False, **filter_kwargs)
+                  for i in range(num_shards)]
+        checks[f'{filter_name}shards'] = \
+            comparable_results(*PartialDetectionStats.merge(shards).evaluate()) == reference
+
+        # Predictions added one sample at a time, as by an inference loop.
+        streaming = StreamingDetectionEval(config_factory('detection_cvpr_2019'), gts_path, verbose=False,
+                                           gts_cache=False, **filter_kwargs)
+        for sample_token, boxes in results.items():
+            streaming.add_sample(sample_token, boxes)
+        checks[f'{filter_name}streaming'] = comparable_results(*streaming.current_results()) == reference
+
+    # One slice of each kind, compared to devkit evaluations of the GTs and predictions filtered by its criteria.
+    slices = load_slices(slices_path)
+    slices_evaluation = evaluation('slices', slices=slices)
+    slices_evaluation.evaluate()
+    gt_boxes = load_gts_columnar(gts_path, slices_evaluation.cfg.max_boxes_per_sample, use_cache=False)
+    pred_boxes, meta = load_prediction_columnar(preds_path, slices_evaluation.cfg.max_boxes_per_sample)
+    for criterion in ('ego_dist', 'attributes'):
+        slice_name, criteria = next((name, criteria) for name, criteria in slices.items() if criterion in criteria)
+        slice_dir = os.path.join(work_dir, f'slice_{criterion}')
+        os.makedirs(slice_dir, exist_ok=True)
+        save_boxes_json(gt_boxes.select(slice_masks(gt_boxes, {slice_name: criteria})[0]),
+                        os.path.join(slice_dir, 'gts.json'))
+        save_boxes_json(pred_boxes.select(slice_masks(pred_boxes, {slice_name: criteria})[0]),
+                        os.path.join(slice_dir, 'preds.json'), meta=meta)
+        config = config_factory('detection_cvpr_2019')
+        if 'class_names' in criteria:
+            config.class_names = [class_name for class_name in config.class_names
+                                  if class_name in criteria['class_names']]
+        reference = evaluation_results(GenericDetectionEval(config, os.path.join(slice_dir, 'preds.json'),
+                                                            os.path.join(slice_dir, 'gts.json'),
+                                                            output_dir=os.path.join(slice_dir, 'devkit'),
+                                                            verbose=False, gts_cache=False, devkit_eval=True))
+        checks[f'slice_{criterion}'] = comparable_results(*slices_evaluation.slice_results[slice_name]) == reference
+
+    return checks
+
+
+def quantize_boxes(boxes: ColumnarBoxes, step: float, score_decimals: int = None) -> None:
+    """
+    Rounds the centers (in the xy plane) of some boxes to a grid, in place, so many distances are tied or equal to the
+    distance thresholds. The ego translations are moved with the centers.
+    :param boxes: Boxes that will be quantized.
+    :param step: Size (in meters) of the cells of the grid.
+    :param score_decimals: If given, the detection scores are also rounded to these decimals, so many scores are tied.
+    """
+    delta = np.round(boxes.translation[:, :2] / step) * step - boxes.translation[:, :2]
+    boxes.translation[:, :2] += delta
+    boxes.ego_translation[:, :2] += delta
+    if score_decimals is not None:
+        boxes.detection_score[:] = np.round(boxes.detection_score, score_decimals)
+
+
+def check_crowd_correctness(work_dir: str, n_samples: int, workers: int, seed: int = 0) -> dict:
+    """
+    Compares the metrics of the optimized evaluation paths to the devkit implementation of the evaluation in dense
+    crowds: samples with hundreds of pedestrians (where the matching uses the BEV grid), with quantized centers and
+    scores that force ties.
+    :param work_dir: Folder where the synthetic JSONs and the outputs of the evaluations are saved.
+    :param n_samples: Number of samples of the crowd.
+    :param workers: Number of processes of the parallel check.
+    :param seed: Seed of the synthetic boxes.
+    :return: Dict mapping each check to whether its metrics are identical to the devkit ones.
+    """
+    cfg = config_factory('detection_cvpr_2019')
+    os.makedirs(work_dir, exist_ok=True)
+    gts_path = os.path.join(work_dir, 'gts.json')
+    preds_path = os.path.join(work_dir, 'preds.json')
+    # Up to 400 pedestrians around the ego vehicle (inside the 40m range of the class).
+    gt_boxes = generate_synthetic_gts(n_samples, 200, class_names=['pedestrian'], seed=seed)
+    gt_boxes.translation[:, :2] -= gt_boxes.ego_translation[:, :2] * 0.3
+    gt_boxes.ego_translation[:, :2] *= 0.7
+    pred_boxes = generate_synthetic_predictions(gt_boxes, false_positives_per_sample=100,
+                                                max_boxes_per_sample=cfg.max_boxes_per_sample, seed=seed)
+    quantize_boxes(gt_boxes, 0.5)
+    quantize_boxes(pred_boxes, 0.5, score_decimals=2)
+    save_boxes_json(gt_boxes, gts_path)
+    save_boxes_json(pred_boxes, preds_path, meta={'use_camera': False, 'use_lidar': True, 'use_radar': False,
+                                                  'use_map': False, 'use_external': False})
+
+    def evaluation(name: str, **kwargs) -> GenericDetectionEval:
+        return GenericDetectionEval(cfg, preds_path, gts_path, output_dir=os.path.join(work_dir, name),
+                                    verbose=False, gts_cache=False, **kwargs)
+
+    reference = evaluation_results(evaluation('devkit', devkit_eval=True))
+    return {'crowd_columnar': evaluation_results(evaluation('columnar')) == reference,
+            'crowd_columnar_workers': evaluation_results(evaluation('columnar', workers=max(workers, 2))) == reference}
+
+
+'''
+Mede o desempenho da avaliação com GTs e predições sintéticas (sem precisar da base da NuScenes) em várias escalas, e
+verifica se os resultados das implementações otimizadas são idênticos aos da implementação do devkit
+'''
+if __name__ == "__main__":
+
+    # Settings.
+    parser = argparse.ArgumentParser(description='Benchmark da avaliação com GTs e predições sintéticas.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--samples', type=int, nargs='+', default=[1000, 10000],
+                        help='Quantidades de amostras (escalas) usadas no benchmark.')
+    parser.add_argument('--boxes_per_sample', type=int, default=20,
+                        help='Quantidade média de GTs por amostra.')
+    parser.add_argument('--false_positives_per_sample', type=int, default=10,
+                        help='Quantidade média de falsos positivos por amostra nas predições.')
+    parser.add_argument('--noise', type=float, default=0.5,
+                        help='Desvio padrão (em metros) do erro da posição das predições. Os outros erros são proporcionais a ele.')
+    parser.add_argument('--set_size', type=int, default=3,
+                        help='Quantidade de arquivos de predições avaliados com o `set_eval.py`.')
+    parser.add_argument('--filter_path', type=str, default='filters/nuscenes_vrus.json',
+                        help='Filtro de classes usado nos benchmarks de filtragem e nas verificações com filtro.')
+    parser.add_argument('--slices_path', type=str, default='slices/ranges_and_attributes.json',
+                        help='Fatias usadas nas verificações (a primeira fatia de distância e a primeira fatia de atributos são comparadas com avaliações do devkit das GTs e predições filtradas pelos mesmos critérios).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Quantidade de processos usados pelo `eval.py` e pelo `set_eval.py`.')
+    parser.add_argument('--check_max_samples', type=int, default=2000,
+                        help='Os resultados são comparados com os da implementação do devkit (que é lenta) apenas nas escalas com até essa quantidade de amostras.')
+    parser.add_argument('--crowd_samples', type=int, default=10,
+                        help='Quantidade de amostras de uma multidão sintética (centenas de pedestres por amostra, com posições e scores arredondados para forçar empates) cujas métricas também são comparadas com as da implementação do devkit. Com 0, essa verificação não é feita.')
+    parser.add_argument('--work_dir', type=str, default='./benchmark',
+                        help='Pasta onde os JSONs sintéticos e os resultados das avaliações são salvos.')
+    parser.add_argument('--output_path', type=str, default='./benchmark/benchmark_results.json',
+                        help='JSON onde os resultados do benchmark são salvos.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Semente dos geradores aleatórios.')
+    parser.add_argument('--startup_runs', type=int, default=5,
+                        help='Quantidade de execuções do `eval.py` com uma única amostra usadas para medir o tempo de inicialização (importações). Com 0, o tempo de inicialização não é medido.')
+    parser.add_argument('--startup_budget', type=float, default=1.5,
+                        help='Tempo máximo (em segundos) de inicialização do `eval.py` (o menor tempo das execuções com uma única amostra). Se for ultrapassado, o script termina com erro.')
+    args = parser.parse_args()
+
+    work_dir_ = os.path.expanduser(args.work_dir)
+    filter_path_ = args.filter_path
+    workers_ = args.workers
+    cfg_ = config_factory('detection_cvpr_2019')
+    classes_filter_ = load_classes_filter(filter_path_)
+
+    results = []
+    failed_checks = []
+
+    startup = None
+    if args.startup_runs > 0:
+        print('Measuring the startup time of eval.py')
+        startup = measure_startup(os.path.join(work_dir_, 'startup'), args.startup_runs, seed=args.seed)
+        print('Startup time: %.2fs (median %.2fs, Python alone %.2fs, budget %.2fs)\n'
+              % (startup['min_wall_time'], startup['median_wall_time'], startup['python_wall_time'],
+                 args.startup_budget))
+        if startup['min_wall_time'] > args.startup_budget:
+            failed_checks.append('startup time of %.2fs above the budget of %.2fs'
+                                 % (startup['min_wall_time'], args.startup_budget))
+    nuscenes_exports = check_nuscenes_package_exports()
+    print('%-20s\t%s\n' % ('nuscenes_exports', 'importable' if nuscenes_exports else 'NOT IMPORTABLE'))
+    if not nuscenes_exports:
+        failed_checks.append('names of the nuscenes package not importable without its __init__')
+
+    crowd_checks = None
+    if args.crowd_samples > 0:
+        print(f'Comparing the results with the devkit evaluation in a crowd of {args.crowd_samples} samples')
+        crowd_checks = check_crowd_correctness(os.path.join(work_dir_, 'crowd'), args.crowd_samples, workers_,
+                                               seed=args.seed)
+        for name, passed in crowd_checks.items():
+            print('%-20s\t%s' % (name, 'identical to devkit' if passed else 'DIFFERENT FROM DEVKIT'))
+            if not passed:
+                failed_checks.append(name)
+        print()
+
+    for n_samples in args.samples:
+        scale_dir = os.path.join(work_dir_, f'{n_samples}_samples')
+        os.makedirs(scale_dir, exist_ok=True)
+        print(f'Generating {n_samples} samples in {scale_dir}')
+
+        gts_path = os.path.join(scale_dir, 'gts.json')
+        gt_boxes = generate_synthetic_gts(n_samples, args.boxes_per_sample, seed=args.seed)
+        save_boxes_json(gt_boxes, gts_path)
+        shutil.rmtree(os.path.join(scale_dir, '.cache'), ignore_errors=True)
+
+        infers_set = []
+        n_pred_boxes = []
+        for i in range(args.set_size):
+            pred_boxes = generate_synthetic_predictions(gt_boxes, noise=args.noise,
+                                                        false_positives_per_sample=args.false_positives_per_sample,
+                                                        max_boxes_per_sample=cfg_.max_boxes_per_sample,
+                                                        seed=args.seed + i)
+            preds_path = os.path.join(scale_dir, f'preds_{i}.json')
+            save_boxes_json(pred_boxes, preds_path, meta={'use_camera': False, 'use_lidar': True, 'use_radar': False,
+                                                          'use_map': False, 'use_external': False})
+            infers_set.append({'name': f'preds_{i}', 'infer_path': preds_path,
+                               'save_path': os.path.join(scale_dir, 'set_eval', f'preds_{i}')})
+            n_pred_boxes.append(len(pred_boxes))
+        with open(os.path.join(scale_dir, 'set.json'), 'w') as f:
+            json.dump(infers_set, f, indent=2)
+
+        # Boxes processed by each evaluation.
+        eval_boxes = len(gt_boxes) + n_pred_boxes[0]
+        set_boxes = len(gt_boxes) + sum(n_pred_boxes)
+        scale_results = {'samples': n_samples, 'gt_boxes': len(gt_boxes), 'pred_boxes': n_pred_boxes[0], 'steps': {}}
+        steps = scale_results['steps']
+
+        # Scripts, in new processes (the first evaluation also creates the GTs cache). A running evaluation server is
+        # not used, so the scripts are measured on their own.
+        eval_args = ['eval.py', gts_path, infers_set[0]['infer_path'], '--verbose', '0', '--render_curves', '0',
+                     '--workers', str(workers_), '--output_dir', os.path.join(scale_dir, 'eval'), '--server', '0']
+        steps['eval_cold_gts_cache'] = run_script(eval_args)
+        steps['eval'] = run_script(eval_args)
+        steps['eval_filter'] = run_script(eval_args + ['--filter_path', filter_path_])
+        steps['set_eval'] = run_script(['set_eval.py', gts_path, os.path.join(scale_dir, 'set.json'), '--verbose', '0',
+                                        '--render_curves', '0', '--workers', str(workers_), '--prefetch', '1',
+                                        '--output_dir', os.path.join(scale_dir, 'agg_results.json')])
+        for step in ('eval_cold_gts_cache', 'eval', 'eval_filter'):
+            steps[step]['boxes_per_s'] = eval_boxes / steps[step]['wall_time']
+        steps['set_eval']['boxes_per_s'] = set_boxes / steps['set_eval']['wall_time']
+
+        # Filtering and rendering, in this process (with the peak RSS of each stage).
+        profiler = StageProfiler()
+        columnar_gts = load_gts_columnar(gts_path, cfg_.max_boxes_per_sample, use_cache=True)
+        with profiler.stage('filter_columnar'):
+            filter_columnar_boxes(columnar_gts, classes_filter_)
+        eval_gts = columnar_gts.to_eval_boxes()
+        with profiler.stage('filter_devkit'):
+            filter_eval_boxes(eval_gts, classes_filter_)
+        with profiler.stage('render'):
+            render_output_dir(os.path.join(scale_dir, 'eval'))
+        for step, record in profiler.stages.items():
+            steps[step] = {'wall_time': record['wall_time'],
+                           'peak_rss_mb': record.get('peak_rss_mb', record.get('max_rss_so_far_mb')),
+                           'boxes_per_s': len(gt_boxes) / record['wall_time'] if step != 'render' else None}
+
+        if n_samples <= args.check_max_samples:
+            print('Comparing the results with the devkit evaluation')
+            scale_results['checks'] = check_correctness(gts_path, infers_set[0]['infer_path'], filter_path_,
+                                                        args.slices_path, os.path.join(scale_dir, 'checks'), workers_)
+            failed_checks += [f'{n_samples} samples: {name}' for name, passed in scale_results['checks'].items()
+                              if not passed]
+
+        results.append(scale_results)
+
+        print(f"\n{n_samples} samples ({len(gt_boxes)} GT boxes and {n_pred_boxes[0]} predicted boxes per file)")
+        print('%-20s\t%-10s\t%-12s\t%-10s' % ('Step', 'Time (s)', 'Boxes/s', 'Peak RSS (MB)'))
+        for step, record in steps.items():
+            boxes_per_s = '-' if record['boxes_per_s'] is None else '%.0f' % record['boxes_per_s']
+            print('%-20s\t%-10.2f\t%-12s\t%-10.0f' % (step, record['wall_time'], boxes_per_s, record['peak_rss_mb']))
+        for name, passed in scale_results.get('checks', {}).items():
+            print('%-20s\t%s' % (name, 'identical to devkit' if passed else 'DIFFERENT FROM DEVKIT'))
+        print()
+
+    if os.path.dirname(args.output_path):
+        os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
+    with open(args.output_path, 'w') as f:
+        json.dump({'startup': startup, 'nuscenes_exports': nuscenes_exports, 'crowd_checks': crowd_checks, 'scales': results}, f, indent=2)
+    print(f'Saved the results to {args.output_path}')
+
+    if failed_checks:
+        print('These checks failed (results different from the devkit evaluation or startup above the budget):\n'
+              + '\n'.join(failed_checks))
+        sys.exit(1)
@@ -0,0 +1,320 @@
+import copy
+import json
+from typing import List
+
+import numpy as np
+from nuscenes.eval.common.data_classes import EvalBoxes
+from nuscenes.eval.detection.data_classes import DetectionBox
+
+
+class ColumnarBoxes:
+    """
+    Column-oriented (structure of arrays) representation of an EvalBoxes of DetectionBox.
+    Every box field is stored in a NumPy array, where the boxes of each sample are contiguous and follow the
+    same order of the original EvalBoxes. The boxes of the sample i are in the range
+    [sample_offsets[i], sample_offsets[i + 1]).
+    Class and attribute names are stored as integer codes that index `class_names` and `attribute_names`.
+    Boxes with class code -1 belong to classes dropped by a filter and are ignored.
+    It also has the EvalBoxes interface used by the devkit (`sample_tokens`, `all` and indexing by sample token).
+    """
+    def __init__(self,
+                 sample_tokens: List[str],
+                 sample_offsets: np.ndarray,
+                 translation: np.ndarray,
+                 size: np.ndarray,
+                 rotation: np.ndarray,
+                 velocity: np.ndarray,
+                 ego_translation: np.ndarray,
+                 num_pts: np.ndarray,
+                 detection_score: np.ndarray,
+                 class_codes: np.ndarray,
+                 class_names: List[str],
+                 attribute_codes: np.ndarray,
+                 attribute_names: List[str]):
+        """
+        Initialize a ColumnarBoxes object. Use `from_eval_boxes` to build it from an EvalBoxes, or a
+        ColumnarBoxesBuilder to build it from serialized boxes.
+        :param sample_tokens: Sample tokens, in the same order of the boxes.
+        :param sample_offsets: Array (n_samples + 1,) with the first box index of each sample.
+        :param translation: Array (n_boxes, 3) with the boxes centers.
+        :param size: Array (n_boxes, 3) with the boxes sizes.
+        :param rotation: Array (n_boxes, 4) with the boxes rotation quaternions.
+        :param velocity: Array (n_boxes, 2) with the boxes velocities.
+        :param ego_translation: Array (n_boxes, 3) with the boxes translation to the ego vehicle.
+        :param num_pts: Array (n_boxes,) with the number of points inside each box.
+        :param detection_score: Array (n_boxes,) with the boxes scores.
+        :param class_codes: Array (n_boxes,) with the index of each box class in `class_names`.
+        :param class_names: Names of the classes.
+        :param attribute_codes: Array (n_boxes,) with the index of each box attribute in `attribute_names`.
+        :param attribute_names: Names of the attributes.
+        """
+        assert len(sample_offsets) == len(sample_tokens) + 1, 'Error: There must be one offset per sample (plus one)!'
+
+        self.sample_tokens = sample_tokens
+        self.sample_offsets = sample_offsets
+        self.translation = translation
+        self.size = size
+        self.rotation = rotation
+        self.velocity = velocity
+        self.ego_translation = ego_translation
+        self.num_pts = num_pts
+        self.detection_score = detection_score
+        self.class_codes = class_codes
+        self.class_names = class_names
+        self.attribute_codes = attribute_codes
+        self.attribute_names = attribute_names
+
+        self._sample_index = None
+        self._sample_lookup = None
+
+    def __len__(self) -> int:
+        return len(self.detection_score)
+
+    def __repr__(self):
+        return "ColumnarBoxes with {} boxes across {} samples".format(len(self), len(self.sample_tokens))
+
+    @property
+    def sample_index(self) -> np.ndarray:
+        """ Returns an array (n_boxes,) with the index of the sample of each box. """
+        if self._sample_index is None:
+            self._sample_index = np.repeat(np.arange(len(self.sample_tokens)), np.diff(self.sample_offsets))
+        return self._sample_index
+
+    def class_mask(self, class_name: str) -> np.ndarray:
+        """
+        Returns a boolean mask of the boxes of a given class.
+        :param class_name: Name of the class.
+        :return: Array (n_boxes,) which is True for the boxes of the class.
+        """
+        if class_name not in self.class_names:
+            return np.zeros(len(self), dtype=bool)
+        return self.class_codes == self.class_names.index(class_name)
+
+    def attribute_name_array(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns the attribute names of some boxes.
+        :param indices: Indices of the boxes.
+        :return: Array of strings with the attribute name of each box.
+        """
+        return np.array(self.attribute_names, dtype=str)[self.attribute_codes[indices]]
+
+    def __getitem__(self, sample_token: str) -> List[DetectionBox]:
+        """
+        Returns the boxes of a sample as DetectionBox objects, like EvalBoxes does. Boxes of dropped classes (see
+        `remap_classes`) are not included.
+        :param sample_token: Token of the sample.
+        :return: List with the boxes of the sample.
+        """
+        if self._sample_lookup is None:
+            self._sample_lookup = {sample_token: i for i, sample_token in enumerate(self.sample_tokens)}
+        i = self._sample_lookup[sample_token]
+        return self._detection_boxes(sample_token, self.sample_offsets[i], self.sample_offsets[i + 1])
+
+    @property
+    def all(self) -> List[DetectionBox]:
+        """ Returns all boxes as DetectionBox objects in a list, like EvalBoxes does. """
+        all_boxes = []
+        for sample_token in self.sample_tokens:
+            all_boxes.extend(self[sample_token])
+        return all_boxes
+
+    def _detection_boxes(self, sample_token: str, start: int, end: int) -> List[DetectionBox]:
+        """
+        Builds DetectionBox objects for a range of boxes of the same sample, skipping boxes of dropped classes.
+        The boxes are not validated again by the DetectionBox constructor (which is slow), since they were already
+        validated when this object was first built.
+        :param sample_token: Token of the sample.
+        :param start: First box index.
+        :param end: Last box index (exclusive).
+        :return: List with the boxes.
+        """
+        keep = np.arange(start, end)[self.class_codes[start:end] >= 0]
+        fields = {
+            'translation': map(tuple, self.translation[keep].tolist()),
+            'size': map(tuple, self.size[keep].tolist()),
+            'rotation': map(tuple, self.rotation[keep].tolist()),
+            'velocity': map(tuple, self.velocity[keep].tolist()),
+            'ego_translation': map(tuple, self.ego_translation[keep].tolist()),
+            'num_pts': self.num_pts[keep].tolist(),
+            'detection_name': [self.class_names[code] for code in self.class_codes[keep].tolist()],
+            'detection_score': self.detection_score[keep].tolist(),
+            'attribute_name': [self.attribute_names[code] for code in self.attribute_codes[keep].tolist()],
+        }
+
+        boxes = []
+        for values in zip(*fields.values()):
+            box = DetectionBox.__new__(DetectionBox)
+            box.__dict__.update(zip(fields.keys(), values), sample_token=sample_token)
+            boxes.append(box)
+        return boxes
+
+    def to_eval_boxes(self) -> EvalBoxes:
+        """
+        Builds an EvalBoxes of DetectionBox with the same boxes (except for boxes of dropped classes).
+        :return: EvalBoxes with the boxes.
+        """
+        boxes = EvalBoxes()
+        for i, sample_token in enumerate(self.sample_tokens):
+            boxes.add_boxes(sample_token,
+                            self._detection_boxes(sample_token, self.sample_offsets[i], self.sample_offsets[i + 1]))
+        return boxes
+
+    def remap_classes(self, lookup_table: np.ndarray, class_names: List[str]):
+        """
+        Renames and drops classes with a lookup table of class codes. The box arrays are not copied nor modified.
+        See `functions/filter_eval_boxes.py` to build the lookup table from a classes filter.
+        :param lookup_table: Array (len(self.class_names) + 1,) with the new code of each class code. The last entry is
+            the new code of the boxes already dropped, and classes mapped to -1 are dropped.
+        :param class_names: Names of the new classes.
+        :return: A new ColumnarBoxes sharing the box arrays, with the new class codes and names.
+        """
+        return self.with_class_codes(lookup_table[self.class_codes], class_names)
+
+    def with_class_codes(self, class_codes: np.ndarray, class_names: List[str]):
+        """
+        Returns a view of the boxes with other class codes. The box arrays are not copied nor modified.
+        :param class_codes: Array (n_boxes,) with the index of each box class in `class_names`, or -1 to drop the box.
+        :param class_names: Names of the classes.
+        :return: A new ColumnarBoxes sharing the box arrays, with the given class codes and names.
+        """
+        assert len(class_codes) == len(self), 'Error: There must be one class code per box!'
+        view = copy.copy(self)
+        view.class_codes = class_codes
+        view.class_names = class_names
+        return view
+
+    def select(self, mask: np.ndarray):
+        """
+        Selects some of the boxes, keeping all samples (even if they end up without boxes) and the boxes order.
+        :param mask: Boolean array (n_boxes,) which is True for the boxes that will be kept.
+        :return: A new ColumnarBoxes with copies of the selected boxes.
+        """
+        # The new offset of each sample is the number of selected boxes before it.
+        selected_before = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+        sample_offsets = selected_before[self.sample_offsets]
+        return ColumnarBoxes(sample_tokens=list(self.sample_tokens),
+                             sample_offsets=sample_offsets,
+                             translation=self.translation[mask],
+                             size=self.size[mask],
+                             rotation=self.rotation[mask],
+                             velocity=self.velocity[mask],
+                             ego_translation=self.ego_translation[mask],
+                             num_pts=self.num_pts[mask],
+                             detection_score=self.detection_score[mask],
+                             class_codes=self.class_codes[mask],
+                             class_names=list(self.class_names),
+                             attribute_codes=self.attribute_codes[mask],
+                             attribute_names=list(self.attribute_names))
+
+    def select_samples(self, sample_mask: np.ndarray):
+        """
+        Selects some of the samples, with all their boxes, keeping the samples and boxes order.
+        :param sample_mask: Boolean array (n_samples,) which is True for the samples that will be kept.
+        :return: A new ColumnarBoxes with copies of the boxes of the selected samples.
+        """
+        boxes = self.select(np.repeat(sample_mask, np.diff(self.sample_offsets)))
+        boxes.sample_tokens = [sample_token for sample_token, keep in zip(self.sample_tokens, sample_mask) if keep]
+        boxes.sample_offsets = np.concatenate([boxes.sample_offsets[:-1][sample_mask], boxes.sample_offsets[-1:]])
+        return boxes
+
+    def save(self, path: str, metadata: dict = None) -> None:
+        """
+        Saves the boxes in a binary (uncompressed .npz) file.
+        :param path: Path of the file.
+        :param metadata: JSON compatible data saved with the boxes, which can be read with `load_metadata`.
+        """
+        with open(path, 'wb') as file:
+            np.savez(file,
+                     metadata=np.array(json.dumps(metadata), dtype=str),
+                     sample_tokens=np.array(self.sample_tokens, dtype=str),
+                     sample_offsets=self.sample_offsets,
+                     translation=self.translation,
+                     size=self.size,
+                     rotation=self.rotation,
+                     velocity=self.velocity,
+                     ego_translation=self.ego_translation,
+                     num_pts=self.num_pts,
+                     detection_score=self.detection_score,
+                     class_codes=self.class_codes,
+                     class_names=np.array(self.class_names, dtype=str),
+                     attribute_codes=self.attribute_codes,
+                     attribute_names=np.array(self.attribute_names, dtype=str))
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads boxes saved with `save`.
+        :param path: Path of the file.
+        :return: ColumnarBoxes with the boxes.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(sample_tokens=data['sample_tokens'].tolist(),
+                       sample_offsets=data['sample_offsets'],
+                       translation=data['translation'],
+                       size=data['size'],
+                       rotation=data['rotation'],
+                       velocity=data['velocity'],
+                       ego_translation=data['ego_translation'],
+                       num_pts=data['num_pts'],
+                       detection_score=data['detection_score'],
+                       class_codes=data['class_codes'],
+                       class_names=data['class_names'].tolist(),
+                       attribute_codes=data['attribute_codes'],
+                       attribute_names=data['attribute_names'].tolist())
+
+    @staticmethod
+    def load_metadata(path: str):
+        """
+        Loads the metadata saved with the boxes by `save`.
+        :param path: Path of the file.
+        :return: The metadata, or None if it was not given.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if 'metadata' not in data.files:
+                return None
+            return json.loads(str(data['metadata']))
+
+    @classmethod
+    def from_eval_boxes(cls, boxes: EvalBoxes):
+        """
+        Builds the columnar representation of an EvalBoxes.
+        :param boxes: EvalBoxes with DetectionBox instances.
+        :return: ColumnarBoxes with the same boxes.
+        """
+        sample_tokens = boxes.sample_tokens
+        all_boxes: List[DetectionBox] = boxes.all
+        sample_offsets = np.zeros(len(sample_tokens) + 1, dtype=np.int64)
+        sample_offsets[1:] = np.cumsum([len(boxes[sample_token]) for sample_token in sample_tokens])
+
+        class_names: List[str] = []
+        class_lookup: dict[str, int] = {}
+        attribute_names: List[str] = []
+        attribute_lookup: dict[str, int] = {}
+        class_codes = np.empty(len(all_boxes), dtype=np.int64)
+        attribute_codes = np.empty(len(all_boxes), dtype=np.int64)
+        for i, box in enumerate(all_boxes):
+            if box.detection_name not in class_lookup:
+                class_lookup[box.detection_name] = len(class_names)
+                class_names.append(box.detection_name)
+            if box.attribute_name not in attribute_lookup:
+                attribute_lookup[box.attribute_name] = len(attribute_names)
+                attribute_names.append(box.attribute_name)
+            class_codes[i] = class_lookup[box.detection_name]
+            attribute_codes[i] = attribute_lookup[box.attribute_name]
+
+        def field(name: str, width: int) -> np.ndarray:
+            return np.array([getattr(box, name) for box in all_boxes], dtype=np.float64).reshape(-1, width)
+
+        return cls(sample_tokens=sample_tokens,
+                   sample_offsets=sample_offsets,
+                   translation=field('translation', 3),
+                   size=field('size', 3),
+                   rotation=field('rotation', 4),
+                   velocity=field('velocity', 2),
+                   ego_translation=field('ego_translation', 3),
+                   num_pts=np.array([box.num_pts for box in all_boxes], dtype=np.int64),
+                   detection_score=np.array([box.detection_score for box in all_boxes], dtype=np.float64),
+                   class_codes=class_codes,
+                   class_names=class_names,
+                   attribute_codes=attribute_codes,
+                   attribute_names=attribute_names)
@@ -0,0 +1,107 @@
+from typing import List
+
+import numpy as np
+from nuscenes.eval.detection.constants import ATTRIBUTE_NAMES, DETECTION_NAMES
+
+from classes.ColumnarBoxes import ColumnarBoxes
+
+
+class ColumnarBoxesBuilder:
+    """
+    Builds a ColumnarBoxes from serialized boxes (dicts in the nuScenes JSON format), one sample at a time.
+    Each sample is converted to arrays as soon as it is added, so the serialized boxes can be discarded right away.
+    The boxes are validated as the DetectionBox constructor does.
+    """
+    int_fields = ['num_pts', 'class_codes', 'attribute_codes']
+    field_widths = {'translation': 3, 'size': 3, 'rotation': 4, 'velocity': 2, 'ego_translation': 3,
+                    'num_pts': None, 'detection_score': None, 'class_codes': None, 'attribute_codes': None}
+
+    def __init__(self, classes_filter: dict[str, list[str]] = None):
+        """
+        Initialize a ColumnarBoxesBuilder object.
+        :param classes_filter: A dict where the keys are new class names and the values are arrays with old class names
+            that will be replaced by the new name. Boxes of other classes are dropped. If not given, no filter is applied.
+        """
+        self.classes_filter = classes_filter
+        self.class_names: List[str] = []
+        self.class_lookup: dict[str, int] = {}
+        if classes_filter is not None:
+            self.class_names = list(classes_filter.keys())
+            for new_class, old_classes_list in classes_filter.items():
+                for old_class in old_classes_list:
+                    self.class_lookup[old_class] = self.class_names.index(new_class)
+        self.known_names = set()
+        self.attribute_names: List[str] = []
+        self.attribute_lookup: dict[str, int] = {}
+
+        self.sample_tokens: List[str] = []
+        self.sample_sizes: List[int] = []
+        self.columns: dict[str, List[np.ndarray]] = {name: [] for name in self.field_widths}
+
+    def _validate_names(self, boxes: List[dict]) -> None:
+        """
+        Validates the class and attribute names of the boxes, registering the new ones.
+        :param boxes: Serialized boxes.
+        """
+        for box in boxes:
+            if box['detection_name'] not in self.known_names:
+                assert box['detection_name'] in DETECTION_NAMES, \
+                    'Error: Unknown detection_name %s' % box['detection_name']
+                self.known_names.add(box['detection_name'])
+                if self.classes_filter is None:
+                    self.class_lookup[box['detection_name']] = len(self.class_names)
+                    self.class_names.append(box['detection_name'])
+            if box['attribute_name'] not in self.attribute_lookup:
+                assert box['attribute_name'] in ATTRIBUTE_NAMES or box['attribute_name'] == '', \
+                    'Error: Unknown attribute_name %s' % box['attribute_name']
+                self.attribute_lookup[box['attribute_name']] = len(self.attribute_names)
+                self.attribute_names.append(box['attribute_name'])
+
+    def add_sample(self, sample_token: str, boxes: List[dict]) -> None:
+        """
+        Adds the boxes of a sample. Samples must be added only once.
+        :param sample_token: Token of the sample.
+        :param boxes: Serialized boxes of the sample.
+        """
+        self._validate_names(boxes)
+        boxes = [box for box in boxes if box['detection_name'] in self.class_lookup]
+
+        self.sample_tokens.append(sample_token)
+        self.sample_sizes.append(len(boxes))
+        self.columns['translation'].append(np.array([box['translation'] for box in boxes], dtype=np.float64))
+        self.columns['size'].append(np.array([box['size'] for box in boxes], dtype=np.float64))
+        self.columns['rotation'].append(np.array([box['rotation'] for box in boxes], dtype=np.float64))
+        self.columns['velocity'].append(np.array([box['velocity'] for box in boxes], dtype=np.float64))
+        self.columns['ego_translation'].append(np.array([box.get('ego_translation', (0.0, 0.0, 0.0))
+                                                         for box in boxes], dtype=np.float64))
+        self.columns['num_pts'].append(np.array([box.get('num_pts', -1) for box in boxes], dtype=np.int64))
+        self.columns['detection_score'].append(np.array([box.get('detection_score', -1.0) for box in boxes],
+                                                        dtype=np.float64))
+        self.columns['class_codes'].append(np.array([self.class_lookup[box['detection_name']] for box in boxes],
+                                                    dtype=np.int64))
+        self.columns['attribute_codes'].append(np.array([self.attribute_lookup[box['attribute_name']]
+                                                         for box in boxes], dtype=np.int64))
+
+    def build(self) -> ColumnarBoxes:
+        """
+        Builds the ColumnarBoxes with all samples added so far.
+        :return: ColumnarBoxes with the boxes.
+        """
+        arrays = {}
+        for name, width in self.field_widths.items():
+            # The empty array keeps the shape and type when there are no samples.
+            dtype = np.int64 if name in self.int_fields else np.float64
+            shape = (-1,) if width is None else (-1, width)
+            empty = np.empty((0,) if width is None else (0, width), dtype=dtype)
+            arrays[name] = np.concatenate([empty] + [values.reshape(shape) for values in self.columns[name]])
+
+        sample_offsets = np.zeros(len(self.sample_tokens) + 1, dtype=np.int64)
+        sample_offsets[1:] = np.cumsum(self.sample_sizes)
+        boxes = ColumnarBoxes(sample_tokens=list(self.sample_tokens),
+                              sample_offsets=sample_offsets,
+                              class_names=list(self.class_names),
+                              attribute_names=list(self.attribute_names),
+                              **arrays)
+        assert not np.any(np.isnan(boxes.detection_score)), 'Error: detection_score may not be NaN!'
+
+        return boxes
@@ -0,0 +1,468 @@
+import json
+import multiprocessing
+import os
+import selectors
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+from nuscenes.eval.common.config import config_factory
+from nuscenes.eval.detection.data_classes import DetectionConfig
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.GenericDetectionEval import GenericDetectionEval
+from functions.filter_eval_boxes import filter_columnar_boxes, load_classes_filter
+from functions.load_gts import gts_cache_path, load_gts_columnar
+from functions.presets import resolve_gts_preset
+from functions.slice_boxes import load_slices
+
+
+def _file_version(path: str) -> Tuple[int, int]:
+    """
+    Version of a file, which changes when the file is modified.
+    :param path: Path of the file.
+    :return: Tuple with the modification time (in ns) and the size of the file.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _run_evaluation(request: dict, gt_boxes: Optional[ColumnarBoxes], result_conn, verbose: bool,
+                    gts_load: Optional[dict]) -> None:
+    """
+    Runs an evaluation of the server, in a forked process, and sends its response through a pipe.
+    :param request: The evaluation request (see EvaluationServer), with absolute paths.
+    :param gt_boxes: GT boxes already loaded and filtered, or None if they are loaded by this process.
+    :param result_conn: Connection (end of a pipe) where the response is sent, with the binary file of the loaded GTs
+        (if any), so the server loads them into memory for the next evaluations. The GTs themselves are not sent
+        through the pipe.
+    :param verbose: Whether to print to stdout. If False, the prints of the evaluation are discarded.
+    :param gts_load: If gt_boxes is None, the GTs to load: a dict with the `key` and `version` of the GTs in the server
+        cache, whether to use the `gts_cache` and the `spill_path` where the GTs are saved if they have no binary cache.
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    payload_path = None
+    loaded_gts = None
+    try:
+        if gt_boxes is None:
+            # Loading (and parsing) the GTs may take a while, so it is done here instead of in the server loop.
+            gts_path, max_boxes_per_sample = gts_load['key']
+            all_gt_boxes = load_gts_columnar(gts_path, max_boxes_per_sample, verbose=verbose,
+                                             use_cache=gts_load['gts_cache'])
+            # The server loads the GTs from their binary cache (created by the load), or from a temporary copy.
+            cache_path = gts_cache_path(gts_path) if gts_load['gts_cache'] else None
+            if cache_path is not None and os.path.exists(cache_path):
+                loaded_gts = (gts_load['key'], gts_load['version'], cache_path, False)
+            else:
+                all_gt_boxes.save(gts_load['spill_path'])
+                loaded_gts = (gts_load['key'], gts_load['version'], gts_load['spill_path'], True)
+            gt_boxes = all_gt_boxes
+            if request.get('filter_path'):
+                gt_boxes = filter_columnar_boxes(all_gt_boxes, load_classes_filter(request['filter_path']))
+
+        output_dir = request['output_dir']
+        os.makedirs(output_dir, exist_ok=True)
+        result_path = request.get('result_path')
+        if result_path is None:
+            # Predictions sent in the request are saved to a temporary file, since the evaluation loads them from disk.
+            fd, payload_path = tempfile.mkstemp(suffix='.json', dir=output_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(request['predictions'], f)
+            result_path = payload_path
+
+        config = request.get('config')
+        config = config_factory('detection_cvpr_2019') if config is None else DetectionConfig.deserialize(config)
+        bootstrap_groups = None
+        if request.get('bootstrap_groups_path'):
+            with open(request['bootstrap_groups_path'], 'r') as f:
+                bootstrap_groups = json.load(f)
+        slices = load_slices(request['slices_path']) if request.get('slices_path') else None
+
+        nusc_eval = GenericDetectionEval(config=config, result_path=result_path, gts_path=request['gts_path'],
+                                         filter_path=request.get('filter_path'), output_dir=output_dir,
+                                         verbose=verbose, gt_boxes=gt_boxes, workers=request.get('workers', 1),
+                                         incremental=request.get('incremental', False),
+                                         profile=request.get('profile', False),
+                                         bootstrap=request.get('bootstrap', 0),
+                                         bootstrap_seed=request.get('bootstrap_seed', 0),
+                                         bootstrap_groups=bootstrap_groups, slices=slices)
+        metrics_summary = nusc_eval.main(plot_examples=0, render_curves=request.get('render_curves', True))
+        # The serialized metrics have nested defaultdicts (which can not be pickled), so they are sent as plain dicts.
+        response = {'status': 'ok', 'metrics_summary': json.loads(json.dumps(metrics_summary))}
+    except Exception:
+        response = {'status': 'error', 'error': traceback.format_exc()}
+    try:
+        result_conn.send((response, loaded_gts))
+    finally:
+        if payload_path is not None and os.path.exists(payload_path):
+            os.remove(payload_path)
+        result_conn.close()
+
+
+class EvaluationServer:
+    """
+    Local evaluation service, run by `eval_server.py`, that keeps the GTs loaded (and filtered) in memory, so an
+    evaluation does not pay the import time of the devkit nor the loading of the GTs. Clients (e.g. `eval.py`, see
+    `functions/eval_client.py`) connect to a Unix socket and send one JSON request per connection:
+    - {"command": "evaluate", "gts_path": ..., "result_path": ..., "output_dir": ..., ...}: Evaluates the predictions
+      of `result_path` (or the predictions JSON given in `predictions`) and answers with the metrics summary. The other
+      optional fields are `filter_path`, `config` (a serialized DetectionConfig), `render_curves`, `workers`,
+      `incremental`, `profile`, `bootstrap`, `bootstrap_seed`, `bootstrap_groups_path` and `slices_path`, as in
+      GenericDetectionEval. Paths must be absolute.
+    - {"command": "status"}: Answers with the number of queued and running evaluations and the loaded (and filtered)
+      GTs.
+    - {"command": "shutdown"}: Stops the server after the running evaluations end.
+    The server runs in a single thread that never blocks: requests are read from non-blocking sockets, evaluations are
+    queued and each one runs in a process forked from the server, which inherits the GTs without copying them, with at
+    most `max_jobs` evaluations at the same time. GTs that are not in memory yet (or whose files changed) are loaded by
+    the evaluation process, which saves them in a binary file (their GTs cache, if it is used) that the server loads to
+    keep them for the next evaluations. Each GTs file is loaded by a single evaluation at a time: the other evaluations
+    of the same GTs wait in the queue until they are in memory. At most `max_gts`
+    GT files and `max_filtered_gts` filtered GTs are kept, dropping the least recently used ones.
+    """
+    # Maximum time (in seconds) for a client to send its request.
+    request_timeout = 30
+    def __init__(self, socket_path: str, max_jobs: int = 1, gts_cache: bool = True, verbose: bool = True,
+                 max_gts: int = 2, max_filtered_gts: int = 8):
+        """
+        Initialize an EvaluationServer object.
+        :param socket_path: Path of the Unix socket. A stale socket file (of a server that is not running) is replaced.
+        :param max_jobs: Maximum number of evaluations running at the same time.
+        :param gts_cache: Whether to load the GTs from a binary cache of the GTs JSON file (created in the first load).
+        :param verbose: Whether to print to stdout (including the prints of the evaluations).
+        :param max_gts: Maximum number of GTs (files loaded with a max number of boxes per sample) kept in memory.
+        :param max_filtered_gts: Maximum number of filtered GTs (GTs with a filter) kept in memory.
+        """
+        assert max_gts > 0 and max_filtered_gts > 0, 'Error: The server must keep at least one set of GTs!'
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.gts_cache = gts_cache
+        self.verbose = verbose
+        self.max_gts = max_gts
+        self.max_filtered_gts = max_filtered_gts
+
+        # GTs loaded with each max number of boxes per sample, and their filtered views, with the versions of the files.
+        # Both are ordered from the least to the most recently used.
+        self._gts: Dict[Tuple[str, int], Tuple[Tuple[int, int], ColumnarBoxes]] = OrderedDict()
+        self._filtered_gts: Dict[Tuple[str, Optional[str], int], Tuple[tuple, ColumnarBoxes]] = OrderedDict()
+
+        self._reading = {}  # Client socket of each request being received -> (received data, connection time).
+        self._pending = deque()  # (client socket, request) of the queued evaluations.
+        # Result connection of each running evaluation -> (client socket, process, start time, key of the GTs it loads).
+        self._running = {}
+        self._loading = {}  # Key of each GTs being loaded by an evaluation -> version of the GTs file.
+        self._spill_dir = None  # Temporary folder of the GTs loaded by evaluations without a GTs cache.
+        self._spill_count = 0
+        self._stopping = False
+        self._context = multiprocessing.get_context('fork')
+        self._selector = None
+        self._socket = None
+
+    def __repr__(self):
+        return "EvaluationServer at {} ({} GTs loaded)".format(self.socket_path, len(self._gts))
+
+    def load_gts(self, gts_path: str, filter_path: Optional[str] = None, max_boxes_per_sample: int = 500) -> ColumnarBoxes:
+        """
+        Returns the GTs of a GTs file and filter, loading them only if they are not in memory or if the files changed.
+        :param gts_path: Path of the GTs JSON file.
+        :param filter_path: Path of the JSON filter file. If None, no filter is applied.
+        :param max_boxes_per_sample: Maximum number of boxes per sample of the config.
+        :return: The (filtered) GT boxes.
+        """
+        gt_boxes = self.cached_gts(gts_path, filter_path, max_boxes_per_sample)
+        if gt_boxes is None:
+            gts_path = os.path.abspath(gts_path)
+            if self.verbose:
+                print(f'Loading the GTs of {gts_path}')
+            self._store_gts((gts_path, max_boxes_per_sample), _file_version(gts_path),
+                            load_gts_columnar(gts_path, max_boxes_per_sample, verbose=self.verbose,
+                                              use_cache=self.gts_cache))
+            gt_boxes = self.cached_gts(gts_path, filter_path, max_boxes_per_sample)
+        return gt_boxes
+
+    def cached_gts(self, gts_path: str, filter_path: Optional[str] = None,
+                   max_boxes_per_sample: int = 500) -> Optional[ColumnarBoxes]:
+        """
+        Returns the GTs of a GTs file and filter if they are in memory and the GTs file did not change. Only the filter
+        (which is fast) may be applied, the GTs file is never loaded.
+        :param gts_path: Path of the GTs JSON file.
+        :param filter_path: Path of the JSON filter file. If None, no filter is applied.
+        :param max_boxes_per_sample: Maximum number of boxes per sample of the config.
+        :return: The (filtered) GT boxes, or None if they must be loaded.
+        """
+        gts_path = os.path.abspath(gts_path)
+        filter_path = None if filter_path is None else os.path.abspath(filter_path)
+        version = (_file_version(gts_path), None if filter_path is None else _file_version(filter_path))
+
+        gts_key = (gts_path, max_boxes_per_sample)
+        if gts_key in self._gts and self._gts[gts_key][0] != version[0]:
+            # The GTs file changed, so its old GTs (and their filtered views) are dropped.
+            self._drop_gts(gts_key)
+        if gts_key not in self._gts:
+            return None
+        self._gts.move_to_end(gts_key)
+
+        filtered_key = (gts_path, filter_path, max_boxes_per_sample)
+        if filtered_key in self._filtered_gts and self._filtered_gts[filtered_key][0] == version:
+            self._filtered_gts.move_to_end(filtered_key)
+            return self._filtered_gts[filtered_key][1]
+
+        gt_boxes = self._gts[gts_key][1]
+        if filter_path is not None:
+            gt_boxes = filter_columnar_boxes(gt_boxes, load_classes_filter(filter_path))
+        self._filtered_gts.pop(filtered_key, None)
+        self._filtered_gts[filtered_key] = (version, gt_boxes)
+        while len(self._filtered_gts) > self.max_filtered_gts:
+            self._filtered_gts.popitem(last=False)
+        return gt_boxes
+
+    def _store_gts(self, gts_key: Tuple[str, int], version: Tuple[int, int], gt_boxes: ColumnarBoxes) -> None:
+        """
+        Keeps loaded GTs in memory, replacing an older version of them and dropping the least recently used GTs if
+        there are more than max_gts.
+        :param gts_key: Tuple with the absolute path of the GTs file and the max number of boxes per sample.
+        :param version: Version of the GTs file (see `_file_version`) when it was loaded.
+        :param gt_boxes: The GT boxes.
+        """
+        self._drop_gts(gts_key)
+        self._gts[gts_key] = (version, gt_boxes)
+        while len(self._gts) > self.max_gts:
+            oldest_key = next(iter(self._gts))
+            if self.verbose:
+                print(f'Dropping the GTs of {oldest_key[0]} from memory')
+            self._drop_gts(oldest_key)
+
+    def _drop_gts(self, gts_key: Tuple[str, int]) -> None:
+        """
+        Removes GTs from memory, with all their filtered views.
+        :param gts_key: Tuple with the absolute path of the GTs file and the max number of boxes per sample.
+        """
+        self._gts.pop(gts_key, None)
+        for filtered_key in [key for key in self._filtered_gts if (key[0], key[2]) == gts_key]:
+            del self._filtered_gts[filtered_key]
+
+    def preload(self, presets: List[str]) -> None:
+        """
+        Loads the GTs of some presets (see GTS_PRESETS), with the default config.
+        :param presets: Names of the presets, or GTs paths.
+        """
+        max_boxes_per_sample = config_factory('detection_cvpr_2019').max_boxes_per_sample
+        for preset in presets:
+            gts_path, filter_path = resolve_gts_preset(preset)
+            self.load_gts(gts_path, filter_path, max_boxes_per_sample)
+
+    def serve_forever(self) -> None:
+        """
+        Listens to the socket and runs the requested evaluations until a shutdown request (or an interruption).
+        """
+        self._bind()
+        self._spill_dir = tempfile.mkdtemp(prefix='eval_server_')
+        if self.verbose:
+            print(f'Listening on {self.socket_path}')
+        try:
+            while not (self._stopping and not self._running):
+                for key, _ in self._selector.select(timeout=1):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data == 'client':
+                        self._receive(key.fileobj)
+                    else:
+                        self._finish(key.fileobj)
+                self._drop_stalled_clients()
+                self._start_pending()
+        finally:
+            for client in list(self._reading):
+                self._selector.unregister(client)
+                self._respond(client, {'status': 'error', 'error': 'The server was stopped.'})
+            while self._pending:
+                self._respond(self._pending.popleft()[0], {'status': 'error', 'error': 'The server was stopped.'})
+            self._selector.close()
+            self._socket.close()
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def _bind(self) -> None:
+        """
+        Creates the listening socket, replacing a stale socket file.
+        """
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(self.socket_path) == 0:
+                    raise RuntimeError(f'Error: Another evaluation server is already running at {self.socket_path}!')
+            os.remove(self.socket_path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.socket_path)
+        self._socket.listen()
+        self._socket.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ, None)
+
+    def _accept(self) -> None:
+        """
+        Accepts a connection. Its request is received without blocking the server (see `_receive`).
+        """
+        try:
+            client, _ = self._socket.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        self._reading[client] = (b'', time.perf_counter())
+        self._selector.register(client, selectors.EVENT_READ, 'client')
+
+    def _receive(self, client: socket.socket) -> None:
+        """
+        Receives the data sent by a client and, once its request (a line) is complete, handles it.
+        :param client: Socket of the client.
+        """
+        data, start_time = self._reading[client]
+        try:
+            chunk = client.recv(1 << 16)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        if chunk and b'\n' not in chunk:
+            self._reading[client] = (data + chunk, start_time)
+            return
+
+        self._selector.unregister(client)
+        del self._reading[client]
+        if not chunk:
+            # The client disconnected without sending a whole request.
+            client.close()
+            return
+        self._handle(client, (data + chunk).split(b'\n', 1)[0])
+
+    def _drop_stalled_clients(self) -> None:
+        """
+        Answers with an error the clients that did not send their request in `request_timeout` seconds.
+        """
+        now = time.perf_counter()
+        for client, (_, start_time) in list(self._reading.items()):
+            if now - start_time > self.request_timeout:
+                self._selector.unregister(client)
+                del self._reading[client]
+                self._respond(client, {'status': 'error', 'error': 'Timed out waiting for the request.'})
+
+    def _handle(self, client: socket.socket, line: bytes) -> None:
+        """
+        Handles a request (status and shutdown requests are answered immediately, evaluations are queued).
+        :param client: Socket of the client.
+        :param line: The JSON request.
+        """
+        try:
+            request = json.loads(line)
+            command = request.get('command', 'evaluate')
+            if command == 'status':
+                self._respond(client, {'status': 'ok', 'queued': len(self._pending), 'running': len(self._running),
+                                       'gts': [{'gts_path': gts_path, 'max_boxes_per_sample': max_boxes_per_sample}
+                                               for gts_path, max_boxes_per_sample in self._gts],
+                                       'filtered_gts': [{'gts_path': gts_path, 'filter_path': filter_path}
+                                                        for gts_path, filter_path, _ in self._filtered_gts],
+                                       'loading_gts': [gts_path for gts_path, _ in self._loading]})
+            elif command == 'shutdown':
+                self._stopping = True
+                self._respond(client, {'status': 'ok'})
+            elif command == 'evaluate':
+                self._pending.append((client, request))
+                if self.verbose:
+                    print(f"Queued the evaluation of {request.get('result_path', 'the sent predictions')}")
+            else:
+                raise ValueError(f'Unknown command {command}')
+        except Exception:
+            self._respond(client, {'status': 'error', 'error': traceback.format_exc()})
+
+    def _start_pending(self) -> None:
+        """
+        Starts queued evaluations, up to max_jobs running at the same time. Evaluations of GTs that are being loaded by
+        another evaluation stay in the queue (in order), without blocking the evaluations behind them.
+        """
+        waiting = []
+        while self._pending and len(self._running) < self.max_jobs and not self._stopping:
+            client, request = self._pending.popleft()
+            try:
+                config = request.get('config')
+                max_boxes_per_sample = (config_factory('detection_cvpr_2019') if config is None else
+                                        DetectionConfig.deserialize(config)).max_boxes_per_sample
+                gts_path = os.path.abspath(request['gts_path'])
+                gts_key = (gts_path, max_boxes_per_sample)
+                gt_boxes = self.cached_gts(gts_path, request.get('filter_path'), max_boxes_per_sample)
+                gts_load = None
+                if gt_boxes is None:
+                    version = _file_version(gts_path)
+                    if self._loading.get(gts_key) == version:
+                        waiting.append((client, request))
+                        continue
+                    if self.verbose:
+                        print(f'Loading the GTs of {gts_path} in the evaluation process')
+                    self._loading[gts_key] = version
+                    self._spill_count += 1
+                    gts_load = {'key': gts_key, 'version': version, 'gts_cache': self.gts_cache,
+                                'spill_path': os.path.join(self._spill_dir, f'gts_{self._spill_count}.npz')}
+            except Exception:
+                self._respond(client, {'status': 'error', 'error': traceback.format_exc()})
+                continue
+
+            result_conn, child_conn = self._context.Pipe(duplex=False)
+            process = self._context.Process(target=_run_evaluation,
+                                            args=(request, gt_boxes, child_conn, self.verbose, gts_load))
+            process.start()
+            child_conn.close()
+            self._running[result_conn] = (client, process, time.perf_counter(), gts_load and gts_load['key'])
+            self._selector.register(result_conn, selectors.EVENT_READ, 'evaluation')
+        self._pending.extendleft(reversed(waiting))
+
+    def _finish(self, result_conn) -> None:
+        """
+        Sends the response of an evaluation that ended to its client.
+        :param result_conn: Connection where the evaluation sends its response.
+        """
+        self._selector.unregister(result_conn)
+        client, process, start_time, loading_key = self._running.pop(result_conn)
+        try:
+            response, loaded_gts = result_conn.recv()
+        except EOFError:
+            response, loaded_gts = {'status': 'error', 'error': 'The evaluation process ended without a response.'}, None
+        if loading_key is not None:
+            self._loading.pop(loading_key, None)
+        if loaded_gts is not None:
+            # The GTs loaded by the evaluation are kept for the next evaluations.
+            gts_key, version, gts_file, temporary = loaded_gts
+            try:
+                self._store_gts(gts_key, version, ColumnarBoxes.load(gts_file))
+            except OSError:
+                # E.g. the GTs file changed and its cache was replaced. The GTs are loaded again when needed.
+                pass
+            finally:
+                if temporary and os.path.exists(gts_file):
+                    os.remove(gts_file)
+        result_conn.close()
+        process.join()
+        if self.verbose:
+            print('Evaluation finished (%s) in %.1fs' % (response['status'], time.perf_counter() - start_time))
+        self._respond(client, response)
+
+    @staticmethod
+    def _respond(client: socket.socket, response: dict) -> None:
+        """
+        Sends a response and closes the connection. Clients that already disconnected are ignored.
+        :param client: Socket of the client.
+        :param response: The response.
+        """
+        try:
+            client.setblocking(True)
+            client.settimeout(EvaluationServer.request_timeout)
+            client.sendall(json.dumps(response).encode() + b'\n')
+        except OSError:
+            pass
+        finally:
+            client.close()
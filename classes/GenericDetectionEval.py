@@ -3,21 +3,34 @@
 
 import json
 import os
+import time
+from typing import Any, Dict, List, Tuple, Union
 
-from functions.filter_eval_boxes import filter_eval_boxes
-from functions.load_gts import load_gts
-from functions.render import class_pr_curve, class_tp_curve, dist_pr_curve, summary_plot
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.SampleMatchCache import SampleMatchCache
+from classes.StageProfiler import StageProfiler
+from functions.accumulate_columnar import accumulate_classes, accumulate_slices
+from functions.bootstrap_metrics import bootstrap_metrics
+from functions.calc_metrics import calc_detection_metrics
+from functions.eval_client import print_metrics_summary
+from functions.filter_eval_boxes import filter_columnar_boxes, filter_columnar_boxes_multi, filter_eval_boxes, \
+    load_classes_filter
+from functions.load_gts import load_gts, load_gts_columnar
+from functions.load_predictions import load_prediction_columnar
+from functions.slice_boxes import slice_masks
 
-from nuscenes.eval.common.loaders import load_prediction
+from nuscenes.eval.common.data_classes import EvalBoxes
 from nuscenes.eval.detection.data_classes import DetectionBox, DetectionConfig, DetectionMetricDataList, DetectionMetrics
-from nuscenes.eval.detection.evaluate import DetectionEval
 
 
-class GenericDetectionEval(DetectionEval):
+class GenericDetectionEval:
     """
-    This is an adaptation of the official nuScenes detection evaluation.
+    This is an adaptation of the official nuScenes detection evaluation (DetectionEval), with the same interface.
     It will calculate the same metrics, but it can be used for any dataset, given the GTs JSON.
     Results are written to the provided output_dir.
+    It does not inherit DetectionEval, whose module imports the NuScenes class and matplotlib: the devkit modules only
+    needed by the devkit evaluation and by the plots are imported when they are used, so short evaluations do not pay
+    their import time.
 
     nuScenes uses the following detection metrics:
     - Mean Average Precision (mAP): Uses center-distance as matching criterion; averaged over distance thresholds.
@@ -26,8 +39,12 @@ class GenericDetectionEval(DetectionEval):
 
     Here is an overview of the functions in this method:
     - init: Loads GT annotations and predictions stored in JSON format and filters the boxes.
+      Unless `devkit_eval` is used, the boxes are kept in columnar arrays (ColumnarBoxes) instead of DetectionBox objects.
+    - evaluate: Matches the boxes with a vectorized (columnar) implementation of the devkit accumulate.
+      The original devkit implementation can still be used with `devkit_eval`, e.g. to verify the results.
     - run: Performs evaluation and dumps the metric data to disk.
     - render: Renders various plots and dumps to disk.
+    - main_multi_filter: Evaluates several classes filters loading the GTs and predictions only once.
 
     We assume that:
     - Every sample_token is given in the results, although there may be not predictions for that sample.
@@ -40,7 +57,20 @@ class GenericDetectionEval(DetectionEval):
                  gts_path: str,
                  filter_path: str = None,
                  output_dir: str = None,
-                 verbose: bool = True):
+                 verbose: bool = True,
+                 devkit_eval: bool = False,
+                 gts_cache: bool = True,
+                 gt_boxes: Union[EvalBoxes, ColumnarBoxes] = None,
+                 workers: int = 1,
+                 pred_boxes: Union[EvalBoxes, ColumnarBoxes] = None,
+                 meta: dict = None,
+                 match_cache: dict = None,
+                 incremental: bool = False,
+                 profile: bool = False,
+                 bootstrap: int = 0,
+                 bootstrap_seed: int = 0,
+                 bootstrap_groups: Dict[str, str] = None,
+                 slices: Dict[str, dict] = None):
         """
         Initialize a DetectionEval object.
         :param config: A DetectionConfig object.
@@ -49,11 +79,50 @@ class GenericDetectionEval(DetectionEval):
         :param filter_path: Path to JSON filter file. If not given, it will not use any filters.
         :param output_dir: Folder to save plots and results to.
         :param verbose: Whether to print to stdout.
+        :param devkit_eval: Whether to use the (slower) devkit implementation of the evaluation instead of the columnar one.
+        :param gts_cache: Whether to load the GTs from a binary cache of the GTs JSON file (created in the first run).
+        :param gt_boxes: GT boxes already loaded (and filtered, if filter_path is given), e.g. with `load_filtered_gts`.
+            If given, gts_path is not used. It allows loading the GTs only once to evaluate several result files.
+        :param workers: Number of processes used to evaluate the classes (not used with devkit_eval) and to render the
+            plots in parallel.
+        :param pred_boxes: Predicted boxes already loaded (and filtered, if filter_path is given), in the representation
+            used by the evaluation (EvalBoxes with devkit_eval, ColumnarBoxes otherwise). If given, result_path is not
+            loaded and `meta` must also be given.
+        :param meta: Meta data of the predictions given in pred_boxes.
+        :param match_cache: Dict shared by evaluations of the same GTs and predictions with different classes filters.
+            The accumulated data of classes made of the same original classes is stored in it and reused (not used
+            with devkit_eval).
+        :param incremental: Whether to keep the matching results of each sample in a cache in output_dir
+            (`sample_match_cache.npz`), so reruns only match the samples whose boxes changed (not used with devkit_eval).
+        :param profile: Whether to record the wall time, CPU time and peak RSS of each stage (and class) of the
+            evaluation, which are saved to `timings.json` in output_dir.
+        :param bootstrap: Number of bootstrap replicates used to compute confidence intervals of the metrics, which are
+            saved to `metrics_bootstrap.json` in output_dir. If 0, they are not computed (not used with devkit_eval).
+        :param bootstrap_seed: Seed of the bootstrap replicates.
+        :param bootstrap_groups: Dict mapping each sample token to its group (e.g. scene token), which is resampled as
+            a whole by the bootstrap. If not given, each sample is resampled independently.
+        :param slices: Slices of the boxes (e.g. ego distance ranges or attributes) that are also evaluated, loaded with
+            `load_slices`. The metrics of each slice are saved to a subdirectory of `slices` in output_dir (not used
+            with devkit_eval).
         """
         self.result_path = result_path
         self.output_dir = output_dir
         self.verbose = verbose
         self.cfg = config
+        self.devkit_eval = devkit_eval
+        self.workers = workers
+        self.match_cache = match_cache
+        self.incremental = incremental
+        self.profiler = StageProfiler(enabled=profile)
+        self.bootstrap = bootstrap
+        self.bootstrap_seed = bootstrap_seed
+        self.bootstrap_groups = bootstrap_groups
+        self.bootstrap_summary = None
+        self.slices = slices
+        self.slice_results: Dict[str, Tuple[DetectionMetrics, DetectionMetricDataList]] = {}
+
+        assert not (bootstrap and devkit_eval), 'Error: The bootstrap is not supported with devkit_eval.'
+        assert not (slices and devkit_eval), 'Error: The slices are not supported with devkit_eval.'
 
         # Check result file exists.
         assert os.path.exists(result_path), 'Error: The result file does not exist!'
@@ -68,55 +137,439 @@ class GenericDetectionEval(DetectionEval):
         # Load data.
         if verbose:
             print('Initializing nuScenes detection evaluation')
-        self.pred_boxes, self.meta = load_prediction(self.result_path, self.cfg.max_boxes_per_sample, DetectionBox, verbose=verbose)
-        self.gt_boxes = load_gts(gts_path, self.cfg.max_boxes_per_sample, DetectionBox, verbose=verbose)
-
-        if filter_path:
-            if verbose:
-                print('Filtering classes')
-            
-            with open(filter_path, mode='r') as json_file:
-                classes_filter = json.load(json_file)
-            
+        classes_filter = load_classes_filter(filter_path) if filter_path else None
+        if classes_filter is not None:
             self.cfg.class_names = list(classes_filter.keys())
+        self.classes_filter = classes_filter
 
-            self.pred_boxes = filter_eval_boxes(self.pred_boxes, classes_filter)
-            self.gt_boxes = filter_eval_boxes(self.gt_boxes, classes_filter)
+        if pred_boxes is not None:
+            assert meta is not None, 'Error: The meta data of the predictions must be given with pred_boxes.'
+            self.pred_boxes, self.meta = pred_boxes, meta
+        else:
+            with self.profiler.stage('load_predictions'):
+                self.pred_boxes, self.meta = self.load_filtered_predictions(self.result_path, self.cfg,
+                                                                            classes_filter=classes_filter,
+                                                                            verbose=verbose,
+                                                                            devkit_eval=self.devkit_eval)
+
+        if gt_boxes is None:
+            with self.profiler.stage('load_gts'):
+                self.gt_boxes = self.load_filtered_gts(gts_path, self.cfg, classes_filter=classes_filter,
+                                                       verbose=verbose, devkit_eval=self.devkit_eval,
+                                                       gts_cache=gts_cache)
+        elif self.devkit_eval and isinstance(gt_boxes, ColumnarBoxes):
+            self.gt_boxes = gt_boxes.to_eval_boxes()
+        elif not self.devkit_eval and isinstance(gt_boxes, EvalBoxes):
+            self.gt_boxes = ColumnarBoxes.from_eval_boxes(gt_boxes)
+        else:
+            self.gt_boxes = gt_boxes
 
         assert set(self.pred_boxes.sample_tokens) == set(self.gt_boxes.sample_tokens), \
             "Samples in split doesn't match samples in predictions."
 
         self.sample_tokens = self.gt_boxes.sample_tokens
 
+    @staticmethod
+    def load_filtered_predictions(result_path: str,
+                                  config: DetectionConfig,
+                                  classes_filter: dict[str, list[str]] = None,
+                                  verbose: bool = True,
+                                  devkit_eval: bool = False) -> Tuple[Union[EvalBoxes, ColumnarBoxes], dict]:
+        """
+        Loads the predictions and applies the classes filter, in the representation used by the evaluation.
+        :param result_path: Path of the nuScenes JSON result file.
+        :param config: A DetectionConfig object.
+        :param classes_filter: Classes filter (see `load_classes_filter`). If not given, no filter is applied.
+        :param verbose: Whether to print to stdout.
+        :param devkit_eval: Whether the predictions will be used by the devkit implementation of the evaluation.
+        :return: The predictions (EvalBoxes if devkit_eval is used, ColumnarBoxes otherwise) and their meta data.
+        """
+        if devkit_eval:
+            from nuscenes.eval.common.loaders import load_prediction
+            pred_boxes, meta = load_prediction(result_path, config.max_boxes_per_sample, DetectionBox, verbose=verbose)
+            if classes_filter is not None:
+                if verbose:
+                    print('Filtering classes')
+                pred_boxes = filter_eval_boxes(pred_boxes, classes_filter)
+        else:
+            # The predictions are streamed into columnar arrays, already filtered.
+            pred_boxes, meta = load_prediction_columnar(result_path, config.max_boxes_per_sample,
+                                                        classes_filter=classes_filter, verbose=verbose)
+        return pred_boxes, meta
+
+    @staticmethod
+    def load_filtered_gts(gts_path: str,
+                          config: DetectionConfig,
+                          classes_filter: dict[str, list[str]] = None,
+                          verbose: bool = True,
+                          devkit_eval: bool = False,
+                          gts_cache: bool = True) -> Union[EvalBoxes, ColumnarBoxes]:
+        """
+        Loads the GTs and applies the classes filter, in the representation used by the evaluation.
+        :param gts_path: Path of the GTs JSON file.
+        :param config: A DetectionConfig object.
+        :param classes_filter: Classes filter (see `load_classes_filter`). If not given, no filter is applied.
+        :param verbose: Whether to print to stdout.
+        :param devkit_eval: Whether the GTs will be used by the devkit implementation of the evaluation.
+        :param gts_cache: Whether to load the GTs from a binary cache of the GTs JSON file (created in the first run).
+        :return: EvalBoxes if devkit_eval is used, ColumnarBoxes otherwise.
+        """
+        if devkit_eval:
+            gt_boxes = load_gts(gts_path, config.max_boxes_per_sample, DetectionBox, verbose=verbose,
+                                use_cache=gts_cache)
+            if classes_filter is not None:
+                gt_boxes = filter_eval_boxes(gt_boxes, classes_filter)
+        else:
+            gt_boxes = load_gts_columnar(gts_path, config.max_boxes_per_sample, verbose=verbose, use_cache=gts_cache)
+            if classes_filter is not None:
+                gt_boxes = filter_columnar_boxes(gt_boxes, classes_filter)
+        return gt_boxes
+
+    @classmethod
+    def main_multi_filter(cls,
+                          config: DetectionConfig,
+                          result_path: str,
+                          gts_path: str,
+                          filter_paths: List[str],
+                          output_dir: str,
+                          verbose: bool = True,
+                          devkit_eval: bool = False,
+                          gts_cache: bool = True,
+                          workers: int = 1,
+                          render_curves: bool = True,
+                          incremental: bool = False,
+                          profile: bool = False,
+                          bootstrap: int = 0,
+                          bootstrap_seed: int = 0,
+                          bootstrap_groups: Dict[str, str] = None,
+                          slices: Dict[str, dict] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Evaluates the same predictions with several classes filters, loading the GTs and predictions only once.
+        The results of each filter are saved in a subdirectory of output_dir named after the filter file (without the
+        extension). Classes that are made of the same original classes in more than one filter (e.g. `pedestrian` in
+        every filter that keeps it as its own class) are matched only once.
+        :param config: A DetectionConfig object. It is not modified.
+        :param result_path: Path of the nuScenes JSON result file.
+        :param gts_path: Path of the GTs JSON file.
+        :param filter_paths: Paths to the JSON filter files.
+        :param output_dir: Folder to save the subdirectories of each filter to.
+        :param verbose: Whether to print to stdout.
+        :param devkit_eval: Whether to use the (slower) devkit implementation of the evaluation instead of the columnar one.
+        :param gts_cache: Whether to load the GTs from a binary cache of the GTs JSON file (created in the first run).
+        :param workers: Number of processes used to evaluate the classes (not used with devkit_eval) and to render the
+            plots in parallel.
+        :param render_curves: Whether to render PR and TP curves to disk.
+        :param incremental: Whether to keep the matching results of each sample in a cache in the subdirectory of each
+            filter, so reruns only match the samples whose boxes changed (not used with devkit_eval).
+        :param profile: Whether to record the time and memory of each stage. The stages of each filter are saved to the
+            `timings.json` of its subdirectory, and the loading and filtering of the boxes to `timings.json` in
+            output_dir.
+        :param bootstrap: Number of bootstrap replicates used to compute confidence intervals of the metrics of each
+            filter. If 0, they are not computed.
+        :param bootstrap_seed: Seed of the bootstrap replicates.
+        :param bootstrap_groups: Dict mapping each sample token to its group (e.g. scene token), which is resampled as
+            a whole by the bootstrap. If not given, each sample is resampled independently.
+        :param slices: Slices of the boxes that are also evaluated with each filter (see `load_slices`).
+        :return: Dict mapping each filter name to the dict with its high-level metrics and meta data.
+        """
+        filter_names = [os.path.splitext(os.path.basename(filter_path))[0] for filter_path in filter_paths]
+        assert len(set(filter_names)) == len(filter_names), 'Error: The filter files must have different names!'
+        classes_filters = {filter_name: load_classes_filter(filter_path)
+                           for filter_name, filter_path in zip(filter_names, filter_paths)}
+
+        profiler = StageProfiler(enabled=profile)
+        with profiler.stage('load_gts'):
+            gt_boxes = cls.load_filtered_gts(gts_path, config, verbose=verbose, devkit_eval=devkit_eval,
+                                             gts_cache=gts_cache)
+        if devkit_eval:
+            from nuscenes.eval.common.loaders import load_prediction
+            with profiler.stage('load_predictions'):
+                pred_boxes, meta = load_prediction(result_path, config.max_boxes_per_sample, DetectionBox,
+                                                   verbose=verbose)
+            with profiler.stage('filter'):
+                filtered_gts = {name: filter_eval_boxes(gt_boxes, classes_filters[name]) for name in filter_names}
+                filtered_preds = {name: filter_eval_boxes(pred_boxes, classes_filters[name]) for name in filter_names}
+        else:
+            with profiler.stage('load_predictions'):
+                pred_boxes, meta = load_prediction_columnar(result_path, config.max_boxes_per_sample, verbose=verbose)
+            with profiler.stage('filter'):
+                filtered_gts = filter_columnar_boxes_multi(gt_boxes, classes_filters)
+                filtered_preds = filter_columnar_boxes_multi(pred_boxes, classes_filters)
+        os.makedirs(output_dir, exist_ok=True)
+        profiler.save(os.path.join(output_dir, 'timings.json'))
+
+        match_cache = {}
+        metrics_summaries = {}
+        for filter_name, filter_path in zip(filter_names, filter_paths):
+            if verbose:
+                print(f'Evaluating filter {filter_name}')
+            nusc_eval = cls(config=DetectionConfig.deserialize(config.serialize()), result_path=result_path, gts_path=gts_path,
+                            filter_path=filter_path, output_dir=os.path.join(output_dir, filter_name), verbose=verbose,
+                            devkit_eval=devkit_eval, gt_boxes=filtered_gts[filter_name], workers=workers,
+                            pred_boxes=filtered_preds[filter_name], meta=meta, match_cache=match_cache,
+                            incremental=incremental, profile=profile, bootstrap=bootstrap,
+                            bootstrap_seed=bootstrap_seed, bootstrap_groups=bootstrap_groups, slices=slices)
+            metrics_summaries[filter_name] = nusc_eval.main(plot_examples=0, render_curves=render_curves)
+
+        return metrics_summaries
+
+    def evaluate(self) -> Tuple[DetectionMetrics, DetectionMetricDataList]:
+        """
+        Performs the actual evaluation.
+        :return: A tuple of high-level and the raw metric data.
+        """
+        if self.devkit_eval:
+            from nuscenes.eval.detection.evaluate import DetectionEval
+            with self.profiler.stage('evaluate'):
+                return DetectionEval.evaluate(self)
+
+        start_time = time.time()
+
+        assert self.cfg.dist_fcn == 'center_distance', \
+            'Error: Only center_distance is supported by the columnar evaluation, use devkit_eval instead.'
+        gt_columns: ColumnarBoxes = self.gt_boxes
+        pred_columns: ColumnarBoxes = self.pred_boxes
+
+        # -----------------------------------
+        # Step 1: Accumulate metric data for all classes and distance thresholds.
+        # -----------------------------------
+        if self.verbose:
+            print('Accumulating metric data...')
+        # All distance thresholds of a class are matched in a single pass, and classes may run in parallel.
+        # Classes already accumulated by the evaluation of another classes filter are reused.
+        # The bootstrap resamples the matching results of each class, so they are also kept.
+        cache_keys = self.match_cache_keys()
+        keep_matches = bool(self.bootstrap)
+        classes_metric_data = {}
+        class_matches = {}
+        missing_classes = []
+        for class_name in self.cfg.class_names:
+            cached = self.match_cache.get(cache_keys[class_name]) if self.match_cache is not None else None
+            if cached is not None and (cached[1] is not None or not keep_matches):
+                classes_metric_data[class_name], class_matches[class_name] = cached
+            else:
+                missing_classes.append(class_name)
+        # In incremental evaluations, only the samples that changed since the last run are matched.
+        sample_cache = None
+        if self.incremental and missing_classes:
+            sample_cache = SampleMatchCache.load(self.sample_cache_path)
+        with self.profiler.stage('accumulate'):
+            accumulated = accumulate_classes(gt_columns, pred_columns, missing_classes, self.cfg.dist_ths,
+                                             workers=self.workers, sample_cache=sample_cache, profiler=self.profiler,
+                                             return_matches=keep_matches)
+        missing_metric_data, missing_matches = accumulated if keep_matches else (accumulated, {})
+        classes_metric_data.update(missing_metric_data)
+        class_matches.update(missing_matches)
+        if sample_cache is not None:
+            if self.verbose:
+                print(f'Reused the matches of {sample_cache.hits} of {sample_cache.hits + sample_cache.misses} '
+                      f'samples (and classes) from {self.sample_cache_path}')
+            sample_cache.save(self.sample_cache_path)
+        if self.match_cache is not None:
+            for class_name in missing_classes:
+                self.match_cache[cache_keys[class_name]] = (classes_metric_data[class_name],
+                                                            class_matches[class_name] if keep_matches else None)
+
+        metric_data_list = DetectionMetricDataList()
+        for class_name in self.cfg.class_names:
+            for dist_th in self.cfg.dist_ths:
+                metric_data_list.set(class_name, dist_th, classes_metric_data[class_name][dist_th])
+
+        # -----------------------------------
+        # Step 2: Calculate metrics from the data.
+        # -----------------------------------
+        if self.verbose:
+            print('Calculating metrics...')
+        with self.profiler.stage('calc_metrics'):
+            metrics = self.calc_metrics(metric_data_list)
+
+        # -----------------------------------
+        # Step 3: Metrics of the slices, matching the boxes of every slice in a single pass.
+        # -----------------------------------
+        if self.slices:
+            if self.verbose:
+                print(f'Evaluating {len(self.slices)} slices...')
+            with self.profiler.stage('slices'):
+                self.slice_results = self.evaluate_slices()
+
+        # -----------------------------------
+        # Step 4: Bootstrap confidence intervals of the metrics.
+        # -----------------------------------
+        if self.bootstrap:
+            if self.verbose:
+                print(f'Computing {self.bootstrap} bootstrap replicates...')
+            with self.profiler.stage('bootstrap'):
+                self.bootstrap_summary = bootstrap_metrics(class_matches, gt_columns.sample_tokens, self.cfg,
+                                                           self.bootstrap,
+                                                           seed=self.bootstrap_seed,
+                                                           sample_groups=self.bootstrap_groups,
+                                                           workers=self.workers)
+
+        # Compute evaluation time.
+        metrics.add_runtime(time.time() - start_time)
+
+        return metrics, metric_data_list
+
+    def evaluate_slices(self) -> Dict[str, Tuple[DetectionMetrics, DetectionMetricDataList]]:
+        """
+        Evaluates the slices of the boxes. Each slice has the same metrics of an evaluation of the GTs and predictions
+        filtered by its criteria, but the boxes are loaded once and the distance matrices are shared by all slices.
+        :return: Dict mapping each slice name to a tuple of high-level and the raw metric data of the slice.
+        """
+        start_time = time.time()
+        slices_metric_data = accumulate_slices(self.gt_boxes, self.pred_boxes, self.cfg.class_names, self.cfg.dist_ths,
+                                               slice_masks(self.gt_boxes, self.slices),
+                                               slice_masks(self.pred_boxes, self.slices),
+                                               workers=self.workers, profiler=self.profiler)
+
+        slice_results = {}
+        for (slice_name, criteria), classes_metric_data in zip(self.slices.items(), slices_metric_data):
+            slice_cfg = DetectionConfig.deserialize(self.cfg.serialize())
+            if 'class_names' in criteria:
+                slice_cfg.class_names = [class_name for class_name in slice_cfg.class_names
+                                         if class_name in criteria['class_names']]
+            metric_data_list = DetectionMetricDataList()
+            for class_name in slice_cfg.class_names:
+                for dist_th in slice_cfg.dist_ths:
+                    metric_data_list.set(class_name, dist_th, classes_metric_data[class_name][dist_th])
+            slice_results[slice_name] = (calc_detection_metrics(slice_cfg, metric_data_list), metric_data_list)
+
+        for metrics, _ in slice_results.values():
+            metrics.add_runtime(time.time() - start_time)
+        return slice_results
+
+    def slice_dir(self, slice_name: str) -> str:
+        """
+        Folder where the results of a slice are saved.
+        :param slice_name: Name of the slice.
+        :return: Path of the folder.
+        """
+        return os.path.join(self.output_dir, 'slices', slice_name)
+
+    @property
+    def sample_cache_path(self) -> str:
+        """ Path of the SampleMatchCache used by incremental evaluations. """
+        return os.path.join(self.output_dir, 'sample_match_cache.npz')
+
+    def match_cache_keys(self) -> Dict[str, tuple]:
+        """
+        Keys of the classes in the match cache. The accumulated data of a class only depends on the original classes
+        that were merged into it, on whether it is a barrier (whose orientation is compared up to 180 degrees) and on the
+        distance thresholds.
+        :return: Dict mapping each class to its key.
+        """
+        source_classes = {class_name: set() for class_name in self.cfg.class_names}
+        if self.classes_filter is None:
+            for class_name in self.cfg.class_names:
+                source_classes[class_name].add(class_name)
+        else:
+            # As in the filter functions, an old class listed more than once goes to the last new class.
+            old_classes_to_new_classes_map: dict[str, str] = {}
+            for new_class, old_classes_list in self.classes_filter.items():
+                for old_class in old_classes_list:
+                    old_classes_to_new_classes_map[old_class] = new_class
+            for old_class, new_class in old_classes_to_new_classes_map.items():
+                source_classes[new_class].add(old_class)
+
+        return {class_name: (tuple(sorted(source_classes[class_name])), class_name == 'barrier',
+                             tuple(self.cfg.dist_ths))
+                for class_name in self.cfg.class_names}
+
+    def calc_metrics(self, metric_data_list: DetectionMetricDataList) -> DetectionMetrics:
+        """
+        Calculates the AP and TP metrics from the accumulated metric data, as the devkit evaluate.
+        :param metric_data_list: DetectionMetricDataList with the data of every class and distance threshold.
+        :return: DetectionMetrics with the metrics (without runtime).
+        """
+        return calc_detection_metrics(self.cfg, metric_data_list, profiler=self.profiler)
+
     def render(self, metrics: DetectionMetrics, md_list: DetectionMetricDataList) -> None:
         """
-        Renders various PR and TP curves.
+        Renders various PR and TP curves. The plots are rendered in parallel when more than one worker is used.
         :param metrics: DetectionMetrics instance.
         :param md_list: DetectionMetricDataList instance.
         """
+        from functions.render import render_metrics
+
         if self.verbose:
             print('Rendering PR and TP curves')
 
-        def savepath(name):
-            return os.path.join(self.plot_dir, name + '.pdf')
-        
-        detection_names = self.cfg.class_names
-        pretty_detection_names = {}
-        detection_colors = {}
-        for i, detection_name in enumerate(detection_names):
-            detection_colors[detection_name] = f'C{i}'
-            pretty_detection_names[detection_name] = detection_name.replace('_', ' ').capitalize()
-
-        summary_plot(md_list, metrics, min_precision=self.cfg.min_precision, min_recall=self.cfg.min_recall,
-                     dist_th_tp=self.cfg.dist_th_tp, savepath=savepath('summary'), detection_names=detection_names, pretty_detection_names=pretty_detection_names)
-
-        for detection_name in detection_names:
-            class_pr_curve(md_list, metrics, detection_name, self.cfg.min_precision, self.cfg.min_recall,
-                           savepath=savepath(detection_name + '_pr'), pretty_detection_names=pretty_detection_names)
-
-            class_tp_curve(md_list, metrics, detection_name, self.cfg.min_recall, self.cfg.dist_th_tp,
-                           savepath=savepath(detection_name + '_tp'), pretty_detection_names=pretty_detection_names)
-
-        for dist_th in self.cfg.dist_ths:
-            dist_pr_curve(md_list, metrics, dist_th, self.cfg.min_precision, self.cfg.min_recall,
-                          savepath=savepath('dist_pr_' + str(dist_th)), pretty_detection_names=pretty_detection_names, detection_colors=detection_colors)
\ No newline at end of file
+        # The plots of the slices are rendered with the same processes.
+        evaluations = [(md_list, metrics, self.plot_dir)]
+        for slice_name, (slice_metrics, slice_md_list) in self.slice_results.items():
+            plot_dir = os.path.join(self.slice_dir(slice_name), 'plots')
+            os.makedirs(plot_dir, exist_ok=True)
+            evaluations.append((slice_md_list, slice_metrics, plot_dir))
+        with self.profiler.stage('render'):
+            render_metrics(evaluations, workers=self.workers)
+
+    def main(self, plot_examples: int = 0, render_curves: bool = True) -> Dict[str, Any]:
+        """
+        Runs the evaluation, renders the curves and saves and prints the metrics, as the devkit main. The metrics of
+        the slices are saved to their folders, and the bootstrap confidence intervals to `metrics_bootstrap.json` and,
+        when profiling, the recorded stages to `timings.json` in output_dir.
+        :param plot_examples: How many example visualizations to write to disk. They need the NuScenes database, so
+            they are not supported.
+        :param render_curves: Whether to render PR and TP curves to disk.
+        :return: A dict that stores the high-level metrics and meta data.
+        """
+        assert plot_examples == 0, 'Error: Example visualizations are not supported, since they need the NuScenes database.'
+
+        # Run evaluation.
+        metrics, metric_data_list = self.evaluate()
+
+        # Render PR and TP curves.
+        if render_curves:
+            self.render(metrics, metric_data_list)
+
+        # Dump the metric data, meta and metrics to disk.
+        with self.profiler.stage('save_metrics'):
+            if self.verbose:
+                print('Saving metrics to: %s' % self.output_dir)
+            metrics_summary = metrics.serialize()
+            metrics_summary['meta'] = self.meta.copy()
+            with open(os.path.join(self.output_dir, 'metrics_summary.json'), 'w') as f:
+                json.dump(metrics_summary, f, indent=2)
+            with open(os.path.join(self.output_dir, 'metrics_details.json'), 'w') as f:
+                json.dump(metric_data_list.serialize(), f, indent=2)
+
+            # Print high-level and per-class metrics.
+            print_metrics_summary(metrics_summary)
+
+        if self.slice_results:
+            self.save_slices()
+
+        if self.bootstrap_summary is not None:
+            with open(os.path.join(self.output_dir, 'metrics_bootstrap.json'), 'w') as f:
+                json.dump(self.bootstrap_summary, f, indent=2)
+            if self.verbose:
+                confidence = round(100 * self.bootstrap_summary['confidence'])
+                for name, label in (('mean_ap', 'mAP'), ('nd_score', 'NDS')):
+                    interval = self.bootstrap_summary[name]
+                    print('%s %d%% CI: [%.4f, %.4f]' % (label, confidence, interval['ci_low'], interval['ci_high']))
+
+        self.profiler.save(os.path.join(self.output_dir, 'timings.json'))
+        return metrics_summary
+
+    def save_slices(self) -> None:
+        """
+        Saves the metrics of each slice to its folder (in the same format of the metrics of the evaluation) and prints
+        the high-level metrics of the slices.
+        """
+        for slice_name, (metrics, metric_data_list) in self.slice_results.items():
+            slice_dir = self.slice_dir(slice_name)
+            os.makedirs(slice_dir, exist_ok=True)
+            metrics_summary = metrics.serialize()
+            metrics_summary['meta'] = self.meta.copy()
+            with open(os.path.join(slice_dir, 'metrics_summary.json'), 'w') as f:
+                json.dump(metrics_summary, f, indent=2)
+            with open(os.path.join(slice_dir, 'metrics_details.json'), 'w') as f:
+                json.dump(metric_data_list.serialize(), f, indent=2)
+
+        if self.verbose:
+            print('Saved the metrics of the slices to: %s' % os.path.join(self.output_dir, 'slices'))
+            print()
+            print('Per-slice results:')
+            print('%-20s\t%-6s\t%-6s' % ('Slice', 'mAP', 'NDS'))
+            for slice_name, (metrics, _) in self.slice_results.items():
+                print('%-20s\t%-6.3f\t%-6.3f' % (slice_name, metrics.mean_ap, metrics.nd_score))
@@ -0,0 +1,125 @@
+from typing import List
+
+import numpy as np
+from nuscenes.utils.data_classes import Box
+from pyquaternion import Quaternion
+
+
+class NuScenesSampleTable:
+    """
+    Compact table with the per-sample data of the NuScenes database needed to preprocess boxes as the detection
+    challenge does (see `functions/preprocess_nuscenes_boxes.py`): the ego pose of the LIDAR_TOP sample data of each
+    sample, used to compute the boxes distance to the ego vehicle, and the bicycle racks annotated in each sample.
+    It is built once from a NuScenes object and saved to disk, so the (slow and memory hungry) NuScenes tables do not
+    need to be loaded again.
+    The bicycle racks of the sample i are in the range [rack_offsets[i], rack_offsets[i + 1]). Each rack is stored as
+    the reference corner and the 3 edges used by the devkit `points_in_box`.
+    """
+    def __init__(self,
+                 version: str,
+                 sample_tokens: List[str],
+                 ego_translation: np.ndarray,
+                 rack_offsets: np.ndarray,
+                 rack_corners: np.ndarray,
+                 rack_edges: np.ndarray):
+        """
+        Initialize a NuScenesSampleTable object. Use `from_nuscenes` to build it from the NuScenes database.
+        :param version: NuScenes version, e.g. v1.0-trainval.
+        :param sample_tokens: Sample tokens.
+        :param ego_translation: Array (n_samples, 3) with the ego vehicle translation of each sample.
+        :param rack_offsets: Array (n_samples + 1,) with the first bicycle rack index of each sample.
+        :param rack_corners: Array (n_racks, 3) with the reference corner of each bicycle rack.
+        :param rack_edges: Array (n_racks, 3, 3) with the 3 edges (rows) of each bicycle rack, from the reference corner.
+        """
+        assert len(sample_tokens) + 1 == len(rack_offsets), 'Error: There must be one offset per sample (plus one)!'
+
+        self.version = version
+        self.sample_tokens = sample_tokens
+        self.ego_translation = ego_translation
+        self.rack_offsets = rack_offsets
+        self.rack_corners = rack_corners
+        self.rack_edges = rack_edges
+
+        self._sample_lookup = {sample_token: i for i, sample_token in enumerate(sample_tokens)}
+
+    def __repr__(self):
+        return "NuScenesSampleTable ({}) with {} samples and {} bicycle racks".format(
+            self.version, len(self.sample_tokens), len(self.rack_corners))
+
+    def sample_indices(self, sample_tokens: List[str]) -> np.ndarray:
+        """
+        Returns the indices of some samples in the table.
+        :param sample_tokens: Sample tokens.
+        :return: Array (len(sample_tokens),) with the index of each sample.
+        """
+        missing = [sample_token for sample_token in sample_tokens if sample_token not in self._sample_lookup]
+        assert len(missing) == 0, \
+            f'Error: {len(missing)} samples (e.g. {missing[0] if missing else ""}) are not in NuScenes {self.version}!'
+        return np.array([self._sample_lookup[sample_token] for sample_token in sample_tokens], dtype=np.int64)
+
+    def save(self, path: str) -> None:
+        """
+        Saves the table in a binary (uncompressed .npz) file.
+        :param path: Path of the file.
+        """
+        with open(path, 'wb') as file:
+            np.savez(file,
+                     version=np.array(self.version, dtype=str),
+                     sample_tokens=np.array(self.sample_tokens, dtype=str),
+                     ego_translation=self.ego_translation,
+                     rack_offsets=self.rack_offsets,
+                     rack_corners=self.rack_corners,
+                     rack_edges=self.rack_edges)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a table saved with `save`.
+        :param path: Path of the file.
+        :return: NuScenesSampleTable with the data.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(version=str(data['version']),
+                       sample_tokens=data['sample_tokens'].tolist(),
+                       ego_translation=data['ego_translation'],
+                       rack_offsets=data['rack_offsets'],
+                       rack_corners=data['rack_corners'],
+                       rack_edges=data['rack_edges'])
+
+    @classmethod
+    def from_nuscenes(cls, nusc):
+        """
+        Builds the table from the NuScenes database, as the devkit `add_center_dist` and `filter_eval_boxes` get it.
+        :param nusc: A NuScenes object.
+        :return: NuScenesSampleTable with the data of all samples.
+        """
+        sample_tokens = [sample_rec['token'] for sample_rec in nusc.sample]
+        ego_translation = np.empty((len(sample_tokens), 3), dtype=np.float64)
+        rack_counts = np.zeros(len(sample_tokens), dtype=np.int64)
+        rack_corners = []
+        rack_edges = []
+        for i, sample_rec in enumerate(nusc.sample):
+            sd_record = nusc.get('sample_data', sample_rec['data']['LIDAR_TOP'])
+            pose_record = nusc.get('ego_pose', sd_record['ego_pose_token'])
+            ego_translation[i] = pose_record['translation']
+
+            for ann in sample_rec['anns']:
+                rec = nusc.get('sample_annotation', ann)
+                if rec['category_name'] != 'static_object.bicycle_rack':
+                    continue
+
+                # Same corners used by the devkit `points_in_box`.
+                corners = Box(rec['translation'], rec['size'], Quaternion(rec['rotation'])).corners()
+                p1 = corners[:, 0]
+                rack_corners.append(p1)
+                rack_edges.append(np.stack([corners[:, 4] - p1, corners[:, 1] - p1, corners[:, 3] - p1]))
+                rack_counts[i] += 1
+
+        rack_offsets = np.zeros(len(sample_tokens) + 1, dtype=np.int64)
+        rack_offsets[1:] = np.cumsum(rack_counts)
+        return cls(version=nusc.version,
+                   sample_tokens=sample_tokens,
+                   ego_translation=ego_translation,
+                   rack_offsets=rack_offsets,
+                   rack_corners=np.array(rack_corners, dtype=np.float64).reshape(-1, 3),
+                   rack_edges=np.array(rack_edges, dtype=np.float64).reshape(-1, 3, 3))
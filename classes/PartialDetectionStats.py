@@ -0,0 +1,343 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from nuscenes.eval.detection.constants import TP_METRICS
+from nuscenes.eval.detection.data_classes import DetectionConfig, DetectionMetricData, DetectionMetricDataList, \
+    DetectionMetrics
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from functions.accumulate_columnar import match_columnar, metric_data_from_matches
+from functions.calc_metrics import calc_detection_metrics
+from functions.eval_client import print_metrics_summary
+from functions.filter_eval_boxes import filter_columnar_boxes, load_classes_filter
+from functions.load_gts import load_gts_columnar
+from functions.load_predictions import load_prediction_shard
+from functions.shards import shard_sample_filter
+
+
+class PartialDetectionStats:
+    """
+    Matching results of a shard of the samples (see `functions/shards.py`), which can be merged with the results of
+    the other shards into the exact metrics of the whole evaluation. It allows spreading an evaluation across nodes,
+    exchanging only the (small) files saved by `save`: each node loads and matches only the boxes of its samples
+    (`evaluate_shard`), and the files of all shards are merged (`merge`) to compute the metrics (`main`).
+
+    For each class, it keeps the number of GTs and, for each prediction, its confidence, its TP flag with each distance
+    threshold and a key with its position in the results file, and the TP errors of the matched predictions.
+    Predictions are sorted by descending confidence, with ties broken by the reverse order of the boxes in the results
+    file, as the devkit does. Since the samples are matched independently, the merged shards have the same metrics of
+    GenericDetectionEval, as long as every shard evaluates the same results file.
+    """
+    format_version = 1
+
+    def __init__(self,
+                 config: DetectionConfig,
+                 classes: Dict[str, Dict[str, Any]],
+                 sample_tokens: List[str],
+                 meta: dict,
+                 eval_time: float = 0.0,
+                 shards: dict = None):
+        """
+        Initialize a PartialDetectionStats object. Use `evaluate_shard` to evaluate a shard, or `load` to load it from
+        a file.
+        :param config: A DetectionConfig object, with the evaluated classes.
+        :param classes: Dict mapping each class to its matching results:
+            - npos: Number of GT boxes of the class.
+            - confs: Array (n_preds,) with the confidences of the predictions of the class, sorted in descending order.
+            - keys: Array (n_preds,) with the position of each prediction in the results file, in the same order.
+            - is_tp: Boolean array (n_dist_ths, n_preds) with the predictions matched with each distance threshold.
+            - tp_errors: List with, for each distance threshold, an array (n_tps, n_tp_metrics) with the errors of the
+              matched predictions (in the same order), in TP_METRICS order.
+        :param sample_tokens: Tokens of the evaluated samples.
+        :param meta: Meta data of the predictions.
+        :param eval_time: Time spent matching the boxes (of all shards).
+        :param shards: When the samples are split by hash, a dict with the number of shards (`num_shards`) and the
+            indices of the evaluated shards (`indices`). None if the samples are split by explicit lists.
+        """
+        self.cfg = config
+        self.classes = classes
+        self.sample_tokens = sample_tokens
+        self.meta = meta
+        self.eval_time = eval_time
+        self.shards = shards
+
+    def __repr__(self):
+        return "PartialDetectionStats of {} samples".format(len(self.sample_tokens))
+
+    @classmethod
+    def evaluate_shard(cls,
+                       config: DetectionConfig,
+                       result_path: str,
+                       gts_path: str,
+                       shard_index: int = None,
+                       num_shards: int = None,
+                       samples_path: str = None,
+                       filter_path: str = None,
+                       verbose: bool = True,
+                       gts_cache: bool = True):
+        """
+        Loads and matches the boxes of a shard of the samples. Only the GTs and predictions of the shard are kept in
+        memory.
+        :param config: A DetectionConfig object.
+        :param result_path: Path of the nuScenes JSON result file, with the predictions of all samples (or at least of
+            the samples of the shard).
+        :param gts_path: Path of the GTs JSON file.
+        :param shard_index: Index of the shard, when the samples are split by hash (see `sample_shard`).
+        :param num_shards: Number of shards, when the samples are split by hash.
+        :param samples_path: Path of a JSON file with the list of sample tokens of the shard, instead of splitting the
+            samples by hash.
+        :param filter_path: Path to JSON filter file. If not given, it will not use any filters.
+        :param verbose: Whether to print to stdout.
+        :param gts_cache: Whether to load the GTs from the binary cache of the GTs JSON file, if it was already created.
+        :return: The PartialDetectionStats of the shard.
+        """
+        assert config.dist_fcn == 'center_distance', 'Error: Only center_distance is supported by the shards.'
+        sample_filter = shard_sample_filter(shard_index, num_shards, samples_path)
+        classes_filter = load_classes_filter(filter_path) if filter_path else None
+        if classes_filter is not None:
+            config.class_names = list(classes_filter.keys())
+
+        pred_boxes, meta, sample_positions = load_prediction_shard(result_path, config.max_boxes_per_sample,
+                                                                   sample_filter, classes_filter=classes_filter,
+                                                                   verbose=verbose)
+        gt_boxes = load_gts_columnar(gts_path, config.max_boxes_per_sample, verbose=verbose, use_cache=gts_cache,
+                                     sample_filter=sample_filter)
+        if classes_filter is not None:
+            gt_boxes = filter_columnar_boxes(gt_boxes, classes_filter)
+        assert set(pred_boxes.sample_tokens) == set(gt_boxes.sample_tokens), \
+            "Samples in split doesn't match samples in predictions."
+
+        shards = None if samples_path is not None else {'num_shards': num_shards, 'indices': [shard_index]}
+        return cls.from_boxes(config, gt_boxes, pred_boxes, sample_positions, meta, shards=shards)
+
+    @classmethod
+    def from_boxes(cls,
+                   config: DetectionConfig,
+                   gt_boxes: ColumnarBoxes,
+                   pred_boxes: ColumnarBoxes,
+                   sample_positions: np.ndarray,
+                   meta: dict,
+                   shards: dict = None):
+        """
+        Matches the boxes of some samples, as the columnar evaluation.
+        :param config: A DetectionConfig object.
+        :param gt_boxes: GT boxes of the samples (filtered, if a classes filter is used).
+        :param pred_boxes: Predicted boxes of the same samples (filtered, if a classes filter is used).
+        :param sample_positions: Array (n_pred_samples,) with the position of each sample of pred_boxes in the results
+            file (see `load_prediction_shard`).
+        :param meta: Meta data of the predictions.
+        :param shards: The evaluated shards (see `__init__`).
+        :return: The PartialDetectionStats of the samples.
+        """
+        start_time = time.time()
+        dist_ths = config.dist_ths
+
+        # A prediction is identified by the position of its sample in the results file and its position in the sample.
+        box_samples = pred_boxes.sample_index
+        keys = (sample_positions[box_samples] * config.max_boxes_per_sample +
+                np.arange(len(pred_boxes)) - pred_boxes.sample_offsets[box_samples])
+
+        classes = {}
+        for class_name in config.class_names:
+            matches = match_columnar(gt_boxes, pred_boxes, class_name, dist_ths)
+            if matches is None:
+                # Without GTs of the class, the predictions are not matched, but they are FPs of the merged shards.
+                pred_inds = np.flatnonzero(pred_boxes.class_mask(class_name))
+                boxes = pred_inds[np.argsort(pred_boxes.detection_score[pred_inds], kind='stable')[::-1]]
+                classes[class_name] = {'npos': 0,
+                                       'confs': pred_boxes.detection_score[boxes],
+                                       'keys': keys[boxes],
+                                       'is_tp': np.zeros((len(dist_ths), len(boxes)), dtype=bool),
+                                       'tp_errors': [np.empty((0, len(TP_METRICS))) for _ in dist_ths]}
+                continue
+
+            classes[class_name] = {'npos': matches['npos'],
+                                   'confs': matches['confs'],
+                                   'keys': keys[matches['boxes']],
+                                   'is_tp': matches['is_tp'],
+                                   'tp_errors': [np.stack([match_data[metric_name] for metric_name in TP_METRICS],
+                                                          axis=1).reshape(-1, len(TP_METRICS))
+                                                 for match_data in matches['match_data']]}
+
+        return cls(config, classes, list(gt_boxes.sample_tokens), meta, eval_time=time.time() - start_time,
+                   shards=shards)
+
+    @classmethod
+    def merge(cls, stats_list: List['PartialDetectionStats']):
+        """
+        Merges the results of several shards, which must have the same config and disjoint samples. The merged
+        results can also be merged again (e.g. to reduce the shards hierarchically).
+        :param stats_list: PartialDetectionStats of the shards.
+        :return: The merged PartialDetectionStats.
+        """
+        assert len(stats_list) > 0, 'Error: At least one shard must be given!'
+        first = stats_list[0]
+        for stats in stats_list[1:]:
+            assert stats.cfg.serialize() == first.cfg.serialize() and stats.cfg.class_names == first.cfg.class_names, \
+                'Error: The shards must be evaluated with the same config and classes filter!'
+        sample_tokens = [sample_token for stats in stats_list for sample_token in stats.sample_tokens]
+        assert len(set(sample_tokens)) == len(sample_tokens), 'Error: The same sample was evaluated by two shards!'
+
+        shards = None
+        if all(stats.shards is not None and stats.shards['num_shards'] == first.shards['num_shards']
+               for stats in stats_list):
+            indices = [index for stats in stats_list for index in stats.shards['indices']]
+            shards = {'num_shards': first.shards['num_shards'], 'indices': sorted(indices)}
+
+        classes = {}
+        for class_name in first.cfg.class_names:
+            parts = [stats.classes[class_name] for stats in stats_list]
+            confs = np.concatenate([part['confs'] for part in parts])
+            keys = np.concatenate([part['keys'] for part in parts])
+            is_tp = np.concatenate([part['is_tp'] for part in parts], axis=1)
+
+            # Sort by confidence, as if all predictions were matched at once. Like the devkit, ties are broken by the
+            # reverse order of the boxes in the results file.
+            order = np.lexsort((keys, confs))[::-1]
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = np.arange(len(order))
+            tp_errors = []
+            for th_ind in range(len(first.cfg.dist_ths)):
+                # The errors of each shard follow the order of its TPs, so they follow the merged TPs before sorting.
+                errors = np.concatenate([part['tp_errors'][th_ind] for part in parts])
+                tp_errors.append(errors[np.argsort(ranks[np.flatnonzero(is_tp[th_ind])])])
+
+            classes[class_name] = {'npos': sum(part['npos'] for part in parts),
+                                   'confs': confs[order],
+                                   'keys': keys[order],
+                                   'is_tp': is_tp[:, order],
+                                   'tp_errors': tp_errors}
+
+        return cls(first.cfg, classes, sample_tokens, first.meta,
+                   eval_time=sum(stats.eval_time for stats in stats_list), shards=shards)
+
+    def metric_data_list(self) -> DetectionMetricDataList:
+        """
+        Builds the metric data of the evaluated samples from the matching results.
+        :return: DetectionMetricDataList with the data of every class and distance threshold.
+        """
+        metric_data_list = DetectionMetricDataList()
+        for class_name, class_stats in self.classes.items():
+            for th_ind, dist_th in enumerate(self.cfg.dist_ths):
+                if class_stats['npos'] == 0:
+                    # For missing classes in the GT, return a data structure corresponding to no predictions.
+                    metric_data = DetectionMetricData.no_predictions()
+                else:
+                    tp_errors = class_stats['tp_errors'][th_ind]
+                    match_data = {metric_name: tp_errors[:, i] for i, metric_name in enumerate(TP_METRICS)}
+                    metric_data = metric_data_from_matches(class_stats['is_tp'][th_ind], class_stats['confs'],
+                                                           match_data, class_stats['npos'])
+                metric_data_list.set(class_name, dist_th, metric_data)
+        return metric_data_list
+
+    def evaluate(self) -> Tuple[DetectionMetrics, DetectionMetricDataList]:
+        """
+        Computes the metrics of the evaluated samples.
+        :return: A tuple of high-level and the raw metric data, as GenericDetectionEval.evaluate. Its runtime is the
+            time spent matching the boxes of every shard and computing the metrics.
+        """
+        start_time = time.time()
+        metric_data_list = self.metric_data_list()
+        metrics = calc_detection_metrics(self.cfg, metric_data_list)
+        metrics.add_runtime(self.eval_time + time.time() - start_time)
+        return metrics, metric_data_list
+
+    def main(self, output_dir: str, render_curves: bool = True, workers: int = 1,
+             verbose: bool = True) -> Dict[str, Any]:
+        """
+        Computes the metrics of the merged shards, renders the curves and saves and prints the metrics, as
+        GenericDetectionEval.main. When the samples are split by hash, every shard must have been merged.
+        :param output_dir: Folder to save plots and results to.
+        :param render_curves: Whether to render PR and TP curves to disk.
+        :param workers: Number of processes used to render the plots in parallel.
+        :param verbose: Whether to print to stdout.
+        :return: A dict that stores the high-level metrics and meta data.
+        """
+        if self.shards is not None:
+            missing = sorted(set(range(self.shards['num_shards'])) - set(self.shards['indices']))
+            assert not missing, f'Error: The shards {missing} of {self.shards["num_shards"]} were not merged!'
+
+        metrics, metric_data_list = self.evaluate()
+
+        if render_curves:
+            from functions.render import render_metrics
+
+            if verbose:
+                print('Rendering PR and TP curves')
+            plot_dir = os.path.join(output_dir, 'plots')
+            os.makedirs(plot_dir, exist_ok=True)
+            render_metrics([(metric_data_list, metrics, plot_dir)], workers=workers)
+
+        if verbose:
+            print('Saving metrics to: %s' % output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        metrics_summary = metrics.serialize()
+        metrics_summary['meta'] = self.meta.copy()
+        with open(os.path.join(output_dir, 'metrics_summary.json'), 'w') as f:
+            json.dump(metrics_summary, f, indent=2)
+        with open(os.path.join(output_dir, 'metrics_details.json'), 'w') as f:
+            json.dump(metric_data_list.serialize(), f, indent=2)
+
+        # Print high-level and per-class metrics.
+        print_metrics_summary(metrics_summary)
+        return metrics_summary
+
+    def save(self, path: str) -> None:
+        """
+        Saves the matching results in a binary (uncompressed .npz) file.
+        :param path: Path of the file.
+        """
+        metadata = {'config': self.cfg.serialize(),
+                    'class_names': list(self.cfg.class_names),
+                    'meta': self.meta,
+                    'eval_time': self.eval_time,
+                    'shards': self.shards}
+        arrays = {}
+        for i, class_stats in enumerate(self.classes.values()):
+            arrays[f'confs_{i}'] = class_stats['confs']
+            arrays[f'keys_{i}'] = class_stats['keys']
+            arrays[f'is_tp_{i}'] = class_stats['is_tp']
+            arrays[f'tp_offsets_{i}'] = np.cumsum([0] + [len(errors) for errors in class_stats['tp_errors']],
+                                                  dtype=np.int64)
+            arrays[f'tp_errors_{i}'] = np.concatenate(class_stats['tp_errors'])
+
+        # Write to a temporary file first, so a reduce never reads a partial file.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file,
+                     format_version=np.array(self.format_version),
+                     metadata=np.array(json.dumps(metadata), dtype=str),
+                     sample_tokens=np.array(self.sample_tokens, dtype=str),
+                     npos=np.array([class_stats['npos'] for class_stats in self.classes.values()], dtype=np.int64),
+                     **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads the matching results saved with `save`.
+        :param path: Path of the file.
+        :return: The PartialDetectionStats.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            assert int(data['format_version']) == cls.format_version, \
+                f'Error: {path} was saved by an incompatible version of the evaluation!'
+            metadata = json.loads(str(data['metadata']))
+            config = DetectionConfig.deserialize(metadata['config'])
+            config.class_names = metadata['class_names']
+
+            classes = {}
+            for i, class_name in enumerate(config.class_names):
+                offsets = data[f'tp_offsets_{i}']
+                tp_errors = data[f'tp_errors_{i}']
+                classes[class_name] = {'npos': int(data['npos'][i]),
+                                       'confs': data[f'confs_{i}'],
+                                       'keys': data[f'keys_{i}'],
+                                       'is_tp': data[f'is_tp_{i}'],
+                                       'tp_errors': [tp_errors[offsets[th_ind]:offsets[th_ind + 1]]
+                                                     for th_ind in range(len(offsets) - 1)]}
+            return cls(config, classes, data['sample_tokens'].tolist(), metadata['meta'],
+                       eval_time=metadata['eval_time'], shards=metadata['shards'])
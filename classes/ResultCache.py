@@ -0,0 +1,143 @@
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+# Files of an evaluation output dir that are stored in the cache (the metrics and the data of the curves).
+CACHED_FILES = ('metrics_summary.json', 'metrics_details.json')
+
+
+class ResultCache:
+    """
+    Content-addressed cache of evaluation results, used by `set_eval.py` to skip predictions that were already
+    evaluated. Each entry stores the metrics JSONs of one evaluation (see CACHED_FILES) and is keyed by the hashes of the
+    predictions file, the GTs file, the filter file and the serialized DetectionConfig, so any change in them gives a
+    new key.
+    The content hash of each file is memoized by its path, size and modification time (in `file_hashes.json`), so
+    unchanged files are not read again. The cache is bounded in size: the least recently used entries are evicted.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Initialize a ResultCache object.
+        :param cache_dir: Directory of the cache. It is created if it does not exist.
+        :param max_bytes: Maximum total size of the cached files. Least recently used entries are evicted beyond it.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._hashes_path = os.path.join(cache_dir, 'file_hashes.json')
+        self._file_hashes = {}
+        if os.path.exists(self._hashes_path):
+            with open(self._hashes_path, 'r') as f:
+                self._file_hashes = json.load(f)
+
+    def __repr__(self):
+        return "ResultCache in {} (up to {} bytes)".format(self.cache_dir, self.max_bytes)
+
+    def file_hash(self, path: Optional[str]) -> Optional[str]:
+        """
+        Returns the content hash of a file, reading it only if it changed since it was last hashed.
+        :param path: Path of the file. If None, None is returned.
+        :return: Hexadecimal SHA-256 digest of the file content.
+        """
+        if path is None:
+            return None
+
+        stat = os.stat(path)
+        abs_path = os.path.abspath(path)
+        memo = self._file_hashes.get(abs_path)
+        if memo is not None and (memo['size'], memo['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return memo['sha256']
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        self._file_hashes[abs_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
+        return sha.hexdigest()
+
+    def key(self, result_path: str, gts_path: str, filter_path: Optional[str], config: dict) -> str:
+        """
+        Returns the key of an evaluation.
+        :param result_path: Path of the predictions JSON file.
+        :param gts_path: Path of the GTs JSON file.
+        :param filter_path: Path of the JSON filter file, or None if no filter is used.
+        :param config: A serialized DetectionConfig.
+        :return: Hexadecimal SHA-256 digest.
+        """
+        content = [self.file_hash(result_path), self.file_hash(gts_path), self.file_hash(filter_path), config]
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key: str, output_dir: str) -> Optional[bool]:
+        """
+        Copies the cached metrics JSONs of a key to an output dir (unless it already has the same files).
+        :param key: Key of the evaluation.
+        :param output_dir: Folder where the metrics of the evaluation are saved.
+        :return: None if the key is not in the cache. Otherwise, whether the files were copied to output_dir.
+        """
+        entry_dir = self._entry_dir(key)
+        if not all(os.path.exists(os.path.join(entry_dir, file_name)) for file_name in CACHED_FILES):
+            return None
+
+        # Mark the entry as recently used.
+        os.utime(entry_dir)
+
+        os.makedirs(output_dir, exist_ok=True)
+        copied = False
+        for file_name in CACHED_FILES:
+            cached_path = os.path.join(entry_dir, file_name)
+            output_path = os.path.join(output_dir, file_name)
+            if os.path.exists(output_path) and filecmp.cmp(cached_path, output_path, shallow=False):
+                continue
+            shutil.copyfile(cached_path, output_path)
+            copied = True
+        return copied
+
+    def put(self, key: str, output_dir: str) -> None:
+        """
+        Stores the metrics JSONs of an evaluation.
+        :param key: Key of the evaluation.
+        :param output_dir: Folder where the metrics of the evaluation were saved.
+        """
+        # Copy to a temporary dir first, so an interrupted copy never leaves a partial entry.
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for file_name in CACHED_FILES:
+            shutil.copyfile(os.path.join(output_dir, file_name), os.path.join(tmp_dir, file_name))
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.replace(tmp_dir, entry_dir)
+
+    def save(self) -> None:
+        """
+        Evicts the least recently used entries beyond the maximum size and saves the memoized file hashes.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry_dir) or name.endswith('.tmp'):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir)
+            total_size -= size
+
+        # Forget the hashes of files that no longer exist.
+        self._file_hashes = {path: memo for path, memo in self._file_hashes.items() if os.path.exists(path)}
+        tmp_path = f'{self._hashes_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._file_hashes, f, indent=2)
+        os.replace(tmp_path, self._hashes_path)
+
@@ -0,0 +1,158 @@
+import copy
+import os
+from typing import Dict, Optional, Set, Tuple
+
+import numpy as np
+
+# Matching results of the predictions and GTs of one class in one sample:
+# - cols: Array (n_dist_ths, n_preds) with the matched GT (index among the sample GTs of the class) of each prediction
+#   (sorted by descending confidence) with each distance threshold, or -1 if it is not a match.
+# - pair_local: Array (n_pairs,) with the prediction (index in the same order) of each distinct matched pair.
+# - pair_col: Array (n_pairs,) with the GT (index among the sample GTs of the class) of each distinct matched pair.
+# - pair_errors: Array (n_pairs, n_tp_metrics) with the TP errors of each distinct matched pair, in TP_METRICS order.
+SampleMatches = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class SampleMatchCache:
+    """
+    Cache of the matching results of each class in each sample (see `accumulate_columnar`), used for incremental
+    evaluations: when the same predictions are evaluated again after some samples changed, only the changed samples
+    are matched again, and the metrics are recomputed from the merged results of all samples.
+    The entries are keyed by a content hash of the sample boxes of the class and of the config fields used to match them
+    (see `sample_match_key`), so a changed sample simply gets a new key. Only the entries used by the last evaluation are
+    saved, so the entries of changed samples are dropped.
+    """
+    format_version = 1
+
+    def __init__(self, stored: Dict[str, np.ndarray] = None):
+        """
+        Initialize a SampleMatchCache object. Use `load` to load it from a file.
+        :param stored: Arrays of the entries saved by `save`. If not given, the cache starts empty.
+        """
+        self._stored = stored
+        self._stored_index = {} if stored is None else {key: i for i, key in enumerate(stored['keys'].tolist())}
+        self._new: Dict[str, SampleMatches] = {}
+        self._used: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._stored_index) + len(self._new)
+
+    def __repr__(self):
+        return "SampleMatchCache with {} entries ({} hits and {} misses)".format(len(self), self.hits, self.misses)
+
+    def get(self, key: str) -> Optional[SampleMatches]:
+        """
+        Returns the matching results of a key, counting the hit or miss.
+        :param key: Key of the class in the sample.
+        :return: The cached SampleMatches, or None if the key is not in the cache.
+        """
+        if key not in self._new and key not in self._stored_index:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if key not in self._new:
+            self._used.add(key)
+        return self._entry(key)
+
+    def _entry(self, key: str) -> SampleMatches:
+        """
+        Returns the matching results of a key in the cache.
+        :param key: Key of the class in the sample.
+        :return: The SampleMatches.
+        """
+        if key in self._new:
+            return self._new[key]
+
+        i = self._stored_index[key]
+        local_start, local_end = self._stored['local_offsets'][i:i + 2]
+        pair_start, pair_end = self._stored['pair_offsets'][i:i + 2]
+        return (self._stored['cols'][:, local_start:local_end],
+                self._stored['pair_local'][pair_start:pair_end],
+                self._stored['pair_col'][pair_start:pair_end],
+                self._stored['pair_errors'][pair_start:pair_end])
+
+    def put(self, key: str, matches: SampleMatches) -> None:
+        """
+        Adds the matching results of a key.
+        :param key: Key of the class in the sample.
+        :param matches: The SampleMatches.
+        """
+        self._new[key] = matches
+
+    def view(self):
+        """
+        Returns a cache with the same stored entries but without changes, e.g. to collect the changes made by one task
+        of a forked process with `updates`.
+        :return: The new SampleMatchCache.
+        """
+        cache = copy.copy(self)
+        cache._new = {}
+        cache._used = set()
+        cache.hits = 0
+        cache.misses = 0
+        return cache
+
+    def updates(self) -> Tuple[Dict[str, SampleMatches], Set[str], int, int]:
+        """
+        Returns the changes made since the cache was loaded (or created by `view`), so a forked process can send them to `merge_updates`.
+        :return: Tuple with the new entries, the keys of the stored entries used, the hits and the misses.
+        """
+        return self._new, self._used, self.hits, self.misses
+
+    def merge_updates(self, updates: Tuple[Dict[str, SampleMatches], Set[str], int, int]) -> None:
+        """
+        Merges the changes made by a copy of the cache (e.g. in a forked process).
+        :param updates: Changes returned by `updates`.
+        """
+        new, used, hits, misses = updates
+        self._new.update(new)
+        self._used |= used
+        self.hits += hits
+        self.misses += misses
+
+    def save(self, path: str) -> None:
+        """
+        Saves the entries used or added since the cache was loaded in a binary (uncompressed .npz) file.
+        :param path: Path of the file.
+        """
+        keys = sorted(self._used - self._new.keys()) + list(self._new.keys())
+        entries = [self._entry(key) for key in keys]
+        if len(entries) == 0:
+            entries = [(np.empty((0, 0), dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                        np.empty((0, 0), dtype=np.float64))]
+            keys_array = np.empty(0, dtype=str)
+        else:
+            keys_array = np.array(keys, dtype=str)
+        cols, pair_local, pair_col, pair_errors = zip(*entries)
+
+        # Write to a temporary file first, so a concurrent evaluation never reads a partial cache.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file,
+                     format_version=np.array(self.format_version),
+                     keys=keys_array,
+                     local_offsets=np.cumsum([0] + [c.shape[1] for c in cols], dtype=np.int64),
+                     pair_offsets=np.cumsum([0] + [len(p) for p in pair_local], dtype=np.int64),
+                     cols=np.concatenate(cols, axis=1),
+                     pair_local=np.concatenate(pair_local),
+                     pair_col=np.concatenate(pair_col),
+                     pair_errors=np.concatenate(pair_errors))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a cache saved with `save`. A missing file (or one saved by an incompatible version) gives an empty cache.
+        :param path: Path of the file.
+        :return: The SampleMatchCache.
+        """
+        if not os.path.exists(path):
+            return cls()
+
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['format_version']) != cls.format_version:
+                return cls()
+            return cls({name: data[name] for name in data.files})
@@ -0,0 +1,183 @@
+import contextlib
+import json
+import os
+import resource
+import time
+from typing import Dict, List, Optional
+
+
+def cpu_time() -> float:
+    """
+    CPU time (user and system) used by the current process and by its finished child processes, e.g. the workers of a
+    multiprocessing pool that was closed.
+    :return: CPU time in seconds.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _proc_status_mb(field: str) -> Optional[float]:
+    """
+    Reads a memory field of the current process from `/proc/self/status` (Linux only).
+    :param field: Name of the field, e.g. `VmRSS` or `VmHWM`.
+    :return: Value in MB, or None if it is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    # The values are given in kB.
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak RSS (high-water mark) of the current process to its current RSS, so the peak of a stage can be
+    measured on its own (Linux only).
+    :return: Whether the peak was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def current_rss_mb() -> Optional[float]:
+    """
+    Resident set size of the current process.
+    :return: RSS in MB, or None if it is not available.
+    """
+    return _proc_status_mb('VmRSS')
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of the current process (since the last `reset_peak_rss`, where it is supported).
+    :return: Peak RSS in MB.
+    """
+    peak = _proc_status_mb('VmHWM')
+    if peak is None:
+        # ru_maxrss is given in KB on Linux, and it is never reset.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+
+def children_peak_rss_mb() -> float:
+    """
+    Peak resident set size of the largest finished child process (e.g. the workers of a closed multiprocessing pool).
+    :return: Peak RSS in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time and memory of each stage of an evaluation (e.g. loading the predictions or
+    accumulating the metric data), and the wall and CPU times of each class in the stages computed per class.
+    Repeated stages are summed. When disabled, nothing is recorded, so the stages can always be wrapped.
+
+    The memory of a stage is its RSS at the start (`rss_start_mb`) and its peak RSS (`peak_rss_mb`): the high-water
+    mark of the process is reset at the start of each stage (on Linux), so the peak is the one reached during the stage,
+    or by a child process that finished during it. Where the high-water mark can not be reset, `peak_rss_mb` is not
+    recorded, but the peak of the process so far is (`max_rss_so_far_mb`). Repeated stages keep the largest peak.
+    """
+    def __init__(self, enabled: bool = True):
+        """
+        Initialize a StageProfiler object.
+        :param enabled: Whether to record the stages.
+        """
+        self.enabled = enabled
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.classes: Dict[str, Dict[str, Dict[str, float]]] = {}
+        self._open_peaks: List[List[float]] = []  # Peak RSS so far of each running (nested) stage.
+
+    def __repr__(self):
+        return "StageProfiler with {} stages and {} classes".format(len(self.stages), len(self.classes))
+
+    @contextlib.contextmanager
+    def stage(self, name: str, class_name: str = None):
+        """
+        Context manager that records the code inside it as a stage (or as the stage of a class).
+        :param name: Name of the stage.
+        :param class_name: Class of the stage, if it is computed per class.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        if class_name is not None:
+            # The memory is only recorded for the whole stages.
+            start_wall, start_cpu = time.perf_counter(), cpu_time()
+            try:
+                yield
+            finally:
+                self.add(name, time.perf_counter() - start_wall, cpu_time() - start_cpu, class_name=class_name)
+            return
+
+        rss_start = current_rss_mb()
+        # The enclosing stages keep the peak reached so far before it is reset.
+        peak = peak_rss_mb()
+        for open_peak in self._open_peaks:
+            open_peak[0] = max(open_peak[0], peak)
+        peak_reset = reset_peak_rss()
+        children_peak = children_peak_rss_mb()
+        stage_peak = [peak_rss_mb() if peak_reset else 0.0]
+        self._open_peaks.append(stage_peak)
+
+        start_wall, start_cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            wall_time, cpu_time_ = time.perf_counter() - start_wall, cpu_time() - start_cpu
+            self._open_peaks.pop()
+            peak = peak_rss_mb()
+            for open_peak in self._open_peaks:
+                open_peak[0] = max(open_peak[0], peak)
+            self.add(name, wall_time, cpu_time_)
+
+            record = self.stages[name]
+            if rss_start is not None:
+                record.setdefault('rss_start_mb', rss_start)
+            if peak_reset:
+                stage_peak = max(stage_peak[0], peak)
+                if children_peak_rss_mb() > children_peak:
+                    # A child process (e.g. a pool worker) that finished during the stage used more memory.
+                    stage_peak = max(stage_peak, children_peak_rss_mb())
+                record['peak_rss_mb'] = max(record.get('peak_rss_mb', 0.0), stage_peak)
+            else:
+                record['max_rss_so_far_mb'] = max(peak, children_peak_rss_mb())
+
+    def add(self, name: str, wall_time: float, cpu_time_: float, class_name: str = None) -> None:
+        """
+        Records a stage measured elsewhere, e.g. in another process.
+        :param name: Name of the stage.
+        :param wall_time: Wall time in seconds.
+        :param cpu_time_: CPU time in seconds.
+        :param class_name: Class of the stage, if it is computed per class.
+        """
+        if not self.enabled:
+            return
+
+        stages = self.stages if class_name is None else self.classes.setdefault(class_name, {})
+        record = stages.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0})
+        record['wall_time'] += wall_time
+        record['cpu_time'] += cpu_time_
+
+    def serialize(self) -> dict:
+        """ Serialize instance into json-friendly format. """
+        return {'stages': self.stages, 'classes': self.classes}
+
+    def save(self, path: str) -> None:
+        """
+        Saves the recorded stages to a JSON file (if enabled).
+        :param path: Path of the JSON file.
+        """
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.serialize(), f, indent=2)
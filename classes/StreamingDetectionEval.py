@@ -0,0 +1,257 @@
+import json
+import os
+import time
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+from nuscenes.eval.detection.constants import TP_METRICS
+from nuscenes.eval.detection.data_classes import DetectionConfig, DetectionMetricData, DetectionMetricDataList, \
+    DetectionMetrics
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.ColumnarBoxesBuilder import ColumnarBoxesBuilder
+from classes.GenericDetectionEval import GenericDetectionEval
+from functions.accumulate_columnar import greedy_match_candidates, match_candidates, match_errors, metric_data_from_matches
+from functions.calc_metrics import calc_detection_metrics
+from functions.filter_eval_boxes import load_classes_filter
+
+
+class StreamingDetectionEval:
+    """
+    Online version of GenericDetectionEval: the predictions are added one sample at a time (e.g. by an inference loop),
+    and the metrics of the samples added so far can be computed at any time.
+
+    Each sample is matched against its GTs as soon as it is added, as the columnar evaluation does (samples are matched
+    independently), and only the matching results are kept for each class: the confidences and TP flags of the
+    predictions and the TP errors of the matched pairs. `current_metrics` sorts these results by confidence and builds
+    the curves and metrics from them, without matching any box again. Once every sample is added, the metrics are the
+    same of GenericDetectionEval.
+
+    Example:
+        evaluator = StreamingDetectionEval(config_factory('detection_cvpr_2019'), gts_path='gts/detection_trainval_val.json')
+        for sample_token, boxes in inference_loop():
+            evaluator.add_sample(sample_token, boxes)
+            if evaluator.n_samples % 500 == 0:
+                print(evaluator.current_metrics().mean_ap)
+    """
+    def __init__(self,
+                 config: DetectionConfig,
+                 gts_path: str = None,
+                 filter_path: str = None,
+                 gt_boxes: ColumnarBoxes = None,
+                 verbose: bool = True,
+                 gts_cache: bool = True):
+        """
+        Initialize a StreamingDetectionEval object.
+        :param config: A DetectionConfig object.
+        :param gts_path: Path of the GTs JSON file.
+        :param filter_path: Path to JSON filter file. If not given, it will not use any filters.
+        :param gt_boxes: GT boxes already loaded (and filtered, if filter_path is given), e.g. with
+            `GenericDetectionEval.load_filtered_gts`. If given, gts_path is not used.
+        :param verbose: Whether to print to stdout.
+        :param gts_cache: Whether to load the GTs from a binary cache of the GTs JSON file (created in the first run).
+        """
+        assert gts_path is not None or gt_boxes is not None, 'Error: The GTs path or the GT boxes must be given!'
+        assert config.dist_fcn == 'center_distance', \
+            'Error: Only center_distance is supported by the streaming evaluation.'
+        self.cfg = config
+        self.verbose = verbose
+        self.eval_time = 0.0
+
+        classes_filter = load_classes_filter(filter_path) if filter_path else None
+        if classes_filter is not None:
+            self.cfg.class_names = list(classes_filter.keys())
+        self.classes_filter = classes_filter
+
+        if gt_boxes is None:
+            gt_boxes = GenericDetectionEval.load_filtered_gts(gts_path, self.cfg, classes_filter=classes_filter,
+                                                              verbose=verbose, gts_cache=gts_cache)
+        self.gt_boxes = gt_boxes
+        self._gt_samples = {sample_token: i for i, sample_token in enumerate(gt_boxes.sample_tokens)}
+        self._gt_class_codes = {class_name: gt_boxes.class_names.index(class_name)
+                                for class_name in self.cfg.class_names if class_name in gt_boxes.class_names}
+        self.sample_tokens: List[str] = []
+        self._added_samples = set()
+
+        # Matching results of each class, in the order the predictions were added. The arrays of each sample are
+        # appended to lists, which are concatenated when the metrics are computed.
+        n_ths = len(self.cfg.dist_ths)
+        self._classes = {class_name: {'npos': 0,
+                                      'n_preds': 0,
+                                      'confs': [],
+                                      'is_tp': [],
+                                      'tp_positions': [[] for _ in range(n_ths)],
+                                      'tp_errors': [[] for _ in range(n_ths)]}
+                         for class_name in self.cfg.class_names}
+
+    def __repr__(self):
+        return "StreamingDetectionEval with {} of {} samples added".format(self.n_samples,
+                                                                          len(self.gt_boxes.sample_tokens))
+
+    @property
+    def n_samples(self) -> int:
+        """ Returns the number of samples added so far. """
+        return len(self.sample_tokens)
+
+    @property
+    def missing_samples(self) -> List[str]:
+        """ Returns the tokens of the GT samples that were not added yet. """
+        return [sample_token for sample_token in self.gt_boxes.sample_tokens if sample_token not in self._added_samples]
+
+    def add_sample(self, sample_token: str, boxes: List[dict]) -> None:
+        """
+        Adds the predictions of a sample and matches them with the GTs of the sample.
+        :param sample_token: Token of the sample, which must be in the GTs. Each sample can only be added once.
+        :param boxes: Predicted boxes of the sample, serialized as in the `results` of the nuScenes JSON result file.
+        """
+        start_time = time.time()
+        assert sample_token in self._gt_samples, f'Error: The sample {sample_token} is not in the GTs!'
+        assert sample_token not in self._added_samples, f'Error: The sample {sample_token} was already added!'
+        assert len(boxes) <= self.cfg.max_boxes_per_sample, \
+            "Error: Only <= %d boxes per sample allowed!" % self.cfg.max_boxes_per_sample
+
+        # The boxes are validated and converted (and filtered) as when loading a result file.
+        builder = ColumnarBoxesBuilder(self.classes_filter)
+        builder.add_sample(sample_token, boxes)
+        pred_boxes = builder.build()
+        self.sample_tokens.append(sample_token)
+        self._added_samples.add(sample_token)
+
+        gt_sample = self._gt_samples[sample_token]
+        start, end = self.gt_boxes.sample_offsets[gt_sample], self.gt_boxes.sample_offsets[gt_sample + 1]
+        gt_codes = self.gt_boxes.class_codes[start:end]
+        for class_name, accumulator in self._classes.items():
+            gt_inds = start + np.flatnonzero(gt_codes == self._gt_class_codes.get(class_name, -2))
+            self._add_class_sample(accumulator, class_name, gt_inds, pred_boxes)
+
+        self.eval_time += time.time() - start_time
+
+    def _add_class_sample(self, accumulator: dict, class_name: str, gt_inds: np.ndarray,
+                          pred_boxes: ColumnarBoxes) -> None:
+        """
+        Matches the predictions and GTs of a class in a sample, as `match_columnar`, and adds the results to the
+        accumulator of the class.
+        :param accumulator: Accumulated matching results of the class.
+        :param class_name: Class to match.
+        :param gt_inds: Indices of the GT boxes of the class in the sample.
+        :param pred_boxes: Predicted boxes of the sample.
+        """
+        accumulator['npos'] += len(gt_inds)
+        pred_inds = np.flatnonzero(pred_boxes.class_mask(class_name))
+        if len(pred_inds) == 0:
+            return
+
+        # The predictions are kept in the order they were given; they are only sorted to be matched.
+        dist_ths = self.cfg.dist_ths
+        matched_cols = np.full((len(dist_ths), len(pred_inds)), -1, dtype=np.int64)
+        if len(gt_inds) > 0:
+            # Like the devkit, ties are broken by the reverse order of the boxes.
+            order = np.argsort(pred_boxes.detection_score[pred_inds], kind='stable')[::-1]
+            candidates = match_candidates(pred_boxes.translation[pred_inds[order], :2],
+                                          self.gt_boxes.translation[gt_inds, :2], dist_ths)
+            for th_ind, dist_th in enumerate(dist_ths):
+                matched_cols[th_ind, order] = greedy_match_candidates(candidates, dist_th)
+        is_tp = matched_cols >= 0
+
+        # The errors of each distinct pair are computed once, as most pairs are matched with more than one threshold.
+        th_inds, positions = np.nonzero(is_tp)
+        pairs, pair_inverse = np.unique(positions * len(gt_inds) + matched_cols[is_tp], return_inverse=True)
+        pair_inverse = pair_inverse.reshape(-1)
+        if len(pairs) > 0:
+            pair_errors = match_errors(self.gt_boxes, gt_inds[pairs % len(gt_inds)],
+                                       pred_boxes, pred_inds[pairs // len(gt_inds)], class_name)
+            errors = np.stack([pair_errors[metric_name] for metric_name in TP_METRICS], axis=1)
+        for th_ind in range(len(dist_ths)):
+            th_mask = th_inds == th_ind
+            if np.any(th_mask):
+                accumulator['tp_positions'][th_ind].append(accumulator['n_preds'] + positions[th_mask])
+                accumulator['tp_errors'][th_ind].append(errors[pair_inverse[th_mask]])
+
+        accumulator['confs'].append(pred_boxes.detection_score[pred_inds])
+        accumulator['is_tp'].append(is_tp)
+        accumulator['n_preds'] += len(pred_inds)
+
+    @staticmethod
+    def _consolidate(chunks: list, empty: np.ndarray, axis: int = 0) -> np.ndarray:
+        """
+        Concatenates the arrays appended to a list, keeping only the concatenated array in it, so the next calls only
+        concatenate the arrays appended since then.
+        :param chunks: List of arrays.
+        :param empty: Empty array returned (with the right shape and type) if the list is empty.
+        :param axis: Axis along which the arrays are concatenated.
+        :return: The concatenated array.
+        """
+        if not chunks:
+            return empty
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks, axis=axis)]
+        return chunks[0]
+
+    def current_metric_data(self) -> DetectionMetricDataList:
+        """
+        Builds the metric data of the samples added so far from the accumulated matching results.
+        :return: DetectionMetricDataList with the data of every class and distance threshold.
+        """
+        dist_ths = self.cfg.dist_ths
+        metric_data_list = DetectionMetricDataList()
+        for class_name, accumulator in self._classes.items():
+            confs = self._consolidate(accumulator['confs'], np.empty(0))
+            if accumulator['npos'] == 0 or len(confs) == 0:
+                # For missing classes in the GT (or without predictions), return no predictions.
+                for dist_th in dist_ths:
+                    metric_data_list.set(class_name, dist_th, DetectionMetricData.no_predictions())
+                continue
+            is_tp = self._consolidate(accumulator['is_tp'], np.empty((len(dist_ths), 0), dtype=bool),
+                                       axis=1)
+
+            # Sort by confidence as if all predictions were given at once. Like the devkit, ties are broken by the
+            # reverse order of the boxes.
+            order = np.argsort(confs, kind='stable')[::-1]
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = np.arange(len(order))
+            for th_ind, dist_th in enumerate(dist_ths):
+                tp_positions = self._consolidate(accumulator['tp_positions'][th_ind], np.empty(0, dtype=np.int64))
+                tp_errors = self._consolidate(accumulator['tp_errors'][th_ind], np.empty((0, len(TP_METRICS))))
+                by_rank = np.argsort(ranks[tp_positions])
+                match_data = {metric_name: tp_errors[by_rank, i] for i, metric_name in enumerate(TP_METRICS)}
+                metric_data_list.set(class_name, dist_th, metric_data_from_matches(is_tp[th_ind][order], confs[order],
+                                                                                   match_data, accumulator['npos']))
+        return metric_data_list
+
+    def current_metrics(self) -> DetectionMetrics:
+        """
+        Computes the metrics of the samples added so far. It can be called at any time, e.g. after each batch of an
+        inference loop; once every sample is added, the metrics are the same of GenericDetectionEval.
+        :return: DetectionMetrics with the metrics. Its runtime is the time spent adding samples and computing metrics.
+        """
+        return self.current_results()[0]
+
+    def current_results(self) -> Tuple[DetectionMetrics, DetectionMetricDataList]:
+        """
+        Computes the metrics and metric data of the samples added so far (see `current_metrics`).
+        :return: A tuple of high-level and the raw metric data, as GenericDetectionEval.evaluate.
+        """
+        start_time = time.time()
+        metric_data_list = self.current_metric_data()
+        metrics = calc_detection_metrics(self.cfg, metric_data_list)
+        self.eval_time += time.time() - start_time
+        metrics.add_runtime(self.eval_time)
+        return metrics, metric_data_list
+
+    def save(self, output_dir: str, meta: dict = None) -> Dict[str, Union[float, dict]]:
+        """
+        Saves the metrics of the samples added so far to `metrics_summary.json` and `metrics_details.json` in output_dir,
+        as the devkit main, so they can be rendered with `render_curves.py`.
+        :param output_dir: Folder to save the metrics to.
+        :param meta: Meta data of the predictions, saved in the metrics summary.
+        :return: A dict that stores the high-level metrics and meta data.
+        """
+        metrics, metric_data_list = self.current_results()
+        os.makedirs(output_dir, exist_ok=True)
+        metrics_summary = metrics.serialize()
+        metrics_summary['meta'] = {} if meta is None else meta.copy()
+        with open(os.path.join(output_dir, 'metrics_summary.json'), 'w') as f:
+            json.dump(metrics_summary, f, indent=2)
+        with open(os.path.join(output_dir, 'metrics_details.json'), 'w') as f:
+            json.dump(metric_data_list.serialize(), f, indent=2)
+        return metrics_summary
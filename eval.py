@@ -1,10 +1,12 @@
 
 import argparse
+import cProfile
 import os
-from nuscenes.eval.common.config import config_factory
 import json
-from nuscenes.eval.detection.data_classes import DetectionConfig
-from classes.GenericDetectionEval import GenericDetectionEval
+import sys
+from functions.eval_client import DEFAULT_SOCKET_PATH, print_metrics_summary, send_request
+from functions.lazy_imports import skip_nuscenes_package_init
+from functions.presets import resolve_gts_preset
 
 
 # Código baseado em: https://github.com/nutonomy/nuscenes-devkit/blob/master/python-sdk/nuscenes/eval/detection/evaluate.py
@@ -28,47 +30,157 @@ if __name__ == "__main__":
                         help='Local onde os resultados serão armazenados (métricas, gráficos, etc.). Caso não seja fornecido, será salvo em `./metrics`.')
     parser.add_argument('--filter_path', type=str, default='',
                         help='Caminho para o JSON com os filtros de classes. Caso não seja fornecido, nenhum filtro será aplicado.')
+    parser.add_argument('--filter_paths', type=str, nargs='+', default=[],
+                        help='Caminhos para vários JSONs de filtros de classes. As GTs e predições são carregadas apenas uma vez e avaliadas com cada filtro, salvando os resultados de cada filtro em uma subpasta de `output_dir` com o nome do arquivo do filtro. Substitui o argumento `--filter_path` e os filtros dos atalhos.')
     parser.add_argument('--config_path', type=str, default='',
                         help='Caminho do arquivo de configuração'
                              'Se não for fornecido, configurações padrões do desafio da NuScenes serão utilizadas.')
-    parser.add_argument('--render_curves', type=int, default=1,
-                        help='Gera ou não gera gráficos de curvas de PR e TP')
+    parser.add_argument('--render_curves', type=str, default='1', choices=['0', '1', 'deferred'],
+                        help='Gera (1) ou não gera (0) gráficos de curvas de PR e TP. Com `deferred`, os gráficos não são gerados durante a avaliação, mas podem ser gerados depois a partir dos JSONs de métricas com o script `render_curves.py`')
     parser.add_argument('--verbose', type=int, default=1,
                         help='Adiciona ou remove prints no terminal')
+    parser.add_argument('--devkit_eval', type=int, default=0,
+                        help='Utiliza a implementação original (mais lenta) da avaliação do devkit da NuScenes, ao invés da implementação vetorizada. Útil para verificar os resultados.')
+    parser.add_argument('--gts_cache', type=int, default=1,
+                        help='Utiliza um cache binário (em uma pasta `.cache` ao lado do JSON das GTs) para carregar as GTs mais rapidamente. O cache é criado na primeira execução e refeito sempre que o JSON for modificado.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Quantidade de processos usados para avaliar as classes em paralelo.')
+    parser.add_argument('--incremental', type=int, default=0,
+                        help='Avaliação incremental: guarda os resultados do pareamento de cada amostra em um cache em `output_dir` (`sample_match_cache.npz`), de forma que, ao avaliar novamente, apenas as amostras cujas caixas mudaram são pareadas de novo.')
+    parser.add_argument('--profile', type=int, default=0, choices=[0, 1, 2],
+                        help='Com 1, registra o tempo (de parede e de CPU) e o pico de memória (RSS) de cada etapa da avaliação (e de cada classe), salvos em `timings.json` ao lado de `metrics_summary.json`. Com 2, também salva um perfil do cProfile (do processo principal) em `profile.pstats`, que pode ser lido com o módulo `pstats`.')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='Quantidade de réplicas de bootstrap (reamostragem das amostras com reposição) usadas para calcular intervalos de confiança de 95%% do mAP, do NDS e do AP e dos erros TP de cada classe, salvos em `metrics_bootstrap.json` ao lado de `metrics_summary.json`. O pareamento das caixas é feito uma única vez e reaproveitado em todas as réplicas. Com 0, os intervalos não são calculados.')
+    parser.add_argument('--bootstrap_seed', type=int, default=0,
+                        help='Semente das réplicas de bootstrap.')
+    parser.add_argument('--bootstrap_groups_path', type=str, default='',
+                        help='JSON opcional que mapeia o token de cada amostra a um grupo (por exemplo, o token da sua cena). Se passado, o bootstrap reamostra os grupos inteiros ao invés das amostras individuais.')
+    parser.add_argument('--slices_path', type=str, default='',
+                        help='JSON opcional com fatias das caixas (por exemplo, faixas de distância ao ego ou atributos) que também são avaliadas. As caixas são carregadas e pareadas uma única vez para todas as fatias, e as métricas de cada uma são salvas em `[output_dir]/slices/[nome da fatia]`.')
+    parser.add_argument('--num_shards', type=int, default=0,
+                        help='Avaliação distribuída: quantidade de shards em que as amostras são divididas (pelo hash do token de cada amostra). Com `--shard_index`, apenas as GTs e predições das amostras do shard são carregadas e pareadas, e os resultados do pareamento são salvos em `[output_dir]/partial_stats_[shard_index]-of-[num_shards].npz`, que podem ser combinados com os dos outros shards pelo script `reduce_shards.py`. Com 0, todas as amostras são avaliadas.')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help='Índice (de 0 a `num_shards` - 1) do shard avaliado.')
+    parser.add_argument('--shard_samples_path', type=str, default='',
+                        help='JSON opcional com a lista de tokens das amostras do shard, ao invés de dividir as amostras pelo hash. Os resultados são salvos em `[output_dir]/partial_stats_[nome do JSON].npz`.')
+    parser.add_argument('--server', type=int, default=1,
+                        help='Se houver um servidor de avaliação rodando (veja `eval_server.py`), envia a avaliação para ele, que já tem as GTs em memória. Caso contrário (ou com 0), a avaliação é feita neste processo. Não é usado com `--devkit_eval`, `--filter_paths`, `--profile 2` ou com os shards.')
+    parser.add_argument('--server_socket', type=str, default=DEFAULT_SOCKET_PATH,
+                        help='Caminho do socket Unix do servidor de avaliação.')
     args = parser.parse_args()
 
     result_path_ = os.path.expanduser(args.result_path)
     output_dir_ = os.path.expanduser(args.output_dir)
     config_path = args.config_path
-    render_curves_ = bool(args.render_curves)
+    render_curves_ = args.render_curves == '1'
+    deferred_render = args.render_curves == 'deferred'
     verbose_ = bool(args.verbose)
+    devkit_eval_ = bool(args.devkit_eval)
+    gts_cache_ = bool(args.gts_cache)
+    workers_ = args.workers
+    incremental_ = bool(args.incremental)
+    profile_ = args.profile
+    bootstrap_ = args.bootstrap
+    bootstrap_seed_ = args.bootstrap_seed
     gts_path_ = args.gts_path
     filter_path_arg = args.filter_path
-    filter_path_ = None  # It will be defined soon
+    filter_paths_ = args.filter_paths
+    sharded = args.num_shards > 0 or args.shard_samples_path != ''
+    if sharded and (devkit_eval_ or filter_paths_ or bootstrap_ or args.slices_path != ''):
+        parser.error('A avaliação distribuída (shards) não é usada com --devkit_eval, --filter_paths, --bootstrap ou --slices_path.')
 
     # Load gts_path
-    if gts_path_ == 'nuscenes_challenge':
-        gts_path_ = 'gts/detection_trainval_val.json'
-    elif gts_path_ == 'nuscenes_vrus-and-cars':
-        gts_path_ = 'gts/detection_trainval_val.json'
-        filter_path_ = 'filters/nuscenes_vrus-and-cars.json'
-    elif gts_path_ == 'nuscenes_vrus':
-        gts_path_ = 'gts/detection_trainval_val.json'
-        filter_path_ = 'filters/nuscenes_vrus.json'
-    elif gts_path_ == 'nuscenes_vrus-and-vehicles':
-        gts_path_ = 'gts/detection_trainval_val.json'
-        filter_path_ = 'filters/nuscenes_vrus-and-vehicles.json'
+    gts_path_, filter_path_ = resolve_gts_preset(gts_path_)
 
     # Overwrite filter_path if passed by argument
     if filter_path_arg != '':
         filter_path_ = filter_path_arg
-    
+
+    # Thin client: the evaluation server (if running) already has the devkit imported and the GTs loaded
+    if args.server and not devkit_eval_ and not filter_paths_ and profile_ != 2 and not sharded:
+        config_ = None
+        if config_path != '':
+            with open(config_path, 'r') as _f:
+                config_ = json.load(_f)
+        request = {
+            'command': 'evaluate',
+            'gts_path': os.path.abspath(gts_path_),
+            'filter_path': os.path.abspath(filter_path_) if filter_path_ else None,
+            'result_path': os.path.abspath(result_path_),
+            'output_dir': os.path.abspath(output_dir_),
+            'config': config_,
+            'render_curves': render_curves_,
+            'workers': workers_,
+            'incremental': incremental_,
+            'profile': bool(profile_),
+            'bootstrap': bootstrap_,
+            'bootstrap_seed': bootstrap_seed_,
+            'bootstrap_groups_path': (os.path.abspath(os.path.expanduser(args.bootstrap_groups_path))
+                                      if args.bootstrap_groups_path != '' else None),
+            'slices_path': os.path.abspath(os.path.expanduser(args.slices_path)) if args.slices_path != '' else None,
+        }
+        try:
+            response = send_request(request, args.server_socket)
+        except ConnectionError:
+            response = None  # No server available: evaluates locally
+        if response is not None:
+            if response['status'] != 'ok':
+                print(f"Error in the evaluation server:\n{response['error']}", file=sys.stderr)
+                sys.exit(1)
+            if verbose_:
+                print(f'Evaluated by the evaluation server at {args.server_socket}')
+            # As the local evaluation (and the devkit), the metrics are always printed
+            print_metrics_summary(response['metrics_summary'])
+            if deferred_render:
+                print(f'Rendering deferred. To render the curves, run: python render_curves.py {output_dir_}')
+            sys.exit(0)
+
+    # Local evaluation (the devkit is only imported here, since the client does not need it)
+    skip_nuscenes_package_init()
+    from nuscenes.eval.common.config import config_factory
+    from nuscenes.eval.detection.data_classes import DetectionConfig
+    from classes.GenericDetectionEval import GenericDetectionEval
+    from functions.slice_boxes import load_slices
+
+    bootstrap_groups_ = None
+    if args.bootstrap_groups_path != '':
+        with open(os.path.expanduser(args.bootstrap_groups_path), 'r') as _f:
+            bootstrap_groups_ = json.load(_f)
+    slices_ = load_slices(os.path.expanduser(args.slices_path)) if args.slices_path != '' else None
+
     if config_path == '':
         cfg_ = config_factory('detection_cvpr_2019')
     else:
         with open(config_path, 'r') as _f:
             cfg_ = DetectionConfig.deserialize(json.load(_f))
 
+    profiler = cProfile.Profile() if profile_ == 2 else None
+    if profiler is not None:
+        profiler.enable()
+
+    if sharded:
+        from classes.PartialDetectionStats import PartialDetectionStats
+
+        shard_samples_path = os.path.expanduser(args.shard_samples_path) if args.shard_samples_path != '' else None
+        partial_stats = PartialDetectionStats.evaluate_shard(cfg_, result_path_, gts_path_, shard_index=args.shard_index, num_shards=args.num_shards, samples_path=shard_samples_path, filter_path=filter_path_, verbose=verbose_, gts_cache=gts_cache_)
+        if shard_samples_path is None:
+            partial_name = f'partial_stats_{args.shard_index}-of-{args.num_shards}.npz'
+        else:
+            partial_name = f'partial_stats_{os.path.splitext(os.path.basename(shard_samples_path))[0]}.npz'
+        os.makedirs(output_dir_, exist_ok=True)
+        partial_stats.save(os.path.join(output_dir_, partial_name))
+        if verbose_:
+            print(f'Saved the partial statistics of {len(partial_stats.sample_tokens)} samples to {os.path.join(output_dir_, partial_name)}')
+    elif filter_paths_:
+        GenericDetectionEval.main_multi_filter(config=cfg_, result_path=result_path_, gts_path=gts_path_, filter_paths=filter_paths_, output_dir=output_dir_, verbose=verbose_, devkit_eval=devkit_eval_, gts_cache=gts_cache_, workers=workers_, render_curves=render_curves_, incremental=incremental_, profile=bool(profile_), bootstrap=bootstrap_, bootstrap_seed=bootstrap_seed_, bootstrap_groups=bootstrap_groups_, slices=slices_)
+    else:
+        nusc_eval = GenericDetectionEval(result_path=result_path_, gts_path=gts_path_, filter_path=filter_path_, config=cfg_, output_dir=output_dir_, verbose=verbose_, devkit_eval=devkit_eval_, gts_cache=gts_cache_, workers=workers_, incremental=incremental_, profile=bool(profile_), bootstrap=bootstrap_, bootstrap_seed=bootstrap_seed_, bootstrap_groups=bootstrap_groups_, slices=slices_)
+        nusc_eval.main(plot_examples=0, render_curves=render_curves_)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_dir_, 'profile.pstats'))
+        print(f"Saved the profile to {os.path.join(output_dir_, 'profile.pstats')}")
 
-    nusc_eval = GenericDetectionEval(result_path=result_path_, gts_path=gts_path_, filter_path=filter_path_, config=cfg_, output_dir=output_dir_, verbose=verbose_)
-    nusc_eval.main(plot_examples=0, render_curves=render_curves_)
\ No newline at end of file
+    if deferred_render and not sharded:
+        print(f'Rendering deferred. To render the curves, run: python render_curves.py {output_dir_}')
@@ -0,0 +1,43 @@
+import argparse
+import os
+
+from classes.EvaluationServer import EvaluationServer
+from functions.eval_client import DEFAULT_SOCKET_PATH
+from functions.presets import GTS_PRESETS, resolve_gts_preset
+
+'''
+Servidor de avaliação: mantém as GTs carregadas (e filtradas) em memória e atende às avaliações pedidas pelo `eval.py`
+(ou por outros clientes, veja `functions/eval_client.py`) por um socket Unix, evitando o tempo de importação do devkit e
+de carregamento das GTs a cada avaliação
+'''
+if __name__ == "__main__":
+
+    # Settings.
+    parser = argparse.ArgumentParser(description='Servidor de avaliação com as GTs em memória.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--socket_path', type=str, default=DEFAULT_SOCKET_PATH,
+                        help='Caminho do socket Unix do servidor. O `eval.py` usa o mesmo caminho por padrão.')
+    parser.add_argument('--presets', type=str, nargs='*', default=list(GTS_PRESETS.keys()),
+                        help='Atalhos (ou caminhos) de GTs carregados ao iniciar o servidor (os que não existem são ignorados). Outras GTs são carregadas na primeira avaliação que as usar e mantidas em memória.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Quantidade máxima de avaliações executadas ao mesmo tempo (cada uma em um processo). As outras ficam em uma fila.')
+    parser.add_argument('--max_gts', type=int, default=2,
+                        help='Quantidade máxima de arquivos de GTs mantidos em memória. Ao passar desse limite, as GTs usadas há mais tempo (e suas versões filtradas) são descartadas, e carregadas novamente se forem pedidas depois.')
+    parser.add_argument('--max_filtered_gts', type=int, default=8,
+                        help='Quantidade máxima de GTs filtradas (cada combinação de GTs e filtro) mantidas em memória, descartando as usadas há mais tempo.')
+    parser.add_argument('--gts_cache', type=int, default=1,
+                        help='Utiliza um cache binário (em uma pasta `.cache` ao lado do JSON das GTs) para carregar as GTs mais rapidamente.')
+    parser.add_argument('--verbose', type=int, default=1,
+                        help='Adiciona ou remove prints no terminal')
+    args = parser.parse_args()
+
+    server = EvaluationServer(args.socket_path, max_jobs=args.jobs, gts_cache=bool(args.gts_cache),
+                              verbose=bool(args.verbose), max_gts=args.max_gts, max_filtered_gts=args.max_filtered_gts)
+    presets = [preset for preset in args.presets if os.path.exists(resolve_gts_preset(preset)[0])]
+    for preset in sorted(set(args.presets) - set(presets)):
+        print(f'Atalho {preset} ignorado: o arquivo de GTs {resolve_gts_preset(preset)[0]} não existe.')
+    server.preload(presets)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
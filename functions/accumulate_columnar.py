@@ -0,0 +1,789 @@
+import hashlib
+import json
+import multiprocessing
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from nuscenes.eval.common.utils import quaternion_yaw
+from nuscenes.eval.detection.constants import TP_METRICS
+from nuscenes.eval.detection.data_classes import DetectionMetricData
+from pyquaternion import Quaternion
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.SampleMatchCache import SampleMatchCache
+from classes.StageProfiler import StageProfiler
+
+# Minimum number of (prediction, GT) pairs of a sample (and class) for which the pairs that can be matched are found
+# with a BEV grid instead of the full distance matrix (see `match_candidates`).
+GRID_MIN_PAIRS = 8192
+
+# Boxes used by the processes of `accumulate_classes`. They are set before the processes are forked, so the
+# processes inherit them instead of receiving a copy of all boxes.
+_shared_boxes = None
+
+
+def devkit_norms(vectors: np.ndarray) -> np.ndarray:
+    """
+    L2 norm of each row, computed one by one as the devkit does (e.g. in `center_distance` and `velocity_l2`).
+    A 1-D `np.linalg.norm` goes through a BLAS dot, which may differ in the last bit from a vectorized norm.
+    :param vectors: Array (n, d).
+    :return: Array (n,) with the norm of each row.
+    """
+    return np.array([np.linalg.norm(vector) for vector in vectors], dtype=np.float64)
+
+
+def center_distances(pred_xy: np.ndarray, gt_xy: np.ndarray, dist_ths: List[float]) -> np.ndarray:
+    """
+    Pairwise L2 distance in the xy plane, with the same values of the devkit `center_distance` wherever the matching
+    depends on them: rows with (almost) tied distances or distances (almost) equal to a threshold are recomputed
+    exactly as the devkit.
+    :param pred_xy: Array (n_preds, 2) with the predictions centers.
+    :param gt_xy: Array (n_gts, 2) with the GTs centers.
+    :param dist_ths: Distance thresholds that will be used to match the boxes.
+    :return: Array (n_preds, n_gts) with the distances.
+    """
+    dists = np.linalg.norm(pred_xy[:, None, :] - gt_xy[None, :, :], axis=-1)
+    if dists.size == 0:
+        return dists
+
+    tol = 1e-12
+    sorted_dists = np.sort(dists, axis=1)
+    close_calls = np.any(np.diff(sorted_dists, axis=1) <= tol * sorted_dists[:, 1:], axis=1)
+    for dist_th in dist_ths:
+        close_calls |= np.any(np.abs(dists - dist_th) <= tol * dist_th, axis=1)
+    for row in np.flatnonzero(close_calls):
+        dists[row] = devkit_norms(pred_xy[row] - gt_xy)
+
+    return dists
+
+
+def grid_candidate_pairs(pred_xy: np.ndarray, gt_xy: np.ndarray, cell_size: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the (prediction, GT) pairs that may be closer than cell_size with a uniform BEV grid of cell_size cells: each
+    prediction is only paired with the GTs of its cell and of the 8 neighbouring cells, so pairs further apart than
+    cell_size are (mostly) pruned without computing their distance.
+    :param pred_xy: Array (n_preds, 2) with the predictions centers. Every coordinate must be finite.
+    :param gt_xy: Array (n_gts, 2) with the GTs centers. Every coordinate must be finite.
+    :param cell_size: Size of the grid cells, at least the largest distance of interest.
+    :return: Arrays (n_pairs,) with the prediction (row) and the GT (column) of each candidate pair, sorted by row and
+        then by column.
+    """
+    pred_cells = np.floor(pred_xy / cell_size).astype(np.int64)
+    gt_cells = np.floor(gt_xy / cell_size).astype(np.int64)
+
+    # Each cell gets an integer key, with a margin of one cell around all boxes for the neighbouring cells.
+    low = np.minimum(pred_cells.min(axis=0), gt_cells.min(axis=0)) - 1
+    height = max(pred_cells[:, 1].max(), gt_cells[:, 1].max()) - low[1] + 2
+    gt_keys = (gt_cells[:, 0] - low[0]) * height + (gt_cells[:, 1] - low[1])
+    gt_order = np.argsort(gt_keys, kind='stable')
+    sorted_keys = gt_keys[gt_order]
+
+    rows, cols = [], []
+    pred_keys = (pred_cells[:, 0] - low[0]) * height + (pred_cells[:, 1] - low[1])
+    for offset in (-height - 1, -height, -height + 1, -1, 0, 1, height - 1, height, height + 1):
+        starts = np.searchsorted(sorted_keys, pred_keys + offset, side='left')
+        counts = np.searchsorted(sorted_keys, pred_keys + offset, side='right') - starts
+        n_pairs = int(counts.sum())
+        if n_pairs == 0:
+            continue
+        # Position of each pair in the range of GTs of its cell.
+        in_cell = np.arange(n_pairs) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows.append(np.repeat(np.arange(len(pred_keys)), counts))
+        cols.append(gt_order[np.repeat(starts, counts) + in_cell])
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
+
+
+def match_candidates(pred_xy: np.ndarray, gt_xy: np.ndarray, dist_ths: List[float]) -> Tuple[list, list, list]:
+    """
+    Finds the (prediction, GT) pairs closer than the largest distance threshold, the only ones that can be matched,
+    with the same distances of `center_distances` wherever the matching depends on them (see `center_distances`).
+    Small samples use the full distance matrix, while large ones (e.g. dense crowds) find the pairs with a BEV grid
+    (see `grid_candidate_pairs`) and only compute the distances of the pairs of neighbouring cells.
+    :param pred_xy: Array (n_preds, 2) with the predictions centers.
+    :param gt_xy: Array (n_gts, 2) with the GTs centers.
+    :param dist_ths: Distance thresholds that will be used to match the boxes.
+    :return: Lists in a compressed sparse row layout (as Python lists, which are faster to traverse one by one):
+        the first index of the pairs of each prediction (n_preds + 1), and the GT (column) and the distance of each
+        pair, sorted by column in the pairs of each prediction.
+    """
+    max_th = max(dist_ths)
+    if len(pred_xy) * len(gt_xy) < max(GRID_MIN_PAIRS, 1) or not (np.all(np.isfinite(pred_xy)) and
+                                                         np.all(np.isfinite(gt_xy))):
+        dists = center_distances(pred_xy, gt_xy, dist_ths)
+        rows, cols = np.nonzero(dists < max_th)
+        values = dists[rows, cols]
+    else:
+        # The cells are slightly larger than the threshold, so rounding never misses a pair closer than it.
+        rows, cols = grid_candidate_pairs(pred_xy, gt_xy, max_th * (1 + 1e-9))
+        values = np.linalg.norm(pred_xy[rows] - gt_xy[cols], axis=-1)
+
+        # Pairs that can not be matched are dropped, keeping the ones that may be closer than the threshold with the
+        # exact distance.
+        tol = 1e-12
+        close = values <= max_th * (1 + tol)
+        rows, cols, values = rows[close], cols[close], values[close]
+
+        # As in `center_distances`, the pairs of predictions with (almost) tied distances or distances (almost) equal
+        # to a threshold are recomputed exactly as the devkit.
+        by_dist = np.lexsort((values, rows))
+        sorted_values = values[by_dist]
+        ties = (np.diff(rows[by_dist]) == 0) & (np.diff(sorted_values) <= tol * sorted_values[1:])
+        close_calls = np.zeros(len(pred_xy), dtype=bool)
+        close_calls[rows[by_dist][1:][ties]] = True
+        for dist_th in dist_ths:
+            close_calls[rows[np.abs(values - dist_th) <= tol * dist_th]] = True
+        recompute = np.flatnonzero(close_calls[rows])
+        values[recompute] = devkit_norms(pred_xy[rows[recompute]] - gt_xy[cols[recompute]])
+
+        keep = values < max_th
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+
+    row_starts = np.searchsorted(rows, np.arange(len(pred_xy) + 1))
+    return row_starts.tolist(), cols.tolist(), values.tolist()
+
+
+def greedy_match_candidates(candidates: Tuple[list, list, list],
+                            dist_th: float,
+                            rows: np.ndarray = None,
+                            gt_allowed: np.ndarray = None) -> np.ndarray:
+    """
+    Greedily matches predictions to GTs, reproducing the matching of the devkit `accumulate`: each prediction takes
+    the closest GT not taken yet (the first one wins ties) if it is closer than the threshold. Only the candidate
+    pairs are visited, instead of every GT of the sample.
+    :param candidates: Candidate pairs returned by `match_candidates`, with predictions sorted by descending confidence.
+    :param dist_th: Distance threshold for a match.
+    :param rows: Predictions that are matched, in the same order. If not given, every prediction is matched.
+    :param gt_allowed: Boolean array (n_gts,) with the GTs that can be matched. If not given, every GT can be matched.
+    :return: Array (n_rows,) with the matched GT column of each prediction, or -1 if it is not a match.
+    """
+    row_starts, cols, dists = candidates
+    if rows is None:
+        rows = range(len(row_starts) - 1)
+    allowed = None if gt_allowed is None else gt_allowed.tolist()
+    matches = [-1] * len(rows)
+    taken = set()
+    for i, row in enumerate(rows):
+        best_col, best_dist = -1, dist_th
+        for k in range(row_starts[row], row_starts[row + 1]):
+            # Columns are sorted, so the strict comparison keeps the first of tied GTs.
+            if dists[k] < best_dist and cols[k] not in taken and (allowed is None or allowed[cols[k]]):
+                best_col, best_dist = cols[k], dists[k]
+        if best_col >= 0:
+            matches[i] = best_col
+            taken.add(best_col)
+    return np.array(matches, dtype=np.int64)
+
+
+def angle_diffs(x: np.ndarray, y: np.ndarray, period: float) -> np.ndarray:
+    """
+    Vectorized version of the devkit `angle_diff`.
+    :param x: First angles (in radians).
+    :param y: Second angles (in radians).
+    :param period: Periodicity in radians for assessing angle difference.
+    :return: Signed smallest between-angle differences in range (-pi, pi).
+    """
+    diff = (x - y + period / 2) % period - period / 2
+    return np.where(diff > np.pi, diff - (2 * np.pi), diff)
+
+
+def quaternion_yaws(rotations: np.ndarray) -> np.ndarray:
+    """
+    Yaw angle of each rotation, computed with the devkit `quaternion_yaw`.
+    :param rotations: Array (n, 4) with quaternions.
+    :return: Array (n,) with the yaw angles in radians.
+    """
+    return np.array([quaternion_yaw(Quaternion(rotation)) for rotation in rotations], dtype=np.float64)
+
+
+def match_errors(gt_boxes: ColumnarBoxes,
+                 gt_inds: np.ndarray,
+                 pred_boxes: ColumnarBoxes,
+                 pred_inds: np.ndarray,
+                 class_name: str) -> Dict[str, np.ndarray]:
+    """
+    Computes the TP errors of matched pairs of boxes, as done by the devkit `accumulate`.
+    :param gt_boxes: All GT boxes.
+    :param gt_inds: Indices of the matched GT boxes.
+    :param pred_boxes: All predicted boxes.
+    :param pred_inds: Indices of the matched predicted boxes (pred_inds[i] matched with gt_inds[i]).
+    :param class_name: Class of the boxes.
+    :return: Dict mapping each TP metric name to an array with the error of each pair.
+    """
+    gt_size = gt_boxes.size[gt_inds]
+    pred_size = pred_boxes.size[pred_inds]
+    assert np.all(gt_size > 0), 'Error: sample_annotation sizes must be >0.'
+    assert np.all(pred_size > 0), 'Error: sample_result sizes must be >0.'
+    intersection = np.prod(np.minimum(gt_size, pred_size), axis=1)
+    scale_iou = intersection / (np.prod(gt_size, axis=1) + np.prod(pred_size, axis=1) - intersection)
+
+    # Barrier orientation is only determined up to 180 degree. (For cones orientation is discarded later)
+    period = np.pi if class_name == 'barrier' else 2 * np.pi
+    yaw_diff = np.abs(angle_diffs(quaternion_yaws(gt_boxes.rotation[gt_inds]),
+                                  quaternion_yaws(pred_boxes.rotation[pred_inds]), period))
+
+    # GTs without attribute have nan accuracy.
+    gt_attributes = gt_boxes.attribute_name_array(gt_inds)
+    attr_acc = np.where(gt_attributes == '', np.nan,
+                        (gt_attributes == pred_boxes.attribute_name_array(pred_inds)).astype(np.float64))
+
+    return {'trans_err': devkit_norms(pred_boxes.translation[pred_inds, :2] - gt_boxes.translation[gt_inds, :2]),
+            'vel_err': devkit_norms(pred_boxes.velocity[pred_inds] - gt_boxes.velocity[gt_inds]),
+            'scale_err': 1 - scale_iou,
+            'orient_err': yaw_diff,
+            'attr_err': 1 - attr_acc}
+
+
+def sample_match_key(gt_boxes: ColumnarBoxes,
+                     gt_inds: np.ndarray,
+                     pred_boxes: ColumnarBoxes,
+                     pred_inds: np.ndarray,
+                     class_name: str,
+                     dist_ths: List[float]) -> str:
+    """
+    Content hash of the boxes of a class in a sample and of the config fields used to match them, used as the key of
+    a SampleMatchCache. The scores are not hashed, only the order they give to the predictions.
+    :param gt_boxes: All GT boxes.
+    :param gt_inds: Indices of the sample GT boxes of the class.
+    :param pred_boxes: All predicted boxes.
+    :param pred_inds: Indices of the sample predicted boxes of the class, sorted by descending confidence.
+    :param class_name: Class of the boxes.
+    :param dist_ths: Distance thresholds for a match.
+    :return: Hexadecimal SHA-1 digest.
+    """
+    sha = hashlib.sha1(json.dumps([SampleMatchCache.format_version, class_name == 'barrier', list(dist_ths),
+                                   len(gt_inds), len(pred_inds)]).encode())
+    for boxes, inds in ((gt_boxes, gt_inds), (pred_boxes, pred_inds)):
+        for array in (boxes.translation, boxes.size, boxes.rotation, boxes.velocity):
+            sha.update(np.ascontiguousarray(array[inds], dtype=np.float64).tobytes())
+        sha.update(json.dumps([boxes.attribute_names[code] for code in boxes.attribute_codes[inds].tolist()]).encode())
+    return sha.hexdigest()
+
+
+def cummean(x: np.ndarray) -> np.ndarray:
+    """
+    Same as the devkit `cummean` (cumulative mean ignoring nans, or ones if every value is nan), without the Python
+    `sum` it uses to count the nans, which dominates its time on large arrays.
+    :param x: Array (n,).
+    :return: Array (n,) with the cumulative means.
+    """
+    if np.all(np.isnan(x)):
+        # Is all numbers in array are NaN's.
+        return np.ones(len(x))  # If all errors are NaN set to error to 1 for all operating points.
+    # Accumulate in a nan-aware manner.
+    sum_vals = np.nancumsum(x.astype(float))  # Cumulative sum ignoring nans.
+    count_vals = np.cumsum(~np.isnan(x))  # Number of non-nans up to each position.
+    return np.divide(sum_vals, count_vals, out=np.zeros_like(sum_vals), where=count_vals != 0)
+
+
+def metric_data_from_matches(is_tp: np.ndarray,
+                             confs: np.ndarray,
+                             match_data: Dict[str, np.ndarray],
+                             npos: int) -> DetectionMetricData:
+    """
+    Builds the interpolated metric data from the matching results, exactly as the end of the devkit `accumulate`.
+    :param is_tp: Boolean array (n_preds,) with the predictions that were matched, sorted by descending confidence.
+    :param confs: Array (n_preds,) with the predictions confidences, in the same order.
+    :param match_data: Dict mapping each TP metric name to an array with the errors of the matched predictions.
+    :param npos: Number of GT boxes.
+    :return: DetectionMetricData with the interpolated curves.
+    """
+    # Check if we have any matches. If not, just return a "no predictions" array.
+    if not np.any(is_tp):
+        return DetectionMetricData.no_predictions()
+
+    # Accumulate.
+    tp = np.cumsum(is_tp).astype(float)
+    fp = np.cumsum(~is_tp).astype(float)
+
+    # Calculate precision and recall.
+    prec = tp / (fp + tp)
+    rec = tp / float(npos)
+
+    rec_interp = np.linspace(0, 1, DetectionMetricData.nelem)  # 101 steps, from 0% to 100% recall.
+    prec = np.interp(rec_interp, rec, prec, right=0)
+    conf = np.interp(rec_interp, rec, confs, right=0)
+    rec = rec_interp
+
+    # Re-sample the match-data to match, prec, recall and conf.
+    match_conf = confs[is_tp]
+    resampled = {}
+    for key, errors in match_data.items():
+        # For each match_data, we first calculate the accumulated mean.
+        tmp = cummean(errors)
+
+        # Then interpolate based on the confidences. (Note reversing since np.interp needs increasing arrays)
+        resampled[key] = np.interp(conf[::-1], match_conf[::-1], tmp[::-1])[::-1]
+
+    return DetectionMetricData(recall=rec,
+                               precision=prec,
+                               confidence=conf,
+                               trans_err=resampled['trans_err'],
+                               vel_err=resampled['vel_err'],
+                               scale_err=resampled['scale_err'],
+                               orient_err=resampled['orient_err'],
+                               attr_err=resampled['attr_err'])
+
+
+def accumulate_columnar(gt_boxes: ColumnarBoxes,
+                        pred_boxes: ColumnarBoxes,
+                        class_name: str,
+                        dist_ths: List[float],
+                        verbose: bool = False,
+                        sample_cache: SampleMatchCache = None) -> Dict[float, DetectionMetricData]:
+    """
+    NumPy implementation of the devkit `accumulate` (with center distance), producing the same DetectionMetricData.
+    The boxes are matched by `match_columnar`, and the curves are built from its results.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes. Every sample must also be in the GT boxes.
+    :param class_name: Class to compute AP on.
+    :param dist_ths: Distance thresholds for a match.
+    :param verbose: If true, print debug messages.
+    :param sample_cache: Cache of the matching results of each sample. If given, the samples found in it are not
+        matched again, and the results of the other samples are added to it.
+    :return: Dict mapping each distance threshold to the DetectionMetricData with the raw data for a number of metrics.
+    """
+    matches = match_columnar(gt_boxes, pred_boxes, class_name, dist_ths, verbose=verbose, sample_cache=sample_cache)
+    return _class_metric_data(matches, dist_ths)
+
+
+def accumulate_columnar_slices(gt_boxes: ColumnarBoxes,
+                               pred_boxes: ColumnarBoxes,
+                               class_name: str,
+                               dist_ths: List[float],
+                               gt_slices: np.ndarray,
+                               pred_slices: np.ndarray) -> List[Dict[float, DetectionMetricData]]:
+    """
+    Runs `accumulate_columnar` on several slices (subsets) of the boxes, matching them with `match_columnar_slices`.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes. Every sample must also be in the GT boxes.
+    :param class_name: Class to compute AP on.
+    :param dist_ths: Distance thresholds for a match.
+    :param gt_slices: Boolean array (n_slices, n_gt_boxes) with the GT boxes of each slice.
+    :param pred_slices: Boolean array (n_slices, n_pred_boxes) with the predicted boxes of each slice.
+    :return: List with, for each slice, the dict mapping each distance threshold to the DetectionMetricData.
+    """
+    return [_class_metric_data(matches, dist_ths)
+            for matches in match_columnar_slices(gt_boxes, pred_boxes, class_name, dist_ths, gt_slices, pred_slices)]
+
+
+def _class_metric_data(matches: Optional[Dict[str, Any]], dist_ths: List[float]) -> Dict[float, DetectionMetricData]:
+    """
+    Builds the metric data of a class from its matching results.
+    :param matches: Matching results returned by `match_columnar`.
+    :param dist_ths: Distance thresholds for a match.
+    :return: Dict mapping each distance threshold to the DetectionMetricData.
+    """
+    # For missing classes in the GT, return a data structure corresponding to no predictions.
+    if matches is None:
+        return {dist_th: DetectionMetricData.no_predictions() for dist_th in dist_ths}
+
+    return {dist_th: metric_data_from_matches(matches['is_tp'][th_ind], matches['confs'],
+                                              matches['match_data'][th_ind], matches['npos'])
+            for th_ind, dist_th in enumerate(dist_ths)}
+
+
+def match_columnar(gt_boxes: ColumnarBoxes,
+                   pred_boxes: ColumnarBoxes,
+                   class_name: str,
+                   dist_ths: List[float],
+                   verbose: bool = False,
+                   sample_cache: SampleMatchCache = None) -> Optional[Dict[str, Any]]:
+    """
+    Matches the predictions and GTs of a class as the devkit `accumulate` (with center distance).
+    All distance thresholds are computed in a single pass: predictions are sorted by confidence once and, for each
+    sample, the pairwise distance matrix between the predictions and GTs of the class is computed once and used to
+    greedily match the boxes with every threshold.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes. Every sample must also be in the GT boxes.
+    :param class_name: Class to match.
+    :param dist_ths: Distance thresholds for a match.
+    :param verbose: If true, print debug messages.
+    :param sample_cache: Cache of the matching results of each sample. If given, the samples found in it are not
+        matched again, and the results of the other samples are added to it.
+    :return: None if the class is not in the GTs. Otherwise, a dict with the matching results:
+        - npos: Number of GT boxes of the class.
+        - sample_npos: Array (n_gt_samples,) with the number of GT boxes of the class in each sample.
+        - confs: Array (n_preds,) with the confidences of the predictions of the class, sorted in descending order.
+        - samples: Array (n_preds,) with the sample (index in the GT samples) of each prediction, in the same order.
+        - boxes: Array (n_preds,) with the index of each prediction in pred_boxes, in the same order.
+        - is_tp: Boolean array (n_dist_ths, n_preds) with the predictions matched with each distance threshold.
+        - match_data: List with, for each distance threshold, a dict mapping each TP metric name to an array with the
+          errors of the matched predictions.
+    """
+    return match_columnar_slices(gt_boxes, pred_boxes, class_name, dist_ths, verbose=verbose,
+                                 sample_cache=sample_cache)[0]
+
+
+def match_columnar_slices(gt_boxes: ColumnarBoxes,
+                          pred_boxes: ColumnarBoxes,
+                          class_name: str,
+                          dist_ths: List[float],
+                          gt_slices: np.ndarray = None,
+                          pred_slices: np.ndarray = None,
+                          verbose: bool = False,
+                          sample_cache: SampleMatchCache = None) -> List[Optional[Dict[str, Any]]]:
+    """
+    Runs `match_columnar` on several slices (subsets) of the boxes at once, with the same results of matching the
+    boxes of each slice separately. The distance matrix of each sample is computed once for all boxes of the class, and
+    each slice greedily matches its own rows and columns of it. The TP errors of a pair matched in more than one slice
+    are also computed once.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes. Every sample must also be in the GT boxes.
+    :param class_name: Class to match.
+    :param dist_ths: Distance thresholds for a match.
+    :param gt_slices: Boolean array (n_slices, n_gt_boxes) with the GT boxes of each slice. If not given, there is a
+        single slice with all boxes.
+    :param pred_slices: Boolean array (n_slices, n_pred_boxes) with the predicted boxes of each slice. It must be given
+        with gt_slices.
+    :param verbose: If true, print debug messages.
+    :param sample_cache: Cache of the matching results of each sample (see `match_columnar`). It can only be used
+        without slices.
+    :return: List with the matching results of each slice (see `match_columnar`).
+    """
+    assert (gt_slices is None) == (pred_slices is None), 'Error: The slices of the GTs and predictions must be given!'
+    assert sample_cache is None or gt_slices is None, 'Error: The sample cache can not be used with slices!'
+    if gt_slices is None:
+        gt_slices = np.ones((1, len(gt_boxes)), dtype=bool)
+        pred_slices = np.ones((1, len(pred_boxes)), dtype=bool)
+    n_slices = len(gt_slices)
+
+    # Count the positives.
+    gt_mask = gt_boxes.class_mask(class_name)
+    npos = int(np.count_nonzero(gt_mask))
+    if verbose:
+        print("Found {} GT of class {} out of {} total across {} samples.".
+              format(npos, class_name, len(gt_boxes), len(gt_boxes.sample_tokens)))
+
+    if npos == 0:
+        return [None] * n_slices
+
+    # Sort by confidence. Like the devkit, ties are broken by the reverse order of the boxes.
+    pred_inds = np.flatnonzero(pred_boxes.class_mask(class_name))
+    order = pred_inds[np.argsort(pred_boxes.detection_score[pred_inds], kind='stable')[::-1]]
+    if verbose:
+        print("Found {} PRED of class {} out of {} total across {} samples.".
+              format(len(order), class_name, len(pred_boxes), len(pred_boxes.sample_tokens)))
+
+    # Group the sorted predictions by sample (keeping the confidence order) and match each sample independently.
+    gt_samples = {sample_token: i for i, sample_token in enumerate(gt_boxes.sample_tokens)}
+    matched_gt = np.full((n_slices, len(dist_ths), len(order)), -1, dtype=np.int64)
+    order_slices = pred_slices[:, order]
+    order_samples = pred_boxes.sample_index[order]
+    by_sample = np.argsort(order_samples, kind='stable')
+    splits = np.flatnonzero(np.diff(order_samples[by_sample])) + 1
+    cached = []  # (ranks, gt_inds, matches) of the samples found in the cache.
+    missing = []  # (key, ranks, gt_inds) of the samples that are added to the cache.
+    for ranks in np.split(by_sample, splits):
+        if len(ranks) == 0:
+            continue
+
+        gt_sample = gt_samples[pred_boxes.sample_tokens[order_samples[ranks[0]]]]
+        start = gt_boxes.sample_offsets[gt_sample]
+        gt_inds = start + np.flatnonzero(gt_mask[start:gt_boxes.sample_offsets[gt_sample + 1]])
+        if len(gt_inds) == 0:
+            continue
+
+        if sample_cache is not None:
+            key = sample_match_key(gt_boxes, gt_inds, pred_boxes, order[ranks], class_name, dist_ths)
+            matches = sample_cache.get(key)
+            if matches is not None:
+                cols = matches[0]
+                matched_gt[0][:, ranks] = np.where(cols >= 0, gt_inds[cols], -1)
+                cached.append((ranks, gt_inds, matches))
+                continue
+            missing.append((key, ranks, gt_inds))
+
+        candidates = match_candidates(pred_boxes.translation[order[ranks], :2], gt_boxes.translation[gt_inds, :2],
+                                      dist_ths)
+        for slice_ind in range(n_slices):
+            rows = np.flatnonzero(order_slices[slice_ind, ranks])
+            gt_allowed = gt_slices[slice_ind, gt_inds]
+            if len(rows) == 0 or not np.any(gt_allowed):
+                continue
+            if len(rows) == len(ranks) and np.all(gt_allowed):
+                rows, gt_allowed = None, None
+            for th_ind, dist_th in enumerate(dist_ths):
+                cols = greedy_match_candidates(candidates, dist_th, rows, gt_allowed)
+                matched = cols >= 0
+                matched_ranks = ranks[matched] if rows is None else ranks[rows[matched]]
+                matched_gt[slice_ind, th_ind, matched_ranks] = gt_inds[cols[matched]]
+
+    # Most pairs are matched with more than one threshold (and slice), so the errors of each distinct pair are
+    # computed once.
+    is_tp = matched_gt >= 0
+    pair_ranks, pair_gts = np.nonzero(is_tp)[2], matched_gt[is_tp]
+    pairs, pair_inverse = np.unique(np.stack([pair_ranks, pair_gts]), axis=1, return_inverse=True)
+    pair_inverse = pair_inverse.reshape(-1)
+    if sample_cache is None:
+        pair_errors = match_errors(gt_boxes, pairs[1], pred_boxes, order[pairs[0]], class_name)
+    else:
+        pair_errors = _cached_pair_errors(gt_boxes, pred_boxes, order, class_name, pairs, cached)
+        _add_sample_matches(sample_cache, matched_gt[0], pairs, pair_errors, missing)
+
+    # The pairs of each slice and threshold are contiguous, in this order.
+    pred_gt_samples = np.array([gt_samples[sample_token] for sample_token in pred_boxes.sample_tokens], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.count_nonzero(is_tp, axis=2).reshape(-1))])
+    results = []
+    for slice_ind in range(n_slices):
+        slice_gt_mask = gt_mask & gt_slices[slice_ind]
+        slice_npos = int(np.count_nonzero(slice_gt_mask))
+        if slice_npos == 0:
+            results.append(None)
+            continue
+
+        match_data = []
+        for th_ind in range(len(dist_ths)):
+            row = slice_ind * len(dist_ths) + th_ind
+            th_pairs = pair_inverse[offsets[row]:offsets[row + 1]]
+            match_data.append({key: errors[th_pairs] for key, errors in pair_errors.items()})
+
+        # Predictions out of the slice are ignored, and they are never matched.
+        slice_ranks = np.flatnonzero(order_slices[slice_ind])
+        results.append({'npos': slice_npos,
+                        'sample_npos': np.bincount(gt_boxes.sample_index[slice_gt_mask],
+                                                   minlength=len(gt_boxes.sample_tokens)),
+                        'confs': pred_boxes.detection_score[order[slice_ranks]],
+                        'samples': pred_gt_samples[order_samples[slice_ranks]],
+                        'boxes': order[slice_ranks],
+                        'is_tp': is_tp[slice_ind][:, slice_ranks],
+                        'match_data': match_data})
+    return results
+
+
+def _cached_pair_errors(gt_boxes: ColumnarBoxes,
+                        pred_boxes: ColumnarBoxes,
+                        order: np.ndarray,
+                        class_name: str,
+                        pairs: np.ndarray,
+                        cached: list) -> Dict[str, np.ndarray]:
+    """
+    Gets the TP errors of the distinct matched pairs of `accumulate_columnar`, taking the errors of the pairs of cached
+    samples from the cache and computing the others.
+    :param gt_boxes: All GT boxes.
+    :param pred_boxes: All predicted boxes.
+    :param order: Indices of the predictions of the class, sorted by descending confidence.
+    :param class_name: Class of the boxes.
+    :param pairs: Array (2, n_pairs) with the rank (in order) and GT index of each pair, sorted by rank and GT.
+    :param cached: List of (ranks, gt_inds, matches) of the samples found in the cache.
+    :return: Dict mapping each TP metric name to an array with the error of each pair.
+    """
+    errors = np.full((pairs.shape[1], len(TP_METRICS)), np.nan)
+    known = np.zeros(pairs.shape[1], dtype=bool)
+    if cached:
+        # Pairs are sorted by rank and GT, so the pairs of the cache are found by binary search of a combined code.
+        codes = pairs[0] * len(gt_boxes) + pairs[1]
+        cached_codes = np.concatenate([ranks[matches[1]] * len(gt_boxes) + gt_inds[matches[2]]
+                                       for ranks, gt_inds, matches in cached])
+        positions = np.searchsorted(codes, cached_codes)
+        errors[positions] = np.concatenate([matches[3] for _, _, matches in cached])
+        known[positions] = True
+
+    unknown = np.flatnonzero(~known)
+    computed = match_errors(gt_boxes, pairs[1, unknown], pred_boxes, order[pairs[0, unknown]], class_name)
+    for i, metric_name in enumerate(TP_METRICS):
+        errors[unknown, i] = computed[metric_name]
+
+    return {metric_name: errors[:, i] for i, metric_name in enumerate(TP_METRICS)}
+
+
+def _add_sample_matches(sample_cache: SampleMatchCache,
+                        matched_gt: np.ndarray,
+                        pairs: np.ndarray,
+                        pair_errors: Dict[str, np.ndarray],
+                        missing: list) -> None:
+    """
+    Adds the matching results of the samples matched by `accumulate_columnar` to the cache.
+    :param sample_cache: The cache.
+    :param matched_gt: Array (n_dist_ths, n_preds) with the matched GT index of each prediction (sorted by rank), or -1.
+    :param pairs: Array (2, n_pairs) with the rank and GT index of each distinct pair, sorted by rank and GT.
+    :param pair_errors: Dict mapping each TP metric name to an array with the error of each pair.
+    :param missing: List of (key, ranks, gt_inds) of the samples that are added to the cache.
+    """
+    if not missing:
+        return
+
+    # Group the pairs by sample.
+    rank_samples = np.full(matched_gt.shape[1], -1, dtype=np.int64)
+    for i, (_, ranks, _) in enumerate(missing):
+        rank_samples[ranks] = i
+    pair_samples = rank_samples[pairs[0]]
+    by_sample = np.argsort(pair_samples, kind='stable')
+    sample_pairs = np.split(by_sample, np.searchsorted(pair_samples[by_sample], np.arange(len(missing) + 1)))[1:]
+    errors = np.stack([pair_errors[metric_name] for metric_name in TP_METRICS], axis=1)
+
+    # Ranks and GT indices of each sample are sorted, so their local indices are found by binary search.
+    for (key, ranks, gt_inds), sample_pair_inds in zip(missing, sample_pairs):
+        sample_matched = matched_gt[:, ranks]
+        cols = np.where(sample_matched >= 0, np.searchsorted(gt_inds, sample_matched), -1).astype(np.int32)
+        sample_cache.put(key, (cols,
+                               np.searchsorted(ranks, pairs[0, sample_pair_inds]).astype(np.int32),
+                               np.searchsorted(gt_inds, pairs[1, sample_pair_inds]).astype(np.int32),
+                               errors[sample_pair_inds]))
+
+
+def _accumulate_class(gt_boxes: ColumnarBoxes,
+                      pred_boxes: ColumnarBoxes,
+                      class_name: str,
+                      dist_ths: List[float],
+                      sample_cache: SampleMatchCache = None,
+                      slices: Tuple[np.ndarray, np.ndarray] = None,
+                      keep_matches: bool = False) -> tuple:
+    """
+    Runs `accumulate_columnar` (or `accumulate_columnar_slices`) for one class, measuring its wall and CPU times.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes.
+    :param class_name: Class to compute AP on.
+    :param dist_ths: Distance thresholds for a match.
+    :param sample_cache: Cache of the matching results of each sample (see `accumulate_columnar`).
+    :param slices: Tuple with the slices of the GT and predicted boxes (see `accumulate_columnar_slices`), if any.
+    :param keep_matches: Whether to also return the matching results of the class (not used with slices).
+    :return: Tuple with the dict mapping each distance threshold to the DetectionMetricData (or the list with the dict
+        of each slice), the matching results returned by `match_columnar` (None if keep_matches is False) and the
+        (wall, CPU) times.
+    """
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    matches = None
+    if slices is None:
+        matches = match_columnar(gt_boxes, pred_boxes, class_name, dist_ths, sample_cache=sample_cache)
+        metric_data = _class_metric_data(matches, dist_ths)
+    else:
+        metric_data = accumulate_columnar_slices(gt_boxes, pred_boxes, class_name, dist_ths, *slices)
+    return (metric_data, matches if keep_matches else None,
+            (time.perf_counter() - start_wall, time.process_time() - start_cpu))
+
+
+def _accumulate_shared_class(class_name: str) -> tuple:
+    """
+    Runs `_accumulate_class` for one class with the boxes shared by `accumulate_classes`.
+    :param class_name: Class to compute AP on.
+    :return: Tuple with the dict mapping each distance threshold to the DetectionMetricData, the matching results (if
+        they are kept), the (wall, CPU) times and the updates of the shared SampleMatchCache (None if it is not used).
+    """
+    gt_boxes, pred_boxes, dist_ths, sample_cache, slices, keep_matches = _shared_boxes
+    if sample_cache is None:
+        return _accumulate_class(gt_boxes, pred_boxes, class_name, dist_ths, slices=slices,
+                                 keep_matches=keep_matches) + (None,)
+
+    # The process has its own copy of the cache, so the changes are sent back to be merged into the original cache.
+    sample_cache = sample_cache.view()
+    return _accumulate_class(gt_boxes, pred_boxes, class_name, dist_ths, sample_cache,
+                             keep_matches=keep_matches) + (sample_cache.updates(),)
+
+
+def accumulate_classes(gt_boxes: ColumnarBoxes,
+                       pred_boxes: ColumnarBoxes,
+                       class_names: List[str],
+                       dist_ths: List[float],
+                       workers: int = 1,
+                       sample_cache: SampleMatchCache = None,
+                       profiler: StageProfiler = None,
+                       return_matches: bool = False) -> Union[Dict[str, Dict[float, DetectionMetricData]], tuple]:
+    """
+    Runs `accumulate_columnar` for several classes, which are independent and can be computed in parallel processes.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes. Every sample must also be in the GT boxes.
+    :param class_names: Classes to compute AP on.
+    :param dist_ths: Distance thresholds for a match.
+    :param workers: Number of processes. If 1, the classes are computed in the current process.
+    :param sample_cache: Cache of the matching results of each sample (see `accumulate_columnar`).
+    :param profiler: StageProfiler where the times of each class are recorded (as the `accumulate` stage).
+    :param return_matches: Whether to also return the matching results of each class, e.g. to resample them in
+        `bootstrap_metrics` without matching the boxes again.
+    :return: Dict mapping each class to a dict mapping each distance threshold to the DetectionMetricData. If
+        return_matches is True, a tuple with this dict and a dict mapping each class to its matching results (see
+        `match_columnar`).
+    """
+    results = _accumulate_classes(gt_boxes, pred_boxes, class_names, dist_ths, workers, sample_cache, None, profiler,
+                                  'accumulate', keep_matches=return_matches)
+    classes_metric_data = {class_name: metric_data for class_name, (metric_data, _) in results.items()}
+    if not return_matches:
+        return classes_metric_data
+    return classes_metric_data, {class_name: matches for class_name, (_, matches) in results.items()}
+
+
+def accumulate_slices(gt_boxes: ColumnarBoxes,
+                      pred_boxes: ColumnarBoxes,
+                      class_names: List[str],
+                      dist_ths: List[float],
+                      gt_slices: np.ndarray,
+                      pred_slices: np.ndarray,
+                      workers: int = 1,
+                      profiler: StageProfiler = None) -> List[Dict[str, Dict[float, DetectionMetricData]]]:
+    """
+    Runs `accumulate_columnar_slices` for several classes, which are independent and can be computed in parallel
+    processes.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes. Every sample must also be in the GT boxes.
+    :param class_names: Classes to compute AP on.
+    :param dist_ths: Distance thresholds for a match.
+    :param gt_slices: Boolean array (n_slices, n_gt_boxes) with the GT boxes of each slice.
+    :param pred_slices: Boolean array (n_slices, n_pred_boxes) with the predicted boxes of each slice.
+    :param workers: Number of processes. If 1, the classes are computed in the current process.
+    :param profiler: StageProfiler where the times of each class are recorded (as the `accumulate_slices` stage).
+    :return: List with, for each slice, the dict mapping each class to a dict mapping each distance threshold to the
+        DetectionMetricData.
+    """
+    results = _accumulate_classes(gt_boxes, pred_boxes, class_names, dist_ths, workers, None,
+                                  (gt_slices, pred_slices), profiler, 'accumulate_slices')
+    return [{class_name: results[class_name][0][slice_ind] for class_name in class_names}
+            for slice_ind in range(len(gt_slices))]
+
+
+def _accumulate_classes(gt_boxes: ColumnarBoxes,
+                        pred_boxes: ColumnarBoxes,
+                        class_names: List[str],
+                        dist_ths: List[float],
+                        workers: int,
+                        sample_cache: Optional[SampleMatchCache],
+                        slices: Optional[Tuple[np.ndarray, np.ndarray]],
+                        profiler: Optional[StageProfiler],
+                        stage_name: str,
+                        keep_matches: bool = False) -> Dict[str, Any]:
+    """
+    Runs `_accumulate_class` for several classes, in parallel processes if more than one worker is used.
+    :param gt_boxes: GT boxes.
+    :param pred_boxes: Predicted boxes.
+    :param class_names: Classes to compute AP on.
+    :param dist_ths: Distance thresholds for a match.
+    :param workers: Number of processes. If 1, the classes are computed in the current process.
+    :param sample_cache: Cache of the matching results of each sample (see `accumulate_columnar`).
+    :param slices: Tuple with the slices of the GT and predicted boxes (see `accumulate_columnar_slices`), if any.
+    :param profiler: StageProfiler where the times of each class are recorded.
+    :param stage_name: Name of the stage of the times of each class.
+    :param keep_matches: Whether to also return the matching results of each class (see `_accumulate_class`).
+    :return: Dict mapping each class to a tuple with the metric data and the matching results returned by
+        `_accumulate_class`.
+    """
+    global _shared_boxes
+
+    class_names = list(class_names)
+    if workers <= 1 or len(class_names) <= 1:
+        results = {class_name: _accumulate_class(gt_boxes, pred_boxes, class_name, dist_ths, sample_cache, slices,
+                                                 keep_matches)
+                   for class_name in class_names}
+    else:
+        # Start with the largest classes, so they do not end up being computed alone at the end.
+        by_size = sorted(class_names, key=lambda class_name: -np.count_nonzero(pred_boxes.class_mask(class_name)))
+
+        _shared_boxes = (gt_boxes, pred_boxes, dist_ths, sample_cache, slices, keep_matches)
+        try:
+            with multiprocessing.get_context('fork').Pool(min(workers, len(class_names))) as pool:
+                results = dict(zip(by_size, pool.map(_accumulate_shared_class, by_size, chunksize=1)))
+        finally:
+            _shared_boxes = None
+
+        if sample_cache is not None:
+            for _, _, _, updates in results.values():
+                sample_cache.merge_updates(updates)
+
+    if profiler is not None:
+        for class_name in class_names:
+            wall_time, cpu_time = results[class_name][2]
+            profiler.add(stage_name, wall_time, cpu_time, class_name=class_name)
+    return {class_name: results[class_name][:2] for class_name in class_names}
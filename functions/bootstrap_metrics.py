@@ -0,0 +1,170 @@
+import multiprocessing
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from nuscenes.eval.detection.constants import TP_METRICS
+from nuscenes.eval.detection.data_classes import DetectionConfig, DetectionMetricData, DetectionMetricDataList
+
+from functions.accumulate_columnar import metric_data_from_matches
+from functions.calc_metrics import calc_detection_metrics
+
+# Matching results used by the processes of `bootstrap_metrics`. They are set before the processes are forked, so the
+# processes inherit them instead of receiving a copy.
+_shared_bootstrap = None
+
+
+def bootstrap_weights(n_units: int, replicate: int, seed: int = 0) -> np.ndarray:
+    """
+    Draws a bootstrap replicate: n_units units (samples or groups of samples) drawn with replacement.
+    Each replicate has its own random generator, so it is the same regardless of the order the replicates are computed.
+    :param n_units: Number of units.
+    :param replicate: Index of the replicate.
+    :param seed: Seed of the replicates.
+    :return: Array (n_units,) with the number of times each unit was drawn.
+    """
+    rng = np.random.default_rng([seed, replicate])
+    return np.bincount(rng.integers(0, n_units, size=n_units), minlength=n_units)
+
+
+def resample_metric_data(matches: Dict[str, Any],
+                         sample_weights: np.ndarray,
+                         dist_ths: List[float]) -> Dict[float, DetectionMetricData]:
+    """
+    Builds the metric data of a class as if each sample was repeated as many times as its weight, reusing the matching
+    results of the samples (which are independent). It is the metric data of the evaluation of the resampled samples,
+    up to the order of predictions with tied confidences.
+    :param matches: Matching results of the class returned by `match_columnar`, or None if the class is not in the GTs.
+    :param sample_weights: Array (n_gt_samples,) with the number of times each sample is repeated.
+    :param dist_ths: Distance thresholds for a match.
+    :return: Dict mapping each distance threshold to the DetectionMetricData.
+    """
+    npos = 0 if matches is None else int(sample_weights @ matches['sample_npos'])
+    if npos == 0:
+        return {dist_th: DetectionMetricData.no_predictions() for dist_th in dist_ths}
+
+    # Repeating the sorted predictions in place keeps them sorted by confidence.
+    pred_weights = sample_weights[matches['samples']]
+    ranks = np.repeat(np.arange(len(pred_weights)), pred_weights)
+    confs = matches['confs'][ranks]
+    metric_data = {}
+    for th_ind, dist_th in enumerate(dist_ths):
+        is_tp = matches['is_tp'][th_ind]
+        tp_weights = pred_weights[is_tp]
+        tp_ranks = np.repeat(np.arange(len(tp_weights)), tp_weights)
+        match_data = {key: errors[tp_ranks] for key, errors in matches['match_data'][th_ind].items()}
+        metric_data[dist_th] = metric_data_from_matches(is_tp[ranks], confs, match_data, npos)
+    return metric_data
+
+
+def _bootstrap_replicate(replicate: int) -> np.ndarray:
+    """
+    Computes the metrics of one bootstrap replicate with the matching results shared by `bootstrap_metrics`.
+    :param replicate: Index of the replicate.
+    :return: Array with the metrics of the replicate (see `_metrics_vector`).
+    """
+    config, class_matches, sample_groups, n_groups, seed = _shared_bootstrap
+    sample_weights = bootstrap_weights(n_groups, replicate, seed)[sample_groups]
+
+    metric_data_list = DetectionMetricDataList()
+    for class_name in config.class_names:
+        class_metric_data = resample_metric_data(class_matches[class_name], sample_weights, config.dist_ths)
+        for dist_th in config.dist_ths:
+            metric_data_list.set(class_name, dist_th, class_metric_data[dist_th])
+    return _metrics_vector(config, calc_detection_metrics(config, metric_data_list).serialize())
+
+
+def _metrics_vector(config: DetectionConfig, metrics_summary: dict) -> np.ndarray:
+    """
+    Flattens the metrics that get confidence intervals into an array.
+    :param config: A DetectionConfig object.
+    :param metrics_summary: Serialized DetectionMetrics.
+    :return: Array with the mAP, the NDS, the AP of each class, the TP errors of each class and the mean TP errors.
+    """
+    return np.array([metrics_summary['mean_ap'], metrics_summary['nd_score']] +
+                    [metrics_summary['mean_dist_aps'][class_name] for class_name in config.class_names] +
+                    [metrics_summary['label_tp_errors'][class_name][metric_name]
+                     for class_name in config.class_names for metric_name in TP_METRICS] +
+                    [metrics_summary['tp_errors'][metric_name] for metric_name in TP_METRICS], dtype=np.float64)
+
+
+def _interval(values: np.ndarray, confidence: float) -> Dict[str, float]:
+    """
+    Summarizes the bootstrap distribution of a metric, ignoring the replicates where it is not defined (nan).
+    :param values: Array (n_replicates,) with the metric in each replicate.
+    :param confidence: Confidence level of the interval.
+    :return: Dict with the standard error and the bounds of the percentile confidence interval.
+    """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {'std': np.nan, 'ci_low': np.nan, 'ci_high': np.nan}
+    low, high = np.percentile(values, [50 * (1 - confidence), 50 * (1 + confidence)])
+    return {'std': float(np.std(values, ddof=1)) if len(values) > 1 else np.nan,
+            'ci_low': float(low), 'ci_high': float(high)}
+
+
+def bootstrap_metrics(class_matches: Dict[str, Optional[Dict[str, Any]]],
+                      sample_tokens: List[str],
+                      config: DetectionConfig,
+                      replicates: int,
+                      seed: int = 0,
+                      sample_groups: Dict[str, str] = None,
+                      confidence: float = 0.95,
+                      workers: int = 1) -> Dict[str, Any]:
+    """
+    Computes bootstrap confidence intervals of the mAP, the NDS and the AP and TP errors of each class, resampling the
+    samples (or groups of samples, e.g. scenes) with replacement.
+    The boxes are not matched again: since each sample is matched independently, the metric data of each replicate is
+    built by repeating the matching results of the evaluation for the drawn samples (see `resample_metric_data`),
+    instead of evaluating the resampled boxes again.
+    :param class_matches: Dict mapping each class of the config to its matching results, as returned by
+        `accumulate_classes` with return_matches.
+    :param sample_tokens: Tokens of the GT samples, in the order used by the matching results.
+    :param config: A DetectionConfig object.
+    :param replicates: Number of bootstrap replicates.
+    :param seed: Seed of the replicates.
+    :param sample_groups: Dict mapping each sample token to its group (e.g. scene token), which is resampled as a
+        whole. If not given, each sample is resampled independently.
+    :param confidence: Confidence level of the intervals.
+    :param workers: Number of processes computing the replicates.
+    :return: Dict with the settings of the bootstrap and, for each metric (with the same structure of the metrics
+        summary), its standard error and the bounds of its percentile confidence interval.
+    """
+    global _shared_bootstrap
+
+    if sample_groups is None:
+        sample_groups_array = np.arange(len(sample_tokens))
+        n_groups = len(sample_tokens)
+    else:
+        missing = [sample_token for sample_token in sample_tokens if sample_token not in sample_groups]
+        assert len(missing) == 0, f'Error: {len(missing)} samples are not in the bootstrap groups, e.g. {missing[0]}!'
+        group_names, sample_groups_array = np.unique([sample_groups[sample_token]
+                                                      for sample_token in sample_tokens], return_inverse=True)
+        sample_groups_array = sample_groups_array.reshape(-1)
+        n_groups = len(group_names)
+
+    _shared_bootstrap = (config, class_matches, sample_groups_array, n_groups, seed)
+    try:
+        if workers <= 1:
+            values = [_bootstrap_replicate(replicate) for replicate in range(replicates)]
+        else:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                values = pool.map(_bootstrap_replicate, range(replicates), chunksize=max(1, replicates // (4 * workers)))
+    finally:
+        _shared_bootstrap = None
+    values = np.array(values).reshape(replicates, -1)
+
+    # The intervals follow the order of `_metrics_vector`.
+    intervals = iter([_interval(values[:, i], confidence) for i in range(values.shape[1])])
+    return {
+        'replicates': replicates,
+        'seed': seed,
+        'confidence': confidence,
+        'resampled_units': 'groups' if sample_groups is not None else 'samples',
+        'n_units': n_groups,
+        'mean_ap': next(intervals),
+        'nd_score': next(intervals),
+        'mean_dist_aps': {class_name: next(intervals) for class_name in config.class_names},
+        'label_tp_errors': {class_name: {metric_name: next(intervals) for metric_name in TP_METRICS}
+                            for class_name in config.class_names},
+        'tp_errors': {metric_name: next(intervals) for metric_name in TP_METRICS},
+    }
@@ -0,0 +1,45 @@
+import contextlib
+
+import numpy as np
+from nuscenes.eval.detection.algo import calc_ap, calc_tp
+from nuscenes.eval.detection.constants import TP_METRICS
+from nuscenes.eval.detection.data_classes import DetectionConfig, DetectionMetricDataList, DetectionMetrics
+
+from classes.StageProfiler import StageProfiler
+
+
+def calc_detection_metrics(config: DetectionConfig,
+                           metric_data_list: DetectionMetricDataList,
+                           profiler: StageProfiler = None) -> DetectionMetrics:
+    """
+    Calculates the AP and TP metrics from the accumulated metric data, as the devkit evaluate.
+    :param config: A DetectionConfig object.
+    :param metric_data_list: DetectionMetricDataList with the data of every class and distance threshold.
+    :param profiler: StageProfiler where the times of each class are recorded (as the `calc_ap` and `calc_tp` stages).
+    :return: DetectionMetrics with the metrics (without runtime).
+    """
+    def stage(name: str, class_name: str):
+        return contextlib.nullcontext() if profiler is None else profiler.stage(name, class_name=class_name)
+
+    metrics = DetectionMetrics(config)
+    for class_name in config.class_names:
+        # Compute APs.
+        with stage('calc_ap', class_name):
+            for dist_th in config.dist_ths:
+                metric_data = metric_data_list[(class_name, dist_th)]
+                ap = calc_ap(metric_data, config.min_recall, config.min_precision)
+                metrics.add_label_ap(class_name, dist_th, ap)
+
+        # Compute TP metrics.
+        with stage('calc_tp', class_name):
+            for metric_name in TP_METRICS:
+                metric_data = metric_data_list[(class_name, config.dist_th_tp)]
+                if class_name in ['traffic_cone'] and metric_name in ['attr_err', 'vel_err', 'orient_err']:
+                    tp = np.nan
+                elif class_name in ['barrier'] and metric_name in ['attr_err', 'vel_err']:
+                    tp = np.nan
+                else:
+                    tp = calc_tp(metric_data, config.min_recall, metric_name)
+                metrics.add_label_tp(class_name, metric_name, tp)
+
+    return metrics
@@ -0,0 +1,70 @@
+import json
+import os
+import socket
+import tempfile
+from typing import Any, Dict
+
+# Default path of the Unix socket of the evaluation server (see `eval_server.py`), one per user.
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), f'eval_server_{os.getuid()}.sock')
+
+
+def send_request(request: Dict[str, Any], socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = None) -> dict:
+    """
+    Sends a request to the evaluation server and waits for its response.
+    The protocol has one JSON object per line: the client sends the request and the server answers with the response.
+    This module only uses the standard library, so a client does not pay the import time of the evaluation.
+    :param request: The request (see EvaluationServer).
+    :param socket_path: Path of the Unix socket of the server.
+    :param timeout: Maximum time (in seconds) to wait for the response. If None, waits until the evaluation ends.
+    :return: The response, with its `status` ('ok' or 'error').
+    :raise ConnectionError: If the server is not available (e.g. it is not running).
+    """
+    if not os.path.exists(socket_path):
+        raise ConnectionError(f'The evaluation server socket {socket_path} does not exist.')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except OSError as error:
+            raise ConnectionError(f'Could not connect to the evaluation server at {socket_path}: {error}')
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as file:
+            line = file.readline()
+    if not line:
+        raise ConnectionError('The evaluation server closed the connection without answering.')
+    return json.loads(line)
+
+
+def print_metrics_summary(metrics_summary: dict) -> None:
+    """
+    Prints the high-level metrics and the metrics of each class of a metrics summary, as the devkit main.
+    :param metrics_summary: The metrics summary returned by the evaluation.
+    """
+    print('mAP: %.4f' % (metrics_summary['mean_ap']))
+    err_name_mapping = {
+        'trans_err': 'mATE',
+        'scale_err': 'mASE',
+        'orient_err': 'mAOE',
+        'vel_err': 'mAVE',
+        'attr_err': 'mAAE'
+    }
+    for tp_name, tp_val in metrics_summary['tp_errors'].items():
+        print('%s: %.4f' % (err_name_mapping[tp_name], tp_val))
+    print('NDS: %.4f' % (metrics_summary['nd_score']))
+    print('Eval time: %.1fs' % metrics_summary['eval_time'])
+
+    # Print per-class metrics.
+    print()
+    print('Per-class results:')
+    print('%-20s\t%-6s\t%-6s\t%-6s\t%-6s\t%-6s\t%-6s' % ('Object Class', 'AP', 'ATE', 'ASE', 'AOE', 'AVE', 'AAE'))
+    class_aps = metrics_summary['mean_dist_aps']
+    class_tps = metrics_summary['label_tp_errors']
+    for class_name in class_aps.keys():
+        print('%-20s\t%-6.3f\t%-6.3f\t%-6.3f\t%-6.3f\t%-6.3f\t%-6.3f'
+              % (class_name, class_aps[class_name],
+                 class_tps[class_name]['trans_err'],
+                 class_tps[class_name]['scale_err'],
+                 class_tps[class_name]['orient_err'],
+                 class_tps[class_name]['vel_err'],
+                 class_tps[class_name]['attr_err']))
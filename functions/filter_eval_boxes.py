@@ -1,14 +1,74 @@
 
+import copy
+import json
+from typing import List
+
+import numpy as np
 from nuscenes.eval.common.data_classes import EvalBoxes
 from nuscenes.eval.detection.data_classes import DetectionBox
 
+from classes.ColumnarBoxes import ColumnarBoxes
+
+
+def load_classes_filter(filter_path: str) -> dict[str, list[str]]:
+    """
+    Loads a classes filter JSON file.
+    :param filter_path: Path to the JSON filter file.
+    :return: A dict where the keys are new class names and the values are arrays with old class names.
+    """
+    with open(filter_path, mode='r') as json_file:
+        return json.load(json_file)
+
+
+def classes_lookup_table(class_names: List[str], classes_filter: dict[str, list[str]]) -> np.ndarray:
+    """
+    Builds the table that maps the class codes of ColumnarBoxes to the class codes after a classes filter.
+    :param class_names: Names of the classes, indexed by their codes.
+    :param classes_filter: A dict where the keys are new class names and the values are arrays with old class names that will be replaced by the new name. Old classes that not appear in the values will be removed.
+    :return: Array (len(class_names) + 1,) with the new code of each class code, where -1 means a removed class. The last entry maps the boxes already removed (code -1) to -1.
+    """
+    lookup_table = np.full(len(class_names) + 1, -1, dtype=np.int64)
+    for new_code, old_classes_list in enumerate(classes_filter.values()):
+        for old_class in old_classes_list:
+            if old_class in class_names:
+                lookup_table[class_names.index(old_class)] = new_code
+    return lookup_table
+
+
+def filter_columnar_boxes(boxes: ColumnarBoxes, classes_filter: dict[str, list[str]]) -> ColumnarBoxes:
+    """
+    Filter and rename boxes classes, without copying nor modifying the boxes.
+    :param boxes: ColumnarBoxes that will be filtered and renamed
+    :param classes_filter: A dict where the keys are new class names and the values are arrays with old class names that will be replaced by the new name. Old classes that not appear in the values will be removed.
+    :return: new ColumnarBoxes object sharing the box arrays, with the classes filtered and renamed.
+    """
+    return boxes.remap_classes(classes_lookup_table(boxes.class_names, classes_filter), list(classes_filter.keys()))
+
+
+def filter_columnar_boxes_multi(boxes: ColumnarBoxes,
+                                classes_filters: dict[str, dict[str, list[str]]]) -> dict[str, ColumnarBoxes]:
+    """
+    Applies several classes filters to the same boxes in one pass over the class codes.
+    :param boxes: ColumnarBoxes that will be filtered and renamed
+    :param classes_filters: Dict mapping a name (e.g. the filter file name) to a classes filter.
+    :return: Dict mapping each name to a new ColumnarBoxes object (sharing the box arrays) with the filter applied.
+    """
+    if not classes_filters:
+        return {}
+
+    lookup_tables = np.stack([classes_lookup_table(boxes.class_names, classes_filter)
+                              for classes_filter in classes_filters.values()])
+    class_codes = lookup_tables[:, boxes.class_codes]
+    return {name: boxes.with_class_codes(codes, list(classes_filter.keys()))
+            for codes, (name, classes_filter) in zip(class_codes, classes_filters.items())}
+
 
 def filter_eval_boxes(boxes: EvalBoxes, classes_filter: dict[str, list[str]]) -> EvalBoxes:
     """
     Filter and rename boxes classes
     :param boxes: EvalBoxes that will be filtered and renamed
     :param classes_filter: A dict where the keys are new class names and the values are arrays with old class names that will be replaced by the new name. Old classes that not appear in the values will be removed.
-    :return: new EvalBoxes object with the boxes filtered and renamed.
+    :return: new EvalBoxes object with the boxes filtered and renamed. The original boxes are not modified.
     """
     new_boxes = EvalBoxes()
     old_classes_to_new_classes_map: dict[str, str] = {}
@@ -22,8 +82,9 @@ def filter_eval_boxes(boxes: EvalBoxes, classes_filter: dict[str, list[str]]) ->
 
         for old_box in old_sample_boxes:
             if old_box.detection_name in old_classes_to_new_classes_map:
-                old_box.detection_name = old_classes_to_new_classes_map[old_box.detection_name]
-                new_sample_boxes.append(old_box)
+                new_box = copy.copy(old_box)
+                new_box.detection_name = old_classes_to_new_classes_map[old_box.detection_name]
+                new_sample_boxes.append(new_box)
 
         new_boxes.add_boxes(sample_token, new_sample_boxes)
     
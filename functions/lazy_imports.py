@@ -0,0 +1,58 @@
+import ast
+import importlib.util
+import sys
+from typing import List
+
+
+def skip_nuscenes_package_init() -> None:
+    """
+    Registers the `nuscenes` package without running its `__init__`, which imports the NuScenes class (and, through
+    it, scikit-learn and matplotlib.pyplot) even when only the evaluation modules are used. That is most of the import
+    time of the scripts. The `__init__` is run (once) when any name that is not a submodule is first taken from the
+    package (e.g. `from nuscenes import NuScenes`), so every name it defines can still be imported.
+    It must be called before any nuscenes module is imported (otherwise it does nothing), so the scripts call it in their
+    entry point (`if __name__ == "__main__":`), right before importing the modules that use the devkit.
+    """
+    if 'nuscenes' in sys.modules:
+        return
+    spec = importlib.util.find_spec('nuscenes')
+    if spec is None:
+        # Not installed: the next import fails with the usual error.
+        return
+
+    package = importlib.util.module_from_spec(spec)
+
+    def run_package_init(name: str):
+        if importlib.util.find_spec(f'nuscenes.{name}') is not None:
+            # A submodule that was not imported yet: the import system imports it.
+            raise AttributeError(f"module 'nuscenes' has no attribute '{name}'")
+        del package.__getattr__
+        spec.loader.exec_module(package)
+        return getattr(package, name)
+
+    package.__getattr__ = run_package_init
+    sys.modules['nuscenes'] = package
+
+
+def nuscenes_package_exports() -> List[str]:
+    """
+    Names defined by the `__init__` of the `nuscenes` package (its `__all__`, or the names it imports and assigns),
+    read from its source without running it.
+    :return: The names.
+    """
+    with open(importlib.util.find_spec('nuscenes').origin, 'r') as f:
+        tree = ast.parse(f.read())
+
+    names = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            names += [(alias.asname or alias.name).split('.')[0] for alias in node.names if alias.name != '*']
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.append(node.name)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id == '__all__':
+                    return list(ast.literal_eval(node.value))
+                if isinstance(target, ast.Name):
+                    names.append(target.id)
+    return names
@@ -1,16 +1,125 @@
-
 from nuscenes.eval.common.data_classes import EvalBoxes
+from nuscenes.eval.detection.data_classes import DetectionBox
+import glob
+import hashlib
 import json
+import os
+from typing import Callable
+
+import numpy as np
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.ColumnarBoxesBuilder import ColumnarBoxesBuilder
+from functions.load_predictions import JsonStreamReader
+from functions.save_boxes import load_boxes_sidecar
+
+
+def gts_cache_path(result_path: str) -> str:
+    """
+    Path of the binary cache of a GTs JSON file.
+    The cache is saved in a `.cache` folder next to the JSON file, and its name has a hash of the JSON file path,
+    modification time and size, so a modified JSON file will not use an outdated cache.
+    :param result_path: Path to the .json GTs file.
+    :return: Path to the .npz cache file.
+    """
+    stat = os.stat(result_path)
+    key = f'{os.path.abspath(result_path)}:{stat.st_mtime_ns}:{stat.st_size}'
+    key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(result_path)), '.cache')
+    return os.path.join(cache_dir, f'{os.path.basename(result_path)}.{key_hash}.npz')
+
+
+def save_gts_cache(gts: ColumnarBoxes, cache_path: str, verbose: bool = False) -> None:
+    """
+    Saves the GTs cache, removing outdated caches of the same JSON file.
+    Failing to write the cache (e.g. in a read-only directory) is not an error, the GTs just will not be cached.
+    :param gts: GT boxes.
+    :param cache_path: Path given by `gts_cache_path`.
+    :param verbose: Whether to print messages to stdout.
+    """
+    json_name = cache_path.rsplit('.', 2)[0]
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        for old_cache_path in glob.glob(glob.escape(json_name) + '.*.npz'):
+            os.remove(old_cache_path)
+
+        # Write to a temporary file first, so other processes never read a partial cache.
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        gts.save(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as error:
+        if verbose:
+            print(f'Could not save GTs cache to {cache_path}: {error}')
+
+
+def load_gts_columnar(result_path: str, max_boxes_per_sample: int, verbose: bool = False,
+                      use_cache: bool = True, sample_filter: Callable[[str], bool] = None) -> ColumnarBoxes:
+    """
+    Loads bounding boxes from GTs JSON file into a ColumnarBoxes, without creating DetectionBox objects.
+    :param result_path: Path to the .json result file provided by the user.
+    :param max_boxes_per_sample: Maximim number of boxes allowed per sample.
+    :param verbose: Whether to print messages to stdout.
+    :param use_cache: Whether to use a binary cache of the JSON file, which is much faster to load. The cache is
+        created in the first time the JSON file is loaded. A binary sidecar saved with the JSON file (see
+        `save_boxes_sidecar`) is also used as the cache.
+    :param sample_filter: Function that receives a sample token and returns whether the sample is loaded (see
+        `shard_sample_filter`). If not given, every sample is loaded. When the JSON file is read, only the boxes of the
+        loaded samples are kept in memory, and the cache is not created (it would only have some of the samples).
+    :return: ColumnarBoxes object with the GTs boxes.
+    """
+    cache_path = gts_cache_path(result_path) if use_cache else None
+    sidecar = load_boxes_sidecar(result_path) if use_cache else None
+
+    if sidecar is not None or (use_cache and os.path.exists(cache_path)):
+        if sidecar is not None:
+            all_results = sidecar[0]
+            source = 'binary sidecar'
+        else:
+            all_results = ColumnarBoxes.load(cache_path)
+            source = f'cached in {cache_path}'
+        if sample_filter is not None:
+            all_results = all_results.select_samples(np.array([sample_filter(sample_token)
+                                                               for sample_token in all_results.sample_tokens],
+                                                              dtype=bool))
+        if verbose:
+            print("Loaded results from {} ({}). Found detections for {} samples."
+                  .format(result_path, source, len(all_results.sample_tokens)))
+    else:
+        # Stream the file sample by sample, converting the boxes to arrays right away.
+        builder = ColumnarBoxesBuilder()
+        with open(result_path) as f:
+            for sample_token, boxes in JsonStreamReader(f).object_items():
+                if sample_filter is None or sample_filter(sample_token):
+                    builder.add_sample(sample_token, boxes)
+        all_results = builder.build()
+        if verbose:
+            print("Loaded results from {}. Found detections for {} samples."
+                  .format(result_path, len(all_results.sample_tokens)))
+
+        if use_cache and sample_filter is None:
+            save_gts_cache(all_results, cache_path, verbose=verbose)
+
+    # Check that each sample has no more than x predicted boxes.
+    assert np.all(np.diff(all_results.sample_offsets) <= max_boxes_per_sample), \
+        "Error: Only <= %d boxes per sample allowed!" % max_boxes_per_sample
+
+    return all_results
+
 
-def load_gts(result_path: str, max_boxes_per_sample: int, box_cls, verbose: bool = False) -> EvalBoxes:
+def load_gts(result_path: str, max_boxes_per_sample: int, box_cls, verbose: bool = False,
+             use_cache: bool = True) -> EvalBoxes:
     """
     Loads bounding boxes from GTs JSON file.
     :param result_path: Path to the .json result file provided by the user.
     :param max_boxes_per_sample: Maximim number of boxes allowed per sample.
     :param box_cls: Type of box to load, e.g. DetectionBox or TrackingBox.
     :param verbose: Whether to print messages to stdout.
+    :param use_cache: Whether to use a binary cache of the JSON file (only for DetectionBox), which is much faster
+        to load. The cache is created in the first time the JSON file is loaded.
     :return: EvalBoxes object with the GTs boxes.
     """
+    if use_cache and box_cls is DetectionBox:
+        return load_gts_columnar(result_path, max_boxes_per_sample, verbose=verbose).to_eval_boxes()
 
     # Load from file and check that the format is correct.
     with open(result_path) as f:
@@ -27,4 +136,4 @@ def load_gts(result_path: str, max_boxes_per_sample: int, box_cls, verbose: bool
         assert len(all_results.boxes[sample_token]) <= max_boxes_per_sample, \
             "Error: Only <= %d boxes per sample allowed!" % max_boxes_per_sample
 
-    return all_results
\ No newline at end of file
+    return all_results
@@ -0,0 +1,226 @@
+import json
+import re
+from typing import Any, Callable, Iterator, Tuple
+
+import numpy as np
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.ColumnarBoxesBuilder import ColumnarBoxesBuilder
+from functions.filter_eval_boxes import filter_columnar_boxes
+from functions.save_boxes import load_boxes_sidecar
+
+WHITESPACE = re.compile(r'\s*')
+
+
+class JsonStreamReader:
+    """
+    Minimal incremental JSON reader: it reads a file in chunks and decodes one value at a time, so a huge JSON object
+    can be traversed without loading the whole file (or all its decoded values) into memory.
+    """
+    def __init__(self, file, chunk_size: int = 1 << 20):
+        """
+        Initialize a JsonStreamReader object.
+        :param file: File opened in text mode.
+        :param chunk_size: Number of characters read from the file at once.
+        """
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_chunk(self) -> bool:
+        """
+        Reads the next chunk of the file, dropping the data already decoded from the buffer.
+        :return: False if the end of the file was reached.
+        """
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skips whitespaces and returns the next character, without consuming it.
+        :return: The next character, or an empty string at the end of the file.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._read_chunk():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char: str) -> None:
+        """
+        Consumes the next character, which must be the given one.
+        :param char: Expected character.
+        """
+        if self.peek() != char:
+            raise ValueError(f'Error: Expected "{char}" at position {self.pos} of the JSON buffer.')
+        self.pos += 1
+
+    def value(self) -> Any:
+        """
+        Decodes and consumes the next JSON value.
+        :return: The decoded value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value may continue in the next chunk.
+                if not self._read_chunk():
+                    raise
+                continue
+
+            # A number that ends with the buffer may be truncated, so it is only accepted with more data after it.
+            if end == len(self.buffer) and self._read_chunk():
+                continue
+
+            self.pos = end
+            return value
+
+    def object_items(self) -> Iterator[Tuple[str, Any]]:
+        """
+        Iterates over the items of the next JSON object, decoding one value at a time.
+        :return: Iterator of (key, value) pairs.
+        """
+        for key in self.iter_object():
+            yield key, self.value()
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        Iterates over the keys of the next JSON object. After each key, the caller must consume its value
+        (e.g. with `value`) before advancing the iterator.
+        :return: Iterator of the keys.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+def _read_results(result_path: str,
+                  max_boxes_per_sample: int,
+                  builder: ColumnarBoxesBuilder,
+                  sample_filter: Callable[[str], bool] = None) -> Tuple[dict, np.ndarray]:
+    """
+    Streams the `results` of a results JSON file (in the nuScenes format) sample by sample into a ColumnarBoxesBuilder.
+    :param result_path: Path to the .json result file provided by the user.
+    :param max_boxes_per_sample: Maximim number of boxes allowed per sample.
+    :param builder: Builder where the samples are added.
+    :param sample_filter: Function that receives a sample token and returns whether the sample is loaded. If not given,
+        every sample is loaded.
+    :return: The meta data and an array (n_loaded_samples,) with the position of each loaded sample in the `results`.
+    """
+    meta = None
+    found_results = False
+    positions = []
+
+    with open(result_path) as f:
+        reader = JsonStreamReader(f)
+        for key in reader.iter_object():
+            if key != 'results':
+                value = reader.value()
+                if key == 'meta':
+                    meta = value
+                continue
+
+            found_results = True
+            for position, (sample_token, boxes) in enumerate(reader.object_items()):
+                # Check that each sample has no more than x predicted boxes.
+                assert len(boxes) <= max_boxes_per_sample, \
+                    "Error: Only <= %d boxes per sample allowed!" % max_boxes_per_sample
+                if sample_filter is None or sample_filter(sample_token):
+                    builder.add_sample(sample_token, boxes)
+                    positions.append(position)
+
+    assert found_results, 'Error: No field `results` in result file. Please note that the result format changed.' \
+                          'See https://www.nuscenes.org/object-detection for more information.'
+    assert meta is not None, 'Error: No field `meta` in result file.'
+
+    return meta, np.array(positions, dtype=np.int64)
+
+
+def load_prediction_columnar(result_path: str,
+                             max_boxes_per_sample: int,
+                             classes_filter: dict[str, list[str]] = None,
+                             verbose: bool = False) -> Tuple[ColumnarBoxes, dict]:
+    """
+    Loads the predictions of a results JSON file (in the nuScenes format) into a ColumnarBoxes.
+    It is equivalent to the devkit `load_prediction` (followed by `filter_eval_boxes` if `classes_filter` is given),
+    but the `results` are streamed sample by sample directly into arrays, without keeping the whole JSON content or
+    DetectionBox objects in memory. If the file has a binary sidecar (see `save_boxes_sidecar`), it is read instead.
+    :param result_path: Path to the .json result file provided by the user.
+    :param max_boxes_per_sample: Maximim number of boxes allowed per sample.
+    :param classes_filter: A dict where the keys are new class names and the values are arrays with old class names
+        that will be replaced by the new name. Boxes of other classes are dropped. If not given, no filter is applied.
+    :param verbose: Whether to print messages to stdout.
+    :return: The predicted boxes and the meta data.
+    """
+    pred_boxes, meta, _ = load_prediction_shard(result_path, max_boxes_per_sample, classes_filter=classes_filter,
+                                                verbose=verbose)
+    return pred_boxes, meta
+
+
+def load_prediction_shard(result_path: str,
+                          max_boxes_per_sample: int,
+                          sample_filter: Callable[[str], bool] = None,
+                          classes_filter: dict[str, list[str]] = None,
+                          verbose: bool = False) -> Tuple[ColumnarBoxes, dict, np.ndarray]:
+    """
+    Loads the predictions of some samples of a results JSON file into a ColumnarBoxes, as `load_prediction_columnar`.
+    The boxes of the other samples are decoded while the file is streamed, but they are never kept in memory.
+    :param result_path: Path to the .json result file provided by the user.
+    :param max_boxes_per_sample: Maximim number of boxes allowed per sample.
+    :param sample_filter: Function that receives a sample token and returns whether the sample is loaded (see
+        `shard_sample_filter`). If not given, every sample is loaded.
+    :param classes_filter: A dict where the keys are new class names and the values are arrays with old class names
+        that will be replaced by the new name. Boxes of other classes are dropped. If not given, no filter is applied.
+    :param verbose: Whether to print messages to stdout.
+    :return: The predicted boxes, the meta data and an array (n_samples,) with the position of each loaded sample in
+        the results of the file, which is used to order the predictions of different shards as in the whole file.
+    """
+    sidecar = load_boxes_sidecar(result_path)
+    if sidecar is not None:
+        pred_boxes, meta = sidecar
+        assert np.all(np.diff(pred_boxes.sample_offsets) <= max_boxes_per_sample), \
+            "Error: Only <= %d boxes per sample allowed!" % max_boxes_per_sample
+        positions = np.arange(len(pred_boxes.sample_tokens))
+        if sample_filter is not None:
+            sample_mask = np.array([sample_filter(sample_token) for sample_token in pred_boxes.sample_tokens],
+                                   dtype=bool)
+            pred_boxes, positions = pred_boxes.select_samples(sample_mask), positions[sample_mask]
+        if classes_filter is not None:
+            pred_boxes = filter_columnar_boxes(pred_boxes, classes_filter)
+            pred_boxes = pred_boxes.select(pred_boxes.class_codes >= 0)
+
+        if verbose:
+            print("Loaded results from {} (binary sidecar). Found detections for {} samples."
+                  .format(result_path, len(pred_boxes.sample_tokens)))
+        return pred_boxes, meta, positions
+
+    builder = ColumnarBoxesBuilder(classes_filter)
+    meta, positions = _read_results(result_path, max_boxes_per_sample, builder, sample_filter)
+    pred_boxes = builder.build()
+
+    if verbose:
+        print("Loaded results from {}. Found detections for {} samples."
+              .format(result_path, len(pred_boxes.sample_tokens)))
+
+    return pred_boxes, meta, positions
@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+from nuscenes.eval.detection.data_classes import DetectionConfig
+
+from classes.ColumnarBoxes import ColumnarBoxes
+from classes.NuScenesSampleTable import NuScenesSampleTable
+from functions.load_predictions import load_prediction_columnar
+from functions.save_boxes import save_boxes_json, save_boxes_sidecar
+
+# Table and config used by the processes of `preprocess_prediction_files`. They are set before the processes are
+# forked, so the processes inherit them.
+_shared_preprocessing = None
+
+
+def nuscenes_table_cache_path(version: str) -> str:
+    """
+    Default path of the cached NuScenesSampleTable of a NuScenes version.
+    :param version: NuScenes version, e.g. v1.0-trainval.
+    :return: Path to the .npz cache file.
+    """
+    return os.path.join('.cache', f'nuscenes_{version}_samples.npz')
+
+
+def load_nuscenes_sample_table(version: str, dataroot: str, cache_path: str = None,
+                               verbose: bool = False) -> NuScenesSampleTable:
+    """
+    Loads the NuScenesSampleTable from its cache. In the first time (when there is no cache), the NuScenes database is
+    loaded to build the table, which is then saved to the cache.
+    :param version: NuScenes version, e.g. v1.0-trainval.
+    :param dataroot: NuScenes data directory.
+    :param cache_path: Path of the cache. If not given, `nuscenes_table_cache_path` is used.
+    :param verbose: Whether to print messages to stdout.
+    :return: The NuScenesSampleTable.
+    """
+    if cache_path is None:
+        cache_path = nuscenes_table_cache_path(version)
+
+    if os.path.exists(cache_path):
+        table = NuScenesSampleTable.load(cache_path)
+        assert table.version == version, \
+            f'Error: The cached table {cache_path} is from NuScenes {table.version}, not {version}!'
+        if verbose:
+            print(f'Loaded {table} from {cache_path}')
+        return table
+
+    # The NuScenes database is only needed to build the table.
+    from nuscenes import NuScenes
+    nusc = NuScenes(version=version, verbose=verbose, dataroot=dataroot)
+    table = NuScenesSampleTable.from_nuscenes(nusc)
+
+    # Write to a temporary file first, so other processes never read a partial cache.
+    if os.path.dirname(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    table.save(tmp_path)
+    os.replace(tmp_path, cache_path)
+    if verbose:
+        print(f'Saved {table} to {cache_path}')
+
+    return table
+
+
+def add_center_dist_columnar(boxes: ColumnarBoxes, table: NuScenesSampleTable) -> ColumnarBoxes:
+    """
+    Vectorized version of the devkit `add_center_dist`: sets the translation of each box to the ego vehicle.
+    :param boxes: Boxes of NuScenes samples. Their `ego_translation` is replaced.
+    :param table: NuScenesSampleTable with the samples of the boxes.
+    :return: The same boxes, augmented with the translation to the ego vehicle.
+    """
+    # Both boxes and ego pose are given in global coord system, so distance can be calculated directly.
+    sample_inds = table.sample_indices(boxes.sample_tokens)
+    boxes.ego_translation = boxes.translation - table.ego_translation[sample_inds[boxes.sample_index]]
+    return boxes
+
+
+def bike_rack_mask(boxes: ColumnarBoxes, table: NuScenesSampleTable, candidates: np.ndarray) -> np.ndarray:
+    """
+    Checks which boxes have their center inside a bicycle rack of their sample, as the devkit `points_in_box`.
+    :param boxes: Boxes of NuScenes samples.
+    :param table: NuScenesSampleTable with the samples of the boxes.
+    :param candidates: Indices of the boxes that will be checked.
+    :return: Boolean array (n_boxes,) which is True for the checked boxes inside a bicycle rack.
+    """
+    in_rack = np.zeros(len(boxes), dtype=bool)
+    sample_inds = table.sample_indices(boxes.sample_tokens)[boxes.sample_index[candidates]]
+    rack_starts = table.rack_offsets[sample_inds]
+    rack_counts = table.rack_offsets[sample_inds + 1] - rack_starts
+    if np.sum(rack_counts) == 0:
+        return in_rack
+
+    # One pair for each candidate box and each rack of its sample.
+    pair_boxes = np.repeat(candidates, rack_counts)
+    pair_firsts = np.repeat(np.cumsum(rack_counts) - rack_counts, rack_counts)
+    pair_racks = np.repeat(rack_starts, rack_counts) + np.arange(len(pair_boxes)) - pair_firsts
+
+    # Project the vector from the reference corner to the center onto each edge of the rack.
+    v = boxes.translation[pair_boxes] - table.rack_corners[pair_racks]
+    edges = table.rack_edges[pair_racks]
+    projections = np.einsum('pej,pj->pe', edges, v)
+    lengths = np.einsum('pej,pej->pe', edges, edges)
+    inside = np.all((0 <= projections) & (projections <= lengths), axis=1)
+
+    in_rack[pair_boxes[inside]] = True
+    return in_rack
+
+
+def filter_nuscenes_boxes(boxes: ColumnarBoxes,
+                          table: NuScenesSampleTable,
+                          max_dist: Dict[str, float],
+                          verbose: bool = False) -> ColumnarBoxes:
+    """
+    Vectorized version of the devkit `filter_eval_boxes`: applies the distance, points per box and bike-racks filters.
+    :param boxes: Boxes of NuScenes samples, with the translation to the ego vehicle (see `add_center_dist_columnar`).
+    :param table: NuScenesSampleTable with the samples of the boxes.
+    :param max_dist: Maps the detection name to the eval distance threshold for that class.
+    :param verbose: Whether to print to stdout.
+    :return: New ColumnarBoxes with the boxes that were not filtered out.
+    """
+    # Filter on distance first.
+    ego_dist = np.sqrt(np.sum(boxes.ego_translation[:, :2] ** 2, axis=1))
+    class_max_dist = np.array([max_dist[class_name] for class_name in boxes.class_names], dtype=np.float64)
+    keep = ego_dist < class_max_dist[boxes.class_codes]
+    dist_filter = np.count_nonzero(keep)
+
+    # Then remove boxes with zero points in them. Eval boxes have -1 points by default.
+    keep &= boxes.num_pts != 0
+    point_filter = np.count_nonzero(keep)
+
+    # Perform bike-rack filtering.
+    bikes = keep & (boxes.class_mask('bicycle') | boxes.class_mask('motorcycle'))
+    keep &= ~bike_rack_mask(boxes, table, np.flatnonzero(bikes))
+    bike_rack_filter = np.count_nonzero(keep)
+
+    if verbose:
+        print("=> Original number of boxes: %d" % len(boxes))
+        print("=> After distance based filtering: %d" % dist_filter)
+        print("=> After LIDAR and RADAR points based filtering: %d" % point_filter)
+        print("=> After bike rack filtering: %d" % bike_rack_filter)
+
+    return boxes.select(keep)
+
+
+def preprocess_prediction_file(input_path: str,
+                               output_path: str,
+                               table: NuScenesSampleTable,
+                               config: DetectionConfig,
+                               verbose: bool = False,
+                               indent: int = None,
+                               sidecar: bool = False) -> None:
+    """
+    Preprocesses (filters) a predictions JSON file as the NuScenes detection challenge does, without the NuScenes
+    database.
+    :param input_path: Path of the predictions JSON file.
+    :param output_path: Path to save the filtered predictions JSON file.
+    :param table: NuScenesSampleTable with the samples of the predictions.
+    :param config: A DetectionConfig object (with the `class_range` and `max_boxes_per_sample`).
+    :param verbose: Whether to print to stdout.
+    :param indent: Indentation of the JSON. If not given, the JSON is compact.
+    :param sidecar: Whether to also save a binary sidecar of the JSON, which the loaders read instead of the JSON.
+    """
+    boxes, meta = load_prediction_columnar(input_path, config.max_boxes_per_sample, verbose=verbose)
+    boxes = add_center_dist_columnar(boxes, table)
+    boxes = filter_nuscenes_boxes(boxes, table, config.class_range, verbose=verbose)
+
+    if verbose:
+        print(f'Saving JSON to {output_path}...')
+    save_boxes_json(boxes, output_path, meta=meta, indent=indent)
+    if sidecar:
+        save_boxes_sidecar(boxes, output_path, meta=meta)
+
+
+def _preprocess_shared_file(paths: Tuple[str, str]) -> str:
+    """
+    Runs `preprocess_prediction_file` with the table and config shared by `preprocess_prediction_files`.
+    :param paths: Tuple with the input and output paths.
+    :return: The output path.
+    """
+    table, config, verbose, indent, sidecar = _shared_preprocessing
+    preprocess_prediction_file(paths[0], paths[1], table, config, verbose=verbose, indent=indent, sidecar=sidecar)
+    return paths[1]
+
+
+def preprocess_prediction_files(paths: List[Tuple[str, str]],
+                                table: NuScenesSampleTable,
+                                config: DetectionConfig,
+                                workers: int = 1,
+                                verbose: bool = False,
+                                indent: int = None,
+                                sidecar: bool = False) -> None:
+    """
+    Runs `preprocess_prediction_file` for several files, which can be processed in parallel processes.
+    :param paths: List of (input_path, output_path) tuples.
+    :param table: NuScenesSampleTable with the samples of the predictions.
+    :param config: A DetectionConfig object (with the `class_range` and `max_boxes_per_sample`).
+    :param workers: Number of processes. If 1, the files are processed in the current process.
+    :param verbose: Whether to print to stdout.
+    :param indent: Indentation of the JSONs. If not given, the JSONs are compact.
+    :param sidecar: Whether to also save binary sidecars of the JSONs, which the loaders read instead of the JSONs.
+    """
+    global _shared_preprocessing
+
+    _shared_preprocessing = (table, config, verbose, indent, sidecar)
+    try:
+        if workers <= 1 or len(paths) <= 1:
+            for i, output_path in enumerate(map(_preprocess_shared_file, paths)):
+                print(f'Filtered {i+1}/{len(paths)}: {output_path}')
+        else:
+            with multiprocessing.get_context('fork').Pool(min(workers, len(paths))) as pool:
+                for i, output_path in enumerate(pool.imap(_preprocess_shared_file, paths)):
+                    print(f'Filtered {i+1}/{len(paths)}: {output_path}')
+    finally:
+        _shared_preprocessing = None
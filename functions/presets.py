@@ -0,0 +1,19 @@
+from typing import Optional, Tuple
+
+# Shortcuts that can be given instead of a GTs path, mapped to the GTs JSON file and the classes filter they use.
+GTS_PRESETS = {
+    'nuscenes_challenge': ('gts/detection_trainval_val.json', None),
+    'nuscenes_vrus-and-cars': ('gts/detection_trainval_val.json', 'filters/nuscenes_vrus-and-cars.json'),
+    'nuscenes_vrus': ('gts/detection_trainval_val.json', 'filters/nuscenes_vrus.json'),
+    'nuscenes_vrus-and-vehicles': ('gts/detection_trainval_val.json', 'filters/nuscenes_vrus-and-vehicles.json'),
+}
+
+
+def resolve_gts_preset(gts_path: str) -> Tuple[str, Optional[str]]:
+    """
+    Resolves a GTs path that may be a preset (see GTS_PRESETS).
+    :param gts_path: Path of the GTs JSON file or name of a preset.
+    :return: Tuple with the path of the GTs JSON file and the path of the classes filter of the preset (None if it is
+        not a preset or if the preset does not use a filter).
+    """
+    return GTS_PRESETS.get(gts_path, (gts_path, None))
@@ -1,6 +1,9 @@
 # Código adaptados de https://github.com/nutonomy/nuscenes-devkit/blob/master/python-sdk/nuscenes/eval/detection/render.py
 
-from typing import Any
+import json
+import multiprocessing
+import os
+from typing import Any, List, Tuple
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -10,6 +13,10 @@ from nuscenes.eval.detection.data_classes import DetectionMetrics, DetectionMetr
 
 Axis = Any
 
+# Evaluations rendered by the processes of `render_metrics`. They are set before the processes are forked, so the
+# processes inherit them instead of receiving a copy for each plot.
+_shared_evaluations = None
+
 def class_pr_curve(md_list: DetectionMetricDataList,
                    metrics: DetectionMetrics,
                    detection_name: str,
@@ -192,4 +199,131 @@ def summary_plot(md_list: DetectionMetricDataList,
 
     if savepath is not None:
         plt.savefig(savepath)
-        plt.close()
\ No newline at end of file
+        plt.close()
+
+
+def render_plot(md_list: DetectionMetricDataList,
+                metrics: DetectionMetrics,
+                plot_dir: str,
+                plot: str,
+                plot_arg: Any = None) -> None:
+    """
+    Renders one of the plots of an evaluation to a PDF file.
+    :param md_list: DetectionMetricDataList instance.
+    :param metrics: DetectionMetrics instance (with the config used in the evaluation).
+    :param plot_dir: Folder to save the plot to.
+    :param plot: Type of the plot: 'summary', 'class_pr', 'class_tp' or 'dist_pr'.
+    :param plot_arg: The class of 'class_pr' and 'class_tp' plots, or the distance threshold of 'dist_pr' plots.
+    """
+    cfg = metrics.cfg
+
+    def savepath(name):
+        return os.path.join(plot_dir, name + '.pdf')
+
+    detection_names = list(cfg.class_names)
+    pretty_detection_names = {}
+    detection_colors = {}
+    for i, detection_name in enumerate(detection_names):
+        detection_colors[detection_name] = f'C{i}'
+        pretty_detection_names[detection_name] = detection_name.replace('_', ' ').capitalize()
+
+    if plot == 'summary':
+        summary_plot(md_list, metrics, min_precision=cfg.min_precision, min_recall=cfg.min_recall,
+                     dist_th_tp=cfg.dist_th_tp, savepath=savepath('summary'), detection_names=detection_names, pretty_detection_names=pretty_detection_names)
+    elif plot == 'class_pr':
+        class_pr_curve(md_list, metrics, plot_arg, cfg.min_precision, cfg.min_recall,
+                       savepath=savepath(plot_arg + '_pr'), pretty_detection_names=pretty_detection_names)
+    elif plot == 'class_tp':
+        class_tp_curve(md_list, metrics, plot_arg, cfg.min_recall, cfg.dist_th_tp,
+                       savepath=savepath(plot_arg + '_tp'), pretty_detection_names=pretty_detection_names)
+    elif plot == 'dist_pr':
+        dist_pr_curve(md_list, metrics, plot_arg, cfg.min_precision, cfg.min_recall,
+                      savepath=savepath('dist_pr_' + str(plot_arg)), pretty_detection_names=pretty_detection_names, detection_colors=detection_colors)
+    else:
+        raise ValueError(f'Error: Unknown plot {plot}.')
+
+
+def plots_list(metrics: DetectionMetrics) -> List[Tuple[str, Any]]:
+    """
+    Lists the plots of an evaluation: the summary, the PR and TP curves of each class and the PR curves of each
+    distance threshold.
+    :param metrics: DetectionMetrics instance (with the config used in the evaluation).
+    :return: List of (plot, plot_arg) pairs, as used by `render_plot`.
+    """
+    plots = [('summary', None)]
+    for detection_name in metrics.cfg.class_names:
+        plots.append(('class_pr', detection_name))
+        plots.append(('class_tp', detection_name))
+    for dist_th in metrics.cfg.dist_ths:
+        plots.append(('dist_pr', dist_th))
+    return plots
+
+
+def init_render_process() -> None:
+    """ Uses a non-interactive backend in the rendering processes. """
+    plt.switch_backend('Agg')
+
+
+def _render_shared_plot(task: Tuple[int, str, Any]) -> None:
+    """
+    Renders one plot of the evaluations shared by `render_metrics`.
+    :param task: Tuple with the index of the evaluation, the plot and the plot argument.
+    """
+    evaluation_ind, plot, plot_arg = task
+    md_list, metrics, plot_dir = _shared_evaluations[evaluation_ind]
+    render_plot(md_list, metrics, plot_dir, plot, plot_arg)
+
+
+def render_metrics(evaluations: List[Tuple[DetectionMetricDataList, DetectionMetrics, str]], workers: int = 1) -> None:
+    """
+    Renders all plots of one or more evaluations. The plots are independent, so they can be rendered in parallel
+    processes (each one with the Agg backend of matplotlib).
+    :param evaluations: List of (md_list, metrics, plot_dir) tuples.
+    :param workers: Number of processes. If 1, the plots are rendered in the current process.
+    """
+    global _shared_evaluations
+
+    tasks = [(evaluation_ind, plot, plot_arg)
+             for evaluation_ind, (_, metrics, _) in enumerate(evaluations)
+             for plot, plot_arg in plots_list(metrics)]
+
+    _shared_evaluations = evaluations
+    try:
+        if workers <= 1:
+            for task in tasks:
+                _render_shared_plot(task)
+        else:
+            with multiprocessing.get_context('fork').Pool(min(workers, len(tasks)),
+                                                          initializer=init_render_process) as pool:
+                pool.map(_render_shared_plot, tasks, chunksize=1)
+    finally:
+        _shared_evaluations = None
+
+
+def load_rendering_data(output_dir: str) -> Tuple[DetectionMetricDataList, DetectionMetrics, str]:
+    """
+    Loads the data needed to render the plots of an evaluation from its output files (`metrics_summary.json` and
+    `metrics_details.json`), e.g. to render evaluations done with deferred rendering.
+    :param output_dir: Folder with the results of the evaluation.
+    :return: Tuple (md_list, metrics, plot_dir), as used by `render_metrics`.
+    """
+    with open(os.path.join(output_dir, 'metrics_summary.json')) as f:
+        metrics_summary = json.load(f)
+    metrics = DetectionMetrics.deserialize(metrics_summary)
+    # The serialized config has all classes of `class_range`, not only the evaluated (e.g. filtered) ones.
+    metrics.cfg.class_names = list(metrics_summary['label_aps'].keys())
+    with open(os.path.join(output_dir, 'metrics_details.json')) as f:
+        md_list = DetectionMetricDataList.deserialize(json.load(f))
+
+    plot_dir = os.path.join(output_dir, 'plots')
+    os.makedirs(plot_dir, exist_ok=True)
+    return md_list, metrics, plot_dir
+
+
+def render_output_dir(output_dir: str) -> None:
+    """
+    Renders all plots of an evaluation from its output files (see `load_rendering_data`).
+    It can run in a separate process while other evaluations run, since only the output path is sent to it.
+    :param output_dir: Folder with the results of the evaluation.
+    """
+    render_metrics([load_rendering_data(output_dir)])
@@ -0,0 +1,143 @@
+import json
+import math
+import os
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from classes.ColumnarBoxes import ColumnarBoxes
+
+
+def _float_json(value: float) -> str:
+    """
+    Encodes a float as `json.dump` does (including NaN and infinity, which are not standard JSON).
+    :param value: The float.
+    :return: The JSON representation.
+    """
+    if math.isfinite(value):
+        return repr(value)
+    if math.isnan(value):
+        return 'NaN'
+    return 'Infinity' if value > 0 else '-Infinity'
+
+
+def _floats_json(values: np.ndarray) -> List[str]:
+    """
+    Encodes the rows of an array as JSON lists of floats.
+    :param values: Array (n, d) of floats.
+    :return: List with the JSON list of each row.
+    """
+    return ['[' + ','.join(map(_float_json, row)) + ']' for row in values.tolist()]
+
+
+def _sample_boxes_json(boxes: ColumnarBoxes) -> Iterator[Tuple[str, str]]:
+    """
+    Encodes the boxes of each sample as compact JSON directly from the box arrays, with the same fields of the
+    DetectionBox `serialize`. Boxes of dropped classes are skipped.
+    :param boxes: The boxes.
+    :return: Iterator of (sample_token, JSON list with the sample boxes) pairs.
+    """
+    keep = boxes.class_codes >= 0
+    class_names = [json.dumps(class_name) for class_name in boxes.class_names]
+    attribute_names = [json.dumps(attribute_name) for attribute_name in boxes.attribute_names]
+    fields = zip(_floats_json(boxes.translation[keep]),
+                 _floats_json(boxes.size[keep]),
+                 _floats_json(boxes.rotation[keep]),
+                 _floats_json(boxes.velocity[keep]),
+                 _floats_json(boxes.ego_translation[keep]),
+                 boxes.num_pts[keep].tolist(),
+                 boxes.class_codes[keep].tolist(),
+                 map(_float_json, boxes.detection_score[keep].tolist()),
+                 boxes.attribute_codes[keep].tolist())
+
+    sample_sizes = np.diff(np.concatenate([[0], np.cumsum(keep, dtype=np.int64)])[boxes.sample_offsets])
+    for sample_token, sample_size in zip(boxes.sample_tokens, sample_sizes.tolist()):
+        token = json.dumps(sample_token)
+        sample_boxes = []
+        for _ in range(sample_size):
+            translation, size, rotation, velocity, ego_translation, num_pts, class_code, score, attribute_code = \
+                next(fields)
+            sample_boxes.append(
+                f'{{"sample_token":{token},"translation":{translation},"size":{size},"rotation":{rotation},'
+                f'"velocity":{velocity},"ego_translation":{ego_translation},"num_pts":{num_pts},'
+                f'"detection_name":{class_names[class_code]},"detection_score":{score},'
+                f'"attribute_name":{attribute_names[attribute_code]}}}')
+        yield sample_token, '[' + ','.join(sample_boxes) + ']'
+
+
+def save_boxes_json(boxes: ColumnarBoxes, path: str, meta: dict = None, indent: int = None) -> None:
+    """
+    Saves boxes to a JSON file, in the GTs format or, if `meta` is given, in the nuScenes results format.
+    By default the JSON is compact (without indentation) and written directly from the box arrays, which is much
+    faster (and the file much smaller) than serializing DetectionBox objects with indentation.
+    :param boxes: The boxes.
+    :param path: Path of the JSON file.
+    :param meta: Meta data of the predictions. If not given, the boxes are saved in the GTs format.
+    :param indent: Indentation of the JSON. If given, the (slower) `json.dump` is used to indent it.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w', encoding='utf-8') as file:
+        if indent is not None:
+            results = {sample_token: json.loads(sample_json) for sample_token, sample_json in _sample_boxes_json(boxes)}
+            json.dump(results if meta is None else {'results': results, 'meta': meta}, file, ensure_ascii=False,
+                      indent=indent)
+            return
+
+        if meta is not None:
+            file.write('{"meta":' + json.dumps(meta, ensure_ascii=False) + ',"results":')
+        file.write('{')
+        for i, (sample_token, sample_json) in enumerate(_sample_boxes_json(boxes)):
+            file.write((',' if i > 0 else '') + json.dumps(sample_token) + ':' + sample_json)
+        file.write('}')
+        if meta is not None:
+            file.write('}')
+
+
+def boxes_sidecar_path(json_path: str) -> str:
+    """
+    Path of the binary sidecar of a boxes JSON file, saved next to it.
+    :param json_path: Path of the JSON file.
+    :return: Path of the .npz sidecar file.
+    """
+    return os.path.splitext(json_path)[0] + '.boxes.npz'
+
+
+def save_boxes_sidecar(boxes: ColumnarBoxes, json_path: str, meta: dict = None) -> None:
+    """
+    Saves a binary sidecar with the same boxes of a JSON file (already saved), which the loaders read instead of the
+    JSON. The sidecar records the size and modification time of the JSON file, so it is ignored if the JSON changes.
+    :param boxes: The boxes saved in the JSON file.
+    :param json_path: Path of the JSON file.
+    :param meta: Meta data of the predictions, if the JSON is in the nuScenes results format.
+    """
+    if np.any(boxes.class_codes < 0):
+        boxes = boxes.select(boxes.class_codes >= 0)
+    stat = os.stat(json_path)
+    metadata = {'json_size': stat.st_size, 'json_mtime_ns': stat.st_mtime_ns, 'meta': meta}
+
+    # Write to a temporary file first, so the loaders never read a partial sidecar.
+    sidecar_path = boxes_sidecar_path(json_path)
+    tmp_path = f'{sidecar_path}.{os.getpid()}.tmp'
+    boxes.save(tmp_path, metadata=metadata)
+    os.replace(tmp_path, sidecar_path)
+
+
+def load_boxes_sidecar(json_path: str) -> Optional[Tuple[ColumnarBoxes, Optional[dict]]]:
+    """
+    Loads the binary sidecar of a JSON file, if there is one and the JSON file was not modified after it was saved.
+    :param json_path: Path of the JSON file.
+    :return: The boxes and the meta data of the predictions (None for GTs), or None if there is no valid sidecar.
+    """
+    sidecar_path = boxes_sidecar_path(json_path)
+    if not os.path.exists(sidecar_path):
+        return None
+
+    metadata = ColumnarBoxes.load_metadata(sidecar_path)
+    stat = os.stat(json_path)
+    if metadata is None or (metadata.get('json_size'), metadata.get('json_mtime_ns')) != \
+            (stat.st_size, stat.st_mtime_ns):
+        return None
+
+    return ColumnarBoxes.load(sidecar_path), metadata['meta']
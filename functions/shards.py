@@ -0,0 +1,36 @@
+import hashlib
+import json
+from typing import Callable
+
+
+def sample_shard(sample_token: str, num_shards: int) -> int:
+    """
+    Shard of a sample when the samples are split by hash. The hash only depends on the token (unlike the built-in
+    `hash`, which changes between processes), so every node assigns each sample to the same shard.
+    :param sample_token: Token of the sample.
+    :param num_shards: Number of shards.
+    :return: Index of the shard of the sample, in [0, num_shards).
+    """
+    digest = hashlib.md5(sample_token.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little') % num_shards
+
+
+def shard_sample_filter(shard_index: int = None, num_shards: int = None,
+                        samples_path: str = None) -> Callable[[str], bool]:
+    """
+    Function that selects the samples of a shard, which can be given to the loaders of the boxes.
+    :param shard_index: Index of the shard, when the samples are split by hash (see `sample_shard`).
+    :param num_shards: Number of shards, when the samples are split by hash.
+    :param samples_path: Path of a JSON file with the list of sample tokens of the shard. If given, the samples are not
+        split by hash.
+    :return: Function that receives a sample token and returns whether the sample is in the shard.
+    """
+    if samples_path is not None:
+        with open(samples_path, 'r') as f:
+            sample_tokens = set(json.load(f))
+        return lambda sample_token: sample_token in sample_tokens
+
+    assert num_shards is not None and num_shards > 0, 'Error: The number of shards must be positive!'
+    assert shard_index is not None and 0 <= shard_index < num_shards, \
+        'Error: The shard index must be in [0, num_shards)!'
+    return lambda sample_token: sample_shard(sample_token, num_shards) == shard_index
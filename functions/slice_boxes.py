@@ -0,0 +1,68 @@
+import json
+from typing import Dict, List
+
+import numpy as np
+
+from classes.ColumnarBoxes import ColumnarBoxes
+
+# Criteria a slice may use. A box is in a slice if it meets every criterion of the slice.
+SLICE_CRITERIA = ('ego_dist', 'attributes', 'class_names')
+
+
+def load_slices(slices_path: str) -> Dict[str, dict]:
+    """
+    Loads a slices JSON file and checks its criteria.
+    :param slices_path: Path to the JSON slices file.
+    :return: A dict where the keys are the slice names and the values are dicts with the criteria of each slice:
+        - ego_dist: [min, max] distance (in meters, in the xy plane) of the box to the ego vehicle, including the min and
+          excluding the max. A null max means no maximum.
+        - attributes: Names of the attributes of the boxes in the slice.
+        - class_names: Classes evaluated in the slice. The boxes of other classes are left out of it.
+    """
+    with open(slices_path, mode='r') as json_file:
+        slices = json.load(json_file)
+
+    for slice_name, criteria in slices.items():
+        assert slice_name not in ('', '.', '..') and '/' not in slice_name, \
+            f'Error: The slice name {slice_name} must be a valid folder name!'
+        unknown = set(criteria) - set(SLICE_CRITERIA)
+        assert len(unknown) == 0, f'Error: Unknown criteria {sorted(unknown)} in slice {slice_name}!'
+        if 'ego_dist' in criteria:
+            assert len(criteria['ego_dist']) == 2, f'Error: The ego_dist of slice {slice_name} must be [min, max]!'
+    return slices
+
+
+def slice_masks(boxes: ColumnarBoxes, slices: Dict[str, dict]) -> np.ndarray:
+    """
+    Selects the boxes of each slice. Predictions are selected by their own fields (e.g. the predicted attribute), so
+    each slice is evaluated as if the GTs and predictions were filtered by its criteria before the evaluation.
+    :param boxes: Boxes that will be sliced. The ego distance criterion uses their `ego_translation`.
+    :param slices: Slices loaded with `load_slices`.
+    :return: Boolean array (n_slices, n_boxes) which is True for the boxes of each slice.
+    """
+    masks = np.ones((len(slices), len(boxes)), dtype=bool)
+    ego_dist = None
+    for mask, criteria in zip(masks, slices.values()):
+        if 'ego_dist' in criteria:
+            if ego_dist is None:
+                # Same as the devkit `ego_dist` property.
+                ego_dist = np.sqrt(np.sum(boxes.ego_translation[:, :2] ** 2, axis=1))
+            min_dist, max_dist = criteria['ego_dist']
+            mask &= ego_dist >= min_dist
+            if max_dist is not None:
+                mask &= ego_dist < max_dist
+        if 'attributes' in criteria:
+            mask &= np.isin(boxes.attribute_codes, _name_codes(boxes.attribute_names, criteria['attributes']))
+        if 'class_names' in criteria:
+            mask &= np.isin(boxes.class_codes, _name_codes(boxes.class_names, criteria['class_names']))
+    return masks
+
+
+def _name_codes(names: List[str], selected_names: List[str]) -> List[int]:
+    """
+    Returns the codes of some names, ignoring the names that are not in the list.
+    :param names: Names, indexed by their codes.
+    :param selected_names: Names whose codes are returned.
+    :return: Codes of the selected names.
+    """
+    return [code for code, name in enumerate(names) if name in selected_names]
@@ -0,0 +1,196 @@
+from typing import List
+
+import numpy as np
+from nuscenes.eval.detection.constants import DETECTION_NAMES
+
+from classes.ColumnarBoxes import ColumnarBoxes
+
+# Typical size (width, length, height) of the boxes of each class.
+CLASS_SIZES = {
+    'car': (1.9, 4.6, 1.7),
+    'truck': (2.5, 6.9, 2.8),
+    'bus': (2.9, 11.0, 3.5),
+    'trailer': (2.9, 12.3, 3.9),
+    'construction_vehicle': (2.8, 6.4, 3.2),
+    'pedestrian': (0.7, 0.7, 1.8),
+    'motorcycle': (0.8, 2.1, 1.5),
+    'bicycle': (0.6, 1.7, 1.3),
+    'traffic_cone': (0.4, 0.4, 1.1),
+    'barrier': (2.5, 0.5, 1.0),
+}
+
+# Attributes that the boxes of each class may have (classes without attributes have an empty attribute).
+CLASS_ATTRIBUTES = {
+    'car': ['vehicle.moving', 'vehicle.parked', 'vehicle.stopped'],
+    'truck': ['vehicle.moving', 'vehicle.parked', 'vehicle.stopped'],
+    'bus': ['vehicle.moving', 'vehicle.parked', 'vehicle.stopped'],
+    'trailer': ['vehicle.moving', 'vehicle.parked', 'vehicle.stopped'],
+    'construction_vehicle': ['vehicle.moving', 'vehicle.parked', 'vehicle.stopped'],
+    'pedestrian': ['pedestrian.moving', 'pedestrian.sitting_lying_down', 'pedestrian.standing'],
+    'motorcycle': ['cycle.with_rider', 'cycle.without_rider'],
+    'bicycle': ['cycle.with_rider', 'cycle.without_rider'],
+    'traffic_cone': [''],
+    'barrier': [''],
+}
+
+
+def _yaw_quaternions(yaws: np.ndarray) -> np.ndarray:
+    """
+    Quaternions of rotations around the z axis.
+    :param yaws: Array (n,) with the yaw angles in radians.
+    :return: Array (n, 4) with the quaternions (w, x, y, z).
+    """
+    rotation = np.zeros((len(yaws), 4))
+    rotation[:, 0] = np.cos(yaws / 2)
+    rotation[:, 3] = np.sin(yaws / 2)
+    return rotation
+
+
+def _random_attributes(rng: np.random.Generator, class_names: List[str], class_codes: np.ndarray,
+                       attribute_names: List[str]) -> np.ndarray:
+    """
+    Draws a valid attribute for each box.
+    :param rng: Random generator.
+    :param class_names: Names of the classes.
+    :param class_codes: Array (n,) with the class code of each box.
+    :param attribute_names: Names of the attributes.
+    :return: Array (n,) with the attribute code of each box.
+    """
+    attribute_codes = np.zeros(len(class_codes), dtype=np.int64)
+    for class_code, class_name in enumerate(class_names):
+        mask = class_codes == class_code
+        class_attributes = [attribute_names.index(name) for name in CLASS_ATTRIBUTES[class_name]]
+        attribute_codes[mask] = rng.choice(class_attributes, size=np.count_nonzero(mask))
+    return attribute_codes
+
+
+def generate_synthetic_gts(n_samples: int,
+                           boxes_per_sample: int,
+                           class_names: List[str] = None,
+                           seed: int = 0) -> ColumnarBoxes:
+    """
+    Generates random GT boxes, in the same format of the GTs of the NuScenes detection challenge.
+    :param n_samples: Number of samples.
+    :param boxes_per_sample: Mean number of boxes per sample (each sample has between 0 and twice this number).
+    :param class_names: Classes of the boxes (NuScenes detection classes). If not given, all of them are used.
+    :param seed: Seed of the random generator.
+    :return: The GT boxes.
+    """
+    rng = np.random.default_rng(seed)
+    class_names = list(DETECTION_NAMES) if class_names is None else list(class_names)
+    attribute_names = sorted({name for class_name in class_names for name in CLASS_ATTRIBUTES[class_name]})
+
+    sample_sizes = rng.integers(0, 2 * boxes_per_sample + 1, size=n_samples)
+    sample_offsets = np.concatenate([[0], np.cumsum(sample_sizes)]).astype(np.int64)
+    n_boxes = int(sample_offsets[-1])
+
+    # Boxes around the ego vehicle of each sample.
+    ego_positions = np.column_stack([rng.uniform(0, 2000, size=(n_samples, 2)), np.zeros(n_samples)])
+    ego_translation = np.column_stack([rng.uniform(-50, 50, size=(n_boxes, 2)), rng.normal(1, 0.5, size=n_boxes)])
+    translation = ego_positions[np.repeat(np.arange(n_samples), sample_sizes)] + ego_translation
+
+    class_codes = rng.integers(0, len(class_names), size=n_boxes)
+    base_sizes = np.array([CLASS_SIZES[class_name] for class_name in class_names])
+    size = base_sizes[class_codes] * rng.lognormal(0, 0.1, size=(n_boxes, 3))
+
+    # As in NuScenes, some GTs do not have a velocity.
+    velocity = rng.normal(0, 3, size=(n_boxes, 2))
+    velocity[rng.random(n_boxes) < 0.05] = np.nan
+
+    return ColumnarBoxes(sample_tokens=[f'{i:032x}' for i in range(n_samples)],
+                         sample_offsets=sample_offsets,
+                         translation=np.round(translation, 3),
+                         size=size,
+                         rotation=_yaw_quaternions(rng.uniform(-np.pi, np.pi, size=n_boxes)),
+                         velocity=velocity,
+                         ego_translation=ego_translation,
+                         num_pts=rng.integers(1, 200, size=n_boxes),
+                         detection_score=np.full(n_boxes, -1.0),
+                         class_codes=class_codes,
+                         class_names=class_names,
+                         attribute_codes=_random_attributes(rng, class_names, class_codes, attribute_names),
+                         attribute_names=attribute_names)
+
+
+def generate_synthetic_predictions(gt_boxes: ColumnarBoxes,
+                                   noise: float = 0.5,
+                                   recall: float = 0.8,
+                                   false_positives_per_sample: int = 10,
+                                   max_boxes_per_sample: int = 500,
+                                   seed: int = 0) -> ColumnarBoxes:
+    """
+    Generates random predictions of GT boxes: noisy copies of some GTs (with higher scores for smaller errors) and
+    random false positives (with lower scores).
+    :param gt_boxes: GT boxes generated by `generate_synthetic_gts`.
+    :param noise: Standard deviation (in meters) of the center error of the predictions of GTs. The other errors are
+        proportional to it.
+    :param recall: Fraction of the GTs that are predicted.
+    :param false_positives_per_sample: Mean number of false positives per sample.
+    :param max_boxes_per_sample: Maximum number of predictions per sample.
+    :param seed: Seed of the random generator.
+    :return: The predicted boxes, with the same samples of the GTs.
+    """
+    rng = np.random.default_rng(seed + 1)
+    n_samples = len(gt_boxes.sample_tokens)
+
+    # Predictions of GTs.
+    detected = np.flatnonzero(rng.random(len(gt_boxes)) < recall)
+    center_error = rng.normal(0, noise, size=(len(detected), 2))
+    translation = gt_boxes.translation[detected].copy()
+    translation[:, :2] += center_error
+    size = gt_boxes.size[detected] * rng.lognormal(0, noise / 5, size=(len(detected), 3))
+    yaws = 2 * np.arctan2(gt_boxes.rotation[detected, 3], gt_boxes.rotation[detected, 0])
+    velocity = np.nan_to_num(gt_boxes.velocity[detected]) + rng.normal(0, noise, size=(len(detected), 2))
+    scores = np.exp(-np.linalg.norm(center_error, axis=1) / (2 * noise + 1e-9)) * rng.uniform(0.5, 1, len(detected))
+    attribute_codes = gt_boxes.attribute_codes[detected].copy()
+    wrong_attributes = rng.random(len(detected)) < 0.1
+    attribute_codes[wrong_attributes] = _random_attributes(rng, gt_boxes.class_names,
+                                                           gt_boxes.class_codes[detected][wrong_attributes],
+                                                           gt_boxes.attribute_names)
+
+    # False positives, anywhere around the ego vehicle.
+    fp_sizes = rng.integers(0, 2 * false_positives_per_sample + 1, size=n_samples)
+    fp_samples = np.repeat(np.arange(n_samples), fp_sizes)
+    n_fps = len(fp_samples)
+    sample_centers = np.zeros((n_samples, 3))
+    has_gts = np.diff(gt_boxes.sample_offsets) > 0
+    sample_centers[has_gts] = gt_boxes.translation[gt_boxes.sample_offsets[:-1][has_gts]] - \
+        gt_boxes.ego_translation[gt_boxes.sample_offsets[:-1][has_gts]]
+    fp_class_codes = rng.integers(0, len(gt_boxes.class_names), size=n_fps)
+    base_sizes = np.array([CLASS_SIZES[class_name] for class_name in gt_boxes.class_names])
+
+    samples = np.concatenate([gt_boxes.sample_index[detected], fp_samples])
+    class_codes = np.concatenate([gt_boxes.class_codes[detected], fp_class_codes])
+    fields = {
+        'translation': np.concatenate([translation, sample_centers[fp_samples] + np.column_stack(
+            [rng.uniform(-50, 50, size=(n_fps, 2)), rng.normal(1, 0.5, size=n_fps)])]),
+        'size': np.concatenate([size, base_sizes[fp_class_codes] * rng.lognormal(0, 0.2, size=(n_fps, 3))]),
+        'rotation': _yaw_quaternions(np.concatenate([yaws + rng.normal(0, noise / 2, size=len(detected)),
+                                                     rng.uniform(-np.pi, np.pi, size=n_fps)])),
+        'velocity': np.concatenate([velocity, rng.normal(0, 3, size=(n_fps, 2))]),
+        'detection_score': np.round(np.concatenate([scores, rng.uniform(0, 0.5, size=n_fps)]), 4),
+        'attribute_codes': np.concatenate([attribute_codes, _random_attributes(rng, gt_boxes.class_names,
+                                                                               fp_class_codes,
+                                                                               gt_boxes.attribute_names)]),
+    }
+
+    # Group the predictions by sample (shuffled inside each sample), with at most max_boxes_per_sample per sample.
+    order = np.lexsort([rng.random(len(samples)), samples])
+    rank_in_sample = np.arange(len(order)) - np.searchsorted(samples[order], samples[order])
+    order = order[rank_in_sample < max_boxes_per_sample]
+    sample_offsets = np.searchsorted(samples[order], np.arange(n_samples + 1)).astype(np.int64)
+
+    ego_positions = sample_centers[samples[order]]
+    return ColumnarBoxes(sample_tokens=list(gt_boxes.sample_tokens),
+                         sample_offsets=sample_offsets,
+                         translation=fields['translation'][order],
+                         size=fields['size'][order],
+                         rotation=fields['rotation'][order],
+                         velocity=fields['velocity'][order],
+                         ego_translation=fields['translation'][order] - ego_positions,
+                         num_pts=np.full(len(order), -1, dtype=np.int64),
+                         detection_score=fields['detection_score'][order],
+                         class_codes=class_codes[order],
+                         class_names=list(gt_boxes.class_names),
+                         attribute_codes=fields['attribute_codes'][order],
+                         attribute_names=list(gt_boxes.attribute_names))
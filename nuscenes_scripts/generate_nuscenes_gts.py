@@ -1,13 +1,16 @@
 
 import argparse
+import sys
 from nuscenes.eval.common.loaders import load_gt, add_center_dist, filter_eval_boxes
 from nuscenes import NuScenes
 from nuscenes.eval.detection.data_classes import DetectionBox
-import json
-import numpy as np
 from nuscenes.eval.common.config import config_factory
 import os
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from classes.ColumnarBoxes import ColumnarBoxes
+from functions.save_boxes import save_boxes_json, save_boxes_sidecar
+
 '''
 Esse script tem como objetivo gerar um JSON das GTs da NuScenes.
 Este JSON poderá ser usado para avaliar algum modelo na base da NuScenes posteriormente utilizando ../eval.py
@@ -27,6 +30,10 @@ if __name__ == "__main__":
                         help='Whether to print to stdout.')
     parser.add_argument('--save_path', type=str, default='',
                         help='Where the JSON with GTs will be saved. If not specified, it will be saved in this path: gts/detection_<version>_<eval_set>.json')
+    parser.add_argument('--indent', type=int, default=0,
+                        help='Indentation of the saved JSON. If 0, the JSON is compact (much smaller and faster to write and read).')
+    parser.add_argument('--sidecar', type=int, default=0,
+                        help='Whether to also save a binary sidecar (<json name>.boxes.npz) next to the JSON, which is loaded instead of the JSON by the evaluation scripts.')
     
     args = parser.parse_args()
 
@@ -35,6 +42,8 @@ if __name__ == "__main__":
     version_ = args.version
     verbose_ = bool(args.verbose)
     save_path_ = args.save_path
+    indent_ = args.indent or None
+    sidecar_ = bool(args.sidecar)
 
     nusc_ = NuScenes(version=version_, verbose=verbose_, dataroot=dataroot_)
     gts = load_gt(nusc_, eval_split=eval_set_, box_cls=DetectionBox, verbose=verbose_)
@@ -44,24 +53,12 @@ if __name__ == "__main__":
     gts = add_center_dist(nusc_, gts)
     gts = filter_eval_boxes(nusc_, gts, config_factory('detection_cvpr_2019').class_range, verbose=verbose_)
     
-    if verbose_:
-        print('Serializing GTs to JSON...')
-    gts_json = gts.serialize()
-
-    # Converte para lista os objetos que não podem ser colocados em um .JSON
-    for key, boxes in gts_json.items():
-        for box in boxes:
-            for key, value in box.items():
-                if isinstance(value, tuple):
-                    box[key] = list(value)
-                elif isinstance(value, np.ndarray):
-                    box[key] = value.tolist()
-    
     if verbose_:
         print('Saving JSON to disk...')
 
     if save_path_ == '':
         save_path_ = os.path.join('gts', f'detection_{version_[5:]}_{eval_set_}.json')
-    os.makedirs(os.path.dirname(save_path_), exist_ok=True)
-    with open(save_path_, 'w', encoding='utf-8') as file:
-        json.dump(gts_json, file, ensure_ascii=False, indent=4)
+    gts = ColumnarBoxes.from_eval_boxes(gts)
+    save_boxes_json(gts, save_path_, indent=indent_)
+    if sidecar_:
+        save_boxes_sidecar(gts, save_path_)
@@ -1,12 +1,12 @@
 
 import argparse
-from nuscenes.eval.common.loaders import add_center_dist, filter_eval_boxes, load_prediction
-from nuscenes import NuScenes
-from nuscenes.eval.detection.data_classes import DetectionBox
 import json
-import numpy as np
-from nuscenes.eval.common.config import config_factory
 import os
+import sys
+from nuscenes.eval.common.config import config_factory
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.preprocess_nuscenes_boxes import load_nuscenes_sample_table, preprocess_prediction_files
 
 '''
 Esse script tem como objetivo pré-processar (filtar) um conjunto de resultados de previsões para a base de dados NuScenes.
@@ -30,6 +30,14 @@ if __name__ == "__main__":
                         help='Whether to print to stdout.')
     parser.add_argument('--dataroot', type=str, default='data/nuscenes',
                         help='Default nuScenes data directory.')
+    parser.add_argument('--indent', type=int, default=0,
+                        help='Indentation of the saved JSON. If 0, the JSON is compact (much smaller and faster to write and read).')
+    parser.add_argument('--sidecar', type=int, default=0,
+                        help='Whether to also save a binary sidecar (<json name>.boxes.npz) next to the JSON, which is loaded instead of the JSON by the evaluation scripts.')
+    parser.add_argument('--cache_path', type=str, default='',
+                        help='Path of the cached table with the NuScenes data needed by the preprocessing (ego poses and bicycle racks). It is created in the first run, so the NuScenes database is not loaded again. If not specified, it will be saved in .cache/nuscenes_<version>_samples.npz')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to preprocess the files in parallel.')
 
     args = parser.parse_args()
 
@@ -39,49 +47,25 @@ if __name__ == "__main__":
     version = args.version
     dataroot = args.dataroot
 
-    nusc = NuScenes(version=version, verbose=verbose, dataroot=dataroot)
+    cache_path = args.cache_path or None
+    indent = args.indent or None
+    sidecar = bool(args.sidecar)
+    workers = args.workers
+
+    table = load_nuscenes_sample_table(version, dataroot, cache_path=cache_path, verbose=verbose)
 
     cfg = config_factory('detection_cvpr_2019')
 
     with open(input_path, 'r') as f:
         infers_set = json.load(f)
-    
-    for i, infer_info in enumerate(infers_set):
-        print(f'Filtering {i+1}/{len(infers_set)}')
 
+    paths = []
+    for infer_info in infers_set:
         infer_path = infer_info['infer_path']
-
-        boxes, meta = load_prediction(infer_path, cfg.max_boxes_per_sample, DetectionBox, verbose=verbose)
-        boxes = add_center_dist(nusc, boxes)
-        boxes = filter_eval_boxes(nusc, boxes, cfg.class_range, verbose=verbose)
-
-        if verbose:
-            print('Serializing GTs to JSON...')
-        boxes_json = boxes.serialize()
-
-        # Converte para lista os objetos que não podem ser colocados em um .JSON
-        for key, boxes in boxes_json.items():
-            for box in boxes:
-                for key, value in box.items():
-                    if isinstance(value, tuple):
-                        box[key] = list(value)
-                    elif isinstance(value, np.ndarray):
-                        box[key] = value.tolist()
-        
-
-        gts_json_final = {
-            'results': boxes_json,
-            'meta': meta
-        }
-        
-        if verbose:
-            print('Saving JSON to disk...')
-
         if not use_save_paths:
             output_path = f'{infer_path[:-5]}_filtered.json'
         else:
             output_path = infer_info['save_path']
-        
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, 'w', encoding='utf-8') as file:
-            json.dump(gts_json_final, file, ensure_ascii=False, indent=4)
\ No newline at end of file
+        paths.append((infer_path, output_path))
+
+    preprocess_prediction_files(paths, table, cfg, workers=workers, verbose=verbose, indent=indent, sidecar=sidecar)
@@ -0,0 +1,65 @@
+import argparse
+import glob
+import os
+import sys
+from functions.lazy_imports import skip_nuscenes_package_init
+
+
+'''
+Combina os resultados parciais dos shards de uma avaliação distribuída (salvos pelo `eval.py` com `--num_shards` ou `--shard_samples_path`) nas métricas finais
+'''
+if __name__ == "__main__":
+
+    # Settings.
+    parser = argparse.ArgumentParser(description='Combina os resultados parciais dos shards de uma avaliação distribuída nas métricas finais.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('partial_paths', type=str, nargs='+',
+                        help='Arquivos `partial_stats_*.npz` dos shards, ou pastas onde eles são procurados (incluindo as subpastas).')
+    parser.add_argument('--output_dir', type=str, default='./metrics',
+                        help='Local onde os resultados serão armazenados (métricas e gráficos).')
+    parser.add_argument('--partial_output_path', type=str, default='',
+                        help='Caminho opcional onde os resultados parciais combinados são salvos, para serem combinados novamente com outros shards (por exemplo, em uma redução hierárquica). Com esse argumento, as métricas só são calculadas se todos os shards (divididos pelo hash) foram combinados.')
+    parser.add_argument('--render_curves', type=str, default='1', choices=['0', '1', 'deferred'],
+                        help='Gera (1) ou não gera (0) gráficos de curvas de PR e TP. Com `deferred`, os gráficos podem ser gerados depois com o script `render_curves.py`.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Quantidade de processos usados para gerar os gráficos em paralelo.')
+    parser.add_argument('--verbose', type=int, default=1,
+                        help='Adiciona ou remove prints no terminal')
+    args = parser.parse_args()
+
+    output_dir_ = os.path.expanduser(args.output_dir)
+    render_curves_ = args.render_curves == '1'
+    verbose_ = bool(args.verbose)
+
+    # The devkit is only imported here, after the arguments are parsed
+    skip_nuscenes_package_init()
+    from classes.PartialDetectionStats import PartialDetectionStats
+
+    # Find the partial results inside the given folders
+    partial_files = []
+    for partial_path in args.partial_paths:
+        partial_path = os.path.expanduser(partial_path)
+        if os.path.isdir(partial_path):
+            partial_files += sorted(glob.glob(os.path.join(glob.escape(partial_path), '**', 'partial_stats_*.npz'),
+                                              recursive=True))
+        else:
+            partial_files.append(partial_path)
+    assert len(partial_files) > 0, 'Error: No partial results found!'
+
+    if verbose_:
+        print(f'Merging the partial results of {len(partial_files)} shards')
+    merged = PartialDetectionStats.merge([PartialDetectionStats.load(path) for path in partial_files])
+
+    if args.partial_output_path != '':
+        merged.save(os.path.expanduser(args.partial_output_path))
+        if verbose_:
+            print(f'Saved the merged partial results to {args.partial_output_path}')
+        shards = merged.shards
+        if shards is None or len(shards['indices']) < shards['num_shards']:
+            # Intermediate reduction: the other shards are merged later
+            sys.exit(0)
+
+    merged.main(output_dir_, render_curves=render_curves_, workers=args.workers, verbose=verbose_)
+
+    if args.render_curves == 'deferred':
+        print(f'Rendering deferred. To render the curves, run: python render_curves.py {output_dir_}')
@@ -0,0 +1,43 @@
+import argparse
+import os
+from functions.lazy_imports import skip_nuscenes_package_init
+
+
+'''
+Gera os gráficos de curvas de PR e TP de avaliações já feitas (por exemplo, com `--render_curves deferred`)
+'''
+if __name__ == "__main__":
+
+    # Settings.
+    parser = argparse.ArgumentParser(description='Gera os gráficos de avaliações já feitas a partir dos JSONs de métricas.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('output_dirs', type=str, nargs='+',
+                        help='Pastas com os resultados das avaliações (`metrics_summary.json` e `metrics_details.json`). As subpastas também são procuradas, então pode ser passada, por exemplo, a pasta com os resultados de vários filtros.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Quantidade de processos usados para gerar os gráficos em paralelo.')
+    parser.add_argument('--verbose', type=int, default=1,
+                        help='Adiciona ou remove prints no terminal')
+    args = parser.parse_args()
+
+    workers_ = args.workers
+    verbose_ = bool(args.verbose)
+
+    # The devkit is only imported here, after the arguments are parsed
+    skip_nuscenes_package_init()
+    from functions.render import load_rendering_data, render_metrics
+
+    # Find every evaluation inside the given folders
+    evaluation_dirs = []
+    for output_dir in args.output_dirs:
+        for dir_path, _, file_names in os.walk(os.path.expanduser(output_dir)):
+            if 'metrics_summary.json' in file_names and 'metrics_details.json' in file_names:
+                evaluation_dirs.append(dir_path)
+    assert len(evaluation_dirs) > 0, 'Error: No evaluation results found!'
+
+    evaluations = []
+    for evaluation_dir in sorted(evaluation_dirs):
+        if verbose_:
+            print(f'Rendering PR and TP curves of {evaluation_dir}')
+        evaluations.append(load_rendering_data(evaluation_dir))
+
+    render_metrics(evaluations, workers=workers_)
@@ -1,10 +1,130 @@
 
 import argparse
+import cProfile
+import multiprocessing
 import os
-from nuscenes.eval.common.config import config_factory
+from collections import deque
+from functools import partial
 import json
-from nuscenes.eval.detection.data_classes import DetectionConfig
-from classes.GenericDetectionEval import GenericDetectionEval
+from classes.ResultCache import ResultCache
+from functions.lazy_imports import skip_nuscenes_package_init
+from functions.presets import resolve_gts_preset
+
+
+# GTs shared by all evaluations. They are loaded only once and inherited by the worker processes (fork).
+shared_gt_boxes = None
+
+
+def load_infer(infer_path: str, config: dict, classes_filter: dict, verbose: bool, devkit_eval: bool) -> tuple:
+    """
+    Loads (and filters) one set of predictions, so it can be done in a background process.
+    :param infer_path: Path of the predictions JSON file.
+    :param config: A serialized DetectionConfig.
+    :param classes_filter: Classes filter (see `load_classes_filter`). If None, no filter is applied.
+    :param verbose: Whether to print to stdout.
+    :param devkit_eval: Whether to load the predictions for the devkit implementation of the evaluation.
+    :return: The predicted boxes and their meta data.
+    """
+    from nuscenes.eval.detection.data_classes import DetectionConfig
+    from classes.GenericDetectionEval import GenericDetectionEval
+    return GenericDetectionEval.load_filtered_predictions(infer_path, DetectionConfig.deserialize(config), classes_filter=classes_filter, verbose=verbose, devkit_eval=devkit_eval)
+
+
+def evaluate_infer(infer_info: dict, config: dict, filter_path: str, render_curves: bool, verbose: bool,
+                   devkit_eval: bool, predictions: tuple = None, profile: bool = False) -> dict:
+    """
+    Evaluates one set of predictions against the shared GTs.
+    :param infer_info: Dict with the name, infer_path and save_path of the predictions.
+    :param config: A serialized DetectionConfig (each evaluation deserializes its own copy, since it may be modified).
+    :param filter_path: Path to JSON filter file (already applied to the shared GTs).
+    :param render_curves: Whether to render PR and TP curves to disk.
+    :param verbose: Whether to print to stdout.
+    :param devkit_eval: Whether to use the devkit implementation of the evaluation.
+    :param predictions: Predicted boxes (already filtered) and meta data given by `load_infer`. If not given, they are
+        loaded from infer_path.
+    :param profile: Whether to record the time and memory of each stage of the evaluation (saved to `timings.json` in
+        save_path).
+    :return: A dict that stores the high-level metrics and meta data (JSON compatible).
+    """
+    from nuscenes.eval.detection.data_classes import DetectionConfig
+    from classes.GenericDetectionEval import GenericDetectionEval
+    pred_boxes, meta = predictions if predictions is not None else (None, None)
+    nusc_eval = GenericDetectionEval(result_path=infer_info['infer_path'], gts_path=None, filter_path=filter_path, config=DetectionConfig.deserialize(config), output_dir=infer_info['save_path'], verbose=verbose, devkit_eval=devkit_eval, gt_boxes=shared_gt_boxes, pred_boxes=pred_boxes, meta=meta, profile=profile)
+    metrics = nusc_eval.main(plot_examples=0, render_curves=render_curves)
+
+    # Plain copy of the metrics (as they are written to the JSON file), since they must be sent between processes
+    return json.loads(json.dumps(metrics))
+
+
+def checkpoint_path(output_path: str) -> str:
+    """
+    Path of the checkpoint (JSON Lines sidecar) of the aggregated results, saved next to them.
+    :param output_path: Path of the aggregated results JSON file.
+    :return: Path of the .jsonl checkpoint file.
+    """
+    return os.path.splitext(output_path)[0] + '.checkpoint.jsonl'
+
+
+def infer_version(infer_path: str) -> dict:
+    """
+    Identifies the version of a predictions file (path, size and modification time), saved with its checkpoint record so
+    a file that changed after it was evaluated is evaluated again on resume.
+    :param infer_path: Path of the predictions JSON file.
+    :return: JSON compatible dict with the absolute path, size and modification time (ns) of the file.
+    """
+    stat = os.stat(infer_path)
+    return {'infer_path': os.path.abspath(infer_path), 'infer_size': stat.st_size, 'infer_mtime_ns': stat.st_mtime_ns}
+
+
+def checkpoint_record(infer_info: dict, metrics: dict) -> dict:
+    """
+    Checkpoint record of a finished evaluation.
+    :param infer_info: Dict with the name and infer_path of the predictions.
+    :param metrics: Metrics of the evaluation.
+    :return: JSON compatible record with the name, the version of the predictions file (see `infer_version`) and the
+        metrics.
+    """
+    return {'name': infer_info['name'], **infer_version(infer_info['infer_path']), 'metrics': metrics}
+
+
+def load_checkpoint(path: str, run_info: dict) -> dict:
+    """
+    Loads the records saved in a checkpoint by an interrupted run with the same settings. A line that was only partially
+    written (e.g. if the run was killed while writing it) is ignored.
+    :param path: Path of the checkpoint file.
+    :param run_info: Settings of the current run (GTs, filter and config), which must match the checkpoint ones.
+    :return: Dict mapping the name of each finished evaluation to its record (see `checkpoint_record`), empty if there is
+        no valid checkpoint.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    finished = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if i == 0:
+                    return {}
+                continue
+            if i == 0 and record.get('run') != run_info:
+                print(f'Ignoring the checkpoint {path}, since it is from a run with different settings')
+                return {}
+            if i > 0:
+                finished[record['name']] = record
+    return finished
+
+
+def append_checkpoint(file, record: dict) -> None:
+    """
+    Appends a record to a checkpoint file as a single line, flushed to disk so it survives a crash.
+    :param file: Checkpoint file, opened in append mode.
+    :param record: JSON compatible record.
+    """
+    file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    file.flush()
+    os.fsync(file.fileno())
 
 
 # Código baseado em: https://github.com/nutonomy/nuscenes-devkit/blob/master/python-sdk/nuscenes/eval/detection/evaluate.py
@@ -39,33 +159,57 @@ if __name__ == "__main__":
     parser.add_argument('--config_path', type=str, default='',
                         help='Caminho do arquivo de configuração'
                              'Se não for fornecido, configurações padrões do desafio da NuScenes serão utilizadas.')
-    parser.add_argument('--render_curves', type=int, default=1,
-                        help='Gera ou não gera gráficos de curvas de PR e TP')
+    parser.add_argument('--render_curves', type=str, default='1', choices=['0', '1', 'deferred'],
+                        help='Gera (1) ou não gera (0) gráficos de curvas de PR e TP. Com `deferred`, os gráficos não são gerados durante a avaliação, mas podem ser gerados depois a partir dos JSONs de métricas com o script `render_curves.py`')
     parser.add_argument('--verbose', type=int, default=1,
                         help='Adiciona ou remove prints no terminal')
+    parser.add_argument('--devkit_eval', type=int, default=0,
+                        help='Utiliza a implementação original (mais lenta) da avaliação do devkit da NuScenes, ao invés da implementação vetorizada. Útil para verificar os resultados.')
+    parser.add_argument('--gts_cache', type=int, default=1,
+                        help='Utiliza um cache binário (em uma pasta `.cache` ao lado do JSON das GTs) para carregar as GTs mais rapidamente. O cache é criado na primeira execução e refeito sempre que o JSON for modificado.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Quantidade de processos usados para avaliar as predições em paralelo. As GTs são carregadas apenas uma vez e compartilhadas com todos os processos.')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Quantidade de arquivos de predições carregados antecipadamente (em processos em segundo plano) enquanto as predições atuais são avaliadas. Com 0 (padrão), cada arquivo é carregado apenas quando for avaliado, sem processos em segundo plano. Usado apenas com `--workers 1`.')
+    parser.add_argument('--render_workers', type=int, default=0,
+                        help='Quantidade de processos usados para gerar os gráficos em segundo plano, enquanto as próximas predições são avaliadas (os prints e erros desses processos podem aparecer fora de ordem). Com 0 (padrão), os gráficos são gerados logo após cada avaliação, sem processos em segundo plano. Usado apenas com `--workers 1`.')
+    parser.add_argument('--result_cache_dir', type=str, default='',
+                        help='Pasta de um cache de resultados. As métricas de cada avaliação são guardadas nela, identificadas pelos hashes do arquivo de predições, do arquivo de GTs, do filtro e das configurações, e as predições que não mudaram desde a última avaliação não são avaliadas novamente. Caso não seja fornecida, o cache não é utilizado.')
+    parser.add_argument('--result_cache_size', type=int, default=1024,
+                        help='Tamanho máximo (em MB) do cache de resultados. Os resultados usados há mais tempo são removidos quando o cache passa desse tamanho.')
+    parser.add_argument('--resume', type=int, default=1,
+                        help='As métricas de cada predição avaliada são salvas em um checkpoint (um arquivo JSON Lines ao lado de `output_dir`, removido ao final). Com 1, uma execução interrompida é retomada do checkpoint, sem avaliar novamente as predições já avaliadas (desde que as GTs, o filtro e as configurações sejam os mesmos; uma predição cujo arquivo mudou (caminho, tamanho ou data de modificação) é avaliada novamente). Com 0, o checkpoint anterior é descartado. Gráficos que estavam sendo gerados em segundo plano durante a interrupção podem ser gerados com o script `render_curves.py`.')
+    parser.add_argument('--profile', type=int, default=0, choices=[0, 1, 2],
+                        help='Com 1, registra o tempo (de parede e de CPU) e o pico de memória (RSS) de cada etapa da avaliação (e de cada classe) de cada predição, salvos em `timings.json` ao lado de `metrics_summary.json` (o carregamento antecipado das predições, feito em segundo plano, não é incluído). Com 2, também salva um perfil do cProfile do processo principal em um arquivo `.pstats` ao lado de `output_dir` (com `--workers` maior que 1, as avaliações são feitas em outros processos e não aparecem nesse perfil).')
     args = parser.parse_args()
 
     result_path_ = os.path.expanduser(args.result_path)
     output_dir_ = os.path.expanduser(args.output_dir)
     config_path = args.config_path
-    render_curves_ = bool(args.render_curves)
+    render_curves_ = args.render_curves == '1'
+    deferred_render = args.render_curves == 'deferred'
     verbose_ = bool(args.verbose)
+    devkit_eval_ = bool(args.devkit_eval)
+    gts_cache_ = bool(args.gts_cache)
+    workers_ = args.workers
+    prefetch_ = args.prefetch
+    render_workers_ = args.render_workers
+    result_cache_dir_ = os.path.expanduser(args.result_cache_dir)
+    result_cache_size_ = args.result_cache_size
+    resume_ = bool(args.resume)
+    profile_ = args.profile
     gts_path_ = args.gts_path
     filter_path_arg = args.filter_path
-    filter_path_ = None  # It will be defined soon
+
+    # The devkit is only imported here, after the arguments are parsed
+    skip_nuscenes_package_init()
+    from nuscenes.eval.common.config import config_factory
+    from nuscenes.eval.detection.data_classes import DetectionConfig
+    from classes.GenericDetectionEval import GenericDetectionEval
+    from functions.filter_eval_boxes import load_classes_filter
 
     # Load gts_path
-    if gts_path_ == 'nuscenes_challenge':
-        gts_path_ = 'gts/detection_trainval_val.json'
-    elif gts_path_ == 'nuscenes_vrus-and-cars':
-        gts_path_ = 'gts/detection_trainval_val.json'
-        filter_path_ = 'filters/nuscenes_vrus-and-cars.json'
-    elif gts_path_ == 'nuscenes_vrus':
-        gts_path_ = 'gts/detection_trainval_val.json'
-        filter_path_ = 'filters/nuscenes_vrus.json'
-    elif gts_path_ == 'nuscenes_vrus-and-vehicles':
-        gts_path_ = 'gts/detection_trainval_val.json'
-        filter_path_ = 'filters/nuscenes_vrus-and-vehicles.json'
+    gts_path_, filter_path_ = resolve_gts_preset(gts_path_)
 
     # Overwrite filter_path if passed by argument
     if filter_path_arg != '':
@@ -80,16 +224,147 @@ if __name__ == "__main__":
     with open(result_path_, 'r') as f:
         infers_set = json.load(f)
 
+    profiler = cProfile.Profile() if profile_ == 2 else None
+    if profiler is not None:
+        profiler.enable()
+
+    evaluate = partial(evaluate_infer, config=cfg_.serialize(), filter_path=filter_path_, render_curves=render_curves_, verbose=verbose_, devkit_eval=devkit_eval_, profile=bool(profile_))
+
     agg_metrics = {}
-    for i, infer_info in enumerate(infers_set):
-        print(f"Evaluating {infer_info['name']}: {i+1}/{len(infers_set)}")
 
-        nusc_eval = GenericDetectionEval(result_path=infer_info['infer_path'], gts_path=gts_path_, filter_path=filter_path_, config=cfg_, output_dir=infer_info['save_path'], verbose=verbose_)
-        metrics = nusc_eval.main(plot_examples=0, render_curves=render_curves_)
+    # Predictions already evaluated by an interrupted run are taken from its checkpoint
+    if os.path.dirname(output_dir_):
+        os.makedirs(os.path.dirname(output_dir_), exist_ok=True)
+    checkpoint_path_ = checkpoint_path(output_dir_)
+    resumed_records = {}
+    run_info_ = {'gts_path': os.path.abspath(gts_path_), 'filter_path': filter_path_ and os.path.abspath(filter_path_), 'config': cfg_.serialize()}
+    if resume_:
+        # An evaluation is only resumed if its predictions file did not change since it was evaluated
+        records = load_checkpoint(checkpoint_path_, run_info_)
+        for infer_info in infers_set:
+            record = records.get(infer_info['name'])
+            if record is not None and os.path.exists(infer_info['infer_path']) and \
+                    {key: record.get(key) for key in ('infer_path', 'infer_size', 'infer_mtime_ns')} == infer_version(infer_info['infer_path']):
+                resumed_records[infer_info['name']] = record
+        agg_metrics.update({name: record['metrics'] for name, record in resumed_records.items()})
+        if agg_metrics:
+            print(f'Resuming from {checkpoint_path_}: {len(agg_metrics)}/{len(infers_set)} predictions were already evaluated')
+    # The checkpoint is rewritten (only with the resumed evaluations) in a temporary file first, so it is never lost
+    with open(f'{checkpoint_path_}.tmp', 'w', encoding='utf-8') as file:
+        append_checkpoint(file, {'run': run_info_})
+        for record in resumed_records.values():
+            append_checkpoint(file, record)
+    os.replace(f'{checkpoint_path_}.tmp', checkpoint_path_)
+    checkpoint_file = open(checkpoint_path_, 'a', encoding='utf-8')
+
+    # Predictions already evaluated (with the same GTs, filter and config) are taken from the cache
+    result_cache = ResultCache(result_cache_dir_, result_cache_size_ * 2 ** 20) if result_cache_dir_ else None
+    cache_keys = {}
+    restored_dirs = []
+    cached_count = 0
+    if result_cache is not None:
+        for infer_info in infers_set:
+            if infer_info['name'] in agg_metrics:
+                continue
+            cache_keys[infer_info['name']] = result_cache.key(infer_info['infer_path'], gts_path_, filter_path_, cfg_.serialize())
+            copied = result_cache.restore(cache_keys[infer_info['name']], infer_info['save_path'])
+            if copied is None:
+                continue
+            with open(os.path.join(infer_info['save_path'], 'metrics_summary.json'), 'r') as f:
+                agg_metrics[infer_info['name']] = json.load(f)
+            append_checkpoint(checkpoint_file, checkpoint_record(infer_info, agg_metrics[infer_info['name']]))
+            cached_count += 1
+            if copied:
+                restored_dirs.append(infer_info['save_path'])
+        print(f'Found {cached_count}/{len(infers_set)} results in the cache {result_cache_dir_}')
+    pending_infers = [infer_info for infer_info in infers_set if infer_info['name'] not in agg_metrics]
+
+    # Load (and filter) the GTs only once for all predictions (and only if some predictions must be evaluated)
+    classes_filter_ = load_classes_filter(filter_path_) if filter_path_ else None
+    if pending_infers:
+        shared_gt_boxes = GenericDetectionEval.load_filtered_gts(gts_path_, cfg_, classes_filter=classes_filter_, verbose=verbose_, devkit_eval=devkit_eval_, gts_cache=gts_cache_)
+
+    if render_curves_:
+        # The plotting modules (matplotlib) are only imported when the curves are rendered
+        from functions.render import init_render_process, render_output_dir
+
+    if workers_ > 1:
+        # The worker processes are forked after the GTs are loaded, so they share the GTs (copy-on-write)
+        with multiprocessing.get_context('fork').Pool(workers_) as pool:
+            for i, (infer_info, metrics) in enumerate(zip(pending_infers, pool.imap(evaluate, pending_infers))):
+                print(f"Evaluated {infer_info['name']}: {i+1}/{len(pending_infers)}")
+                agg_metrics[infer_info['name']] = metrics
+                append_checkpoint(checkpoint_file, checkpoint_record(infer_info, metrics))
+                if result_cache is not None:
+                    result_cache.put(cache_keys[infer_info['name']], infer_info['save_path'])
+        if render_curves_:
+            # The curves of results copied from the cache are rendered from their metrics JSONs
+            for save_path in restored_dirs:
+                render_output_dir(save_path)
+    else:
+        # Pipeline: the next predictions are loaded by background processes while the current ones are evaluated,
+        # and the curves are rendered by background processes (from the metrics JSONs) while the next ones are evaluated
+        context = multiprocessing.get_context('fork')
+        loader_pool = context.Pool(prefetch_) if prefetch_ > 0 else None
+        render_pool = context.Pool(render_workers_, initializer=init_render_process) if render_curves_ and render_workers_ > 0 else None
+        if render_pool is not None:
+            evaluate = partial(evaluate, render_curves=False)
+        load = partial(load_infer, config=cfg_.serialize(), classes_filter=classes_filter_, verbose=verbose_, devkit_eval=devkit_eval_)
 
-        agg_metrics[infer_info['name']] = metrics
+        pending_loads = deque()
+        pending_renders = []
+        try:
+            # The curves of results copied from the cache are rendered from their metrics JSONs
+            if render_curves_:
+                for save_path in restored_dirs:
+                    if render_pool is not None:
+                        pending_renders.append(render_pool.apply_async(render_output_dir, (save_path,)))
+                    else:
+                        render_output_dir(save_path)
 
-    os.makedirs(os.path.dirname(output_dir_), exist_ok=True)
+            for i, infer_info in enumerate(pending_infers):
+                predictions = None
+                if loader_pool is not None:
+                    # Keep the current file and up to `prefetch` next files loading (bounded, to limit the memory usage)
+                    while len(pending_loads) <= prefetch_ and i + len(pending_loads) < len(pending_infers):
+                        pending_loads.append(loader_pool.apply_async(load, (pending_infers[i + len(pending_loads)]['infer_path'],)))
+                    predictions = pending_loads.popleft().get()
+
+                print(f"Evaluating {infer_info['name']}: {i+1}/{len(pending_infers)}")
+                agg_metrics[infer_info['name']] = evaluate(infer_info, predictions=predictions)
+                append_checkpoint(checkpoint_file, checkpoint_record(infer_info, agg_metrics[infer_info['name']]))
+                if result_cache is not None:
+                    result_cache.put(cache_keys[infer_info['name']], infer_info['save_path'])
+
+                if render_pool is not None:
+                    pending_renders.append(render_pool.apply_async(render_output_dir, (infer_info['save_path'],)))
+
+            for render in pending_renders:
+                render.get()
+        finally:
+            for pool in (loader_pool, render_pool):
+                if pool is not None:
+                    pool.terminate()
+
+    if result_cache is not None:
+        result_cache.save()
+
+    # Same order of the inference list, wherever the metrics came from
+    agg_metrics = {infer_info['name']: agg_metrics[infer_info['name']] for infer_info in infers_set}
 
     with open(output_dir_, 'w', encoding='utf-8') as file:
-            json.dump(agg_metrics, file, ensure_ascii=False, indent=4)
\ No newline at end of file
+            json.dump(agg_metrics, file, ensure_ascii=False, indent=4)
+
+    # The run finished, so the checkpoint is no longer needed
+    checkpoint_file.close()
+    os.remove(checkpoint_path_)
+
+    if profiler is not None:
+        profiler.disable()
+        profile_path = os.path.splitext(output_dir_)[0] + '.pstats'
+        profiler.dump_stats(profile_path)
+        print(f'Saved the profile to {profile_path}')
+
+    if deferred_render:
+        save_paths = ' '.join(infer_info['save_path'] for infer_info in infers_set)
+        print(f'Rendering deferred. To render the curves, run: python render_curves.py {save_paths}')